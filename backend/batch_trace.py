@@ -0,0 +1,175 @@
+import os
+import copy
+import asyncio
+from dotenv import load_dotenv
+from traceroute import get_route, TracerouteBusyError, TracerouteFailedError
+from ip_location import IPLocation
+from location_operations import merge_frontend_locations, populate_route_information
+from rate_limits import request_priority, PRIORITY_BATCH
+from logging_config import get_logger
+
+logger = get_logger()
+load_dotenv()
+
+# how many hosts of a batch are traced at once
+BATCH_CONCURRENCY = int(os.environ.get("TRACE_BATCH_CONCURRENCY", 4))
+
+# most hosts accepted in one batch
+BATCH_MAX_HOSTS = int(os.environ.get("TRACE_BATCH_MAX_HOSTS", 500))
+
+class BatchTrace:
+    """
+    Traces a list of hosts and locates every hop, as one sweep.
+
+    Hosts are traced over a bounded pool. Routes from the same vantage point share most
+    of their hops (especially the ones near the source), so every router IP is
+    geolocated and matched to a facility only once for the whole batch: each finished
+    route only looks up the addresses no earlier route has seen, in a single batched
+    geolocation request.
+    """
+
+    def __init__(self, hosts, hops, concurrency=BATCH_CONCURRENCY, trace=get_route, priority=PRIORITY_BATCH):
+        """
+        Args:
+            hosts (list): the addresses to run traceroutes on. duplicates are traced once
+            hops (int): the maximum number of hops for each traceroute
+            concurrency (int): most traceroutes to run at once
+            trace (function): async function (host, hops) -> get_route output. lets the
+                caller put a cache in front of get_route
+            priority (int): priority of the batch's upstream requests. batches go behind
+                interactive requests by default
+        """
+        self.hosts = list(dict.fromkeys(hosts))
+        self.hops = hops
+        self.concurrency = concurrency
+        self.trace = trace
+        self.priority = priority
+
+        # IP address -> task that locates it (geolocation + facility). the task resolves
+        # to a dict of IP address -> IPLocation for every address looked up with it
+        self._lookups = {}
+
+        self.stats = {"hosts": len(self.hosts), "failed": 0, "hops": 0, "unique_ips": 0}
+
+    async def run(self):
+        """
+        Runs the batch
+
+        Yields:
+            (string, dict): (event name, event data) pairs, one per host in the order the
+                hosts finish:
+                route: {"host", "ip_addresses", "time_info", "locations"} with the merged
+                    frontend locations of the route
+                error: {"host", "detail"} if the host couldn't be traced
+        """
+        events = asyncio.Queue()
+        slots = asyncio.Semaphore(self.concurrency)
+
+        async def run_host(host):
+            # every task has its own copy of the context, so this only applies to this
+            # host's requests (and the lookup tasks it starts)
+            request_priority.set(self.priority)
+            async with slots:
+                try:
+                    event = await self._run_host(host)
+                except Exception as e:
+                    # run() waits for one event per host, so a failure past the trace
+                    # (locating, cable matching, merging) still has to send one
+                    logger.error(f"[BatchTrace.run]: failed to locate {host}: {e}")
+                    self.stats["failed"] += 1
+                    event = ("error", {"host": host, "detail": "failed to locate route"})
+            await events.put(event)
+
+        tasks = [asyncio.create_task(run_host(host)) for host in self.hosts]
+        try:
+            for _ in tasks:
+                yield await events.get()
+        finally:
+            # the client may have disconnected, stop whatever is still running
+            for task in [*tasks, *self._lookups.values()]:
+                task.cancel()
+
+    async def _run_host(self, host):
+        """
+        Traces and locates a single host
+
+        Returns:
+            (string, dict): the event for the host
+        """
+        try:
+            route = await self.trace(host, self.hops)
+        except TracerouteBusyError:
+            self.stats["failed"] += 1
+            return ("error", {"host": host, "detail": "too many traceroutes in progress"})
+        except TracerouteFailedError:
+            self.stats["failed"] += 1
+            return ("error", {"host": host, "detail": "traceroute failed"})
+        except Exception as e:
+            logger.error(f"[BatchTrace._run_host]: failed to trace {host}: {e}")
+            self.stats["failed"] += 1
+            return ("error", {"host": host, "detail": "traceroute failed"})
+
+        ip_addresses = route["ip_addresses"]
+        self.stats["hops"] += len(ip_addresses)
+
+        locations = await self._locate(ip_addresses)
+
+        # setup cable info and compute distances for every adjacent pair of locations
+        populate_route_information(locations)
+
+        frontend_form_locations = [loc.get_frontend_format() for loc in locations]
+        return ("route", {
+            "host": host,
+            "ip_addresses": ip_addresses,
+            "time_info": route["time_info"],
+            "locations": merge_frontend_locations(frontend_form_locations),
+        })
+
+    async def _locate(self, ip_addresses):
+        """
+        Gets the located, non-private IPLocations for a route, looking up only the
+        addresses that haven't been seen earlier in the batch
+
+        Returns:
+            list: IPLocation instances in route order. these are copies, since the cable
+                and distance info filled in afterwards belongs to this route only
+        """
+        new_ips = [ip for ip in dict.fromkeys(ip_addresses) if ip not in self._lookups]
+        if new_ips:
+            lookup = asyncio.create_task(self._lookup(new_ips))
+            for ip in new_ips:
+                self._lookups[ip] = lookup
+            self.stats["unique_ips"] += len(new_ips)
+
+        results = {}
+        for lookup in {self._lookups[ip] for ip in ip_addresses}:
+            try:
+                results.update(await asyncio.shield(lookup))
+            except Exception as e:
+                logger.error(f"[BatchTrace._locate]: failed to locate hops: {e}")
+
+        return [
+            copy.copy(results[ip]) for ip in ip_addresses
+            if ip in results and not results[ip].is_private
+        ]
+
+    async def _lookup(self, ips):
+        """
+        Geolocates a list of new addresses in one batch and finds their facilities
+
+        Returns:
+            dict: IP address -> IPLocation
+        """
+        ip_locations = await IPLocation.create_batch(ips)
+
+        public = [ip_location for ip_location in ip_locations if not ip_location.is_private]
+        results = await asyncio.gather(
+            *[ip_location.find_facility() for ip_location in public],
+            return_exceptions=True
+        )
+        for ip_location, result in zip(public, results):
+            # the location is still useful without a facility
+            if isinstance(result, Exception):
+                logger.error(f"[BatchTrace._lookup]: failed to find facility for {ip_location.ip}: {result}")
+
+        return {ip_location.ip: ip_location for ip_location in ip_locations}
@@ -0,0 +1,91 @@
+import os
+import sys
+import time
+import numpy as np
+
+# run from /backend: python benchmarks/cable_matching_bench.py [number of pairs]
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from undersea_cables import CableMapper, MATCH_ENDPOINTS, MATCH_GEOMETRY, MATCH_STATIONS
+
+TOL = 30
+
+def make_pairs(mapper, n, seed=0):
+    """
+    Makes hop pairs to match: half of them near cable landing points (jittered by about
+    20 km, like geolocated routers in coastal cities), half anywhere on the globe
+
+    Returns:
+        list: (lat_A, lon_A, lat_B, lon_B) tuples
+    """
+    rng = np.random.default_rng(seed)
+    pairs = []
+    for i in range(n):
+        if i % 2:
+            a, b = rng.integers(len(mapper._lat_deg), size=2)
+            lat_A, lon_A = mapper._lat_deg[a] + rng.normal(0, 0.2), mapper._lon_deg[a] + rng.normal(0, 0.2)
+            lat_B, lon_B = mapper._lat_deg[b] + rng.normal(0, 0.2), mapper._lon_deg[b] + rng.normal(0, 0.2)
+        else:
+            lat_A, lat_B = rng.uniform(-70, 70, size=2)
+            lon_A, lon_B = rng.uniform(-180, 180, size=2)
+        pairs.append((float(np.clip(lat_A, -89, 89)), float(lon_A), float(np.clip(lat_B, -89, 89)), float(lon_B)))
+    return pairs
+
+def time_pairs(mapper, pairs):
+    started_at = time.perf_counter()
+    results = [mapper.find_nearest_cable(*pair, tol=TOL) for pair in pairs]
+    return results, (time.perf_counter() - started_at) / len(pairs)
+
+def time_route(mapper, pairs, route_length=30):
+    """
+    Times find_nearest_cables_for_route over routes made of consecutive pair hops
+    """
+    points = [(lat, lon) for lat, lon, _, _ in pairs]
+    routes = [points[i:i + route_length] for i in range(0, len(points), route_length)]
+
+    started_at = time.perf_counter()
+    for route in routes:
+        mapper.find_nearest_cables_for_route(route, tol=TOL)
+    return (time.perf_counter() - started_at) / max(len(points) - len(routes), 1)
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 4000
+
+    started_at = time.perf_counter()
+    endpoints = CableMapper(mode=MATCH_ENDPOINTS)
+    endpoints_load = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    geometry = CableMapper(mode=MATCH_GEOMETRY)
+    geometry_load = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    stations = CableMapper(mode=MATCH_STATIONS)
+    stations_load = time.perf_counter() - started_at
+
+    pairs = make_pairs(endpoints, n)
+    endpoint_results, endpoint_time = time_pairs(endpoints, pairs)
+    geometry_results, geometry_time = time_pairs(geometry, pairs)
+    station_results, station_time = time_pairs(stations, pairs)
+
+    print(f"{n} hop pairs, tol={TOL} km, {len(geometry._segments)} segments, {len(stations._stations.stations)} landing stations")
+    print(f"{'mode':10} {'load':>9} {'per pair':>10} {'per route pair':>15} {'matched':>8}")
+    for name, load, per_pair, mapper, results in (
+        ("endpoints", endpoints_load, endpoint_time, endpoints, endpoint_results),
+        ("geometry", geometry_load, geometry_time, geometry, geometry_results),
+        ("stations", stations_load, station_time, stations, station_results),
+    ):
+        per_route_pair = time_route(mapper, pairs)
+        matched = sum(result is not None for result in results)
+        print(f"{name:10} {load * 1e3:7.1f}ms {per_pair * 1e6:8.1f}us {per_route_pair * 1e6:13.1f}us {matched:8}")
+
+    both = [(e, g) for e, g in zip(endpoint_results, geometry_results) if e and g]
+    only_geometry = sum(1 for e, g in zip(endpoint_results, geometry_results) if g and not e)
+    only_endpoints = sum(1 for e, g in zip(endpoint_results, geometry_results) if e and not g)
+    same = sum(1 for e, g in both if e["id"] == g["id"])
+    print(f"matched by both: {len(both)} ({same} on the same cable), "
+          f"only geometry: {only_geometry}, only endpoints: {only_endpoints}")
+
+    both = [(e, s) for e, s in zip(endpoint_results, station_results) if e and s]
+    same = sum(1 for e, s in both if e["id"] == s["id"])
+    print(f"endpoints and stations both matched: {len(both)} ({same} on the same cable)")
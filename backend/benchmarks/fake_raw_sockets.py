@@ -0,0 +1,177 @@
+import os
+import sys
+import socket
+import struct
+import asyncio
+import argparse
+
+# runs the raw socket tracer against a simulated network instead of raw sockets, so it
+# can be checked without root or a network. run from /backend: python benchmarks/fake_raw_sockets.py
+# every scenario traces a made up path and checks the hops the tracer reports against it:
+# replies matched back to their probe's TTL, unrelated packets ignored, hops that don't
+# answer left empty, and the route cut at the smallest TTL that reached the destination
+# even when probes with a bigger TTL answer first. exits with status 1 if any scenario fails
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from raw_tracer import RawSocketTracer, ICMP_TIME_EXCEEDED, TCP_SYN, TCP_ACK, TCP_RST
+
+SOURCE_IP = "192.0.2.1"
+DESTINATION_IP = "203.0.113.50"
+
+class FakeNetwork:
+    """
+    A path of routers in front of the destination. Answers every probe written to the
+    "send" socket the way the real network would: an ICMP time exceeded from the router
+    the probe expired at, or a SYN-ACK (RST if closed) from the destination once the
+    TTL is big enough. Replies are written to datagram socketpairs, so the tracer reads
+    them with the event loop like it reads real sockets
+    """
+
+    def __init__(self, routers, silent=(), closed=False, delay=0.001, reverse=False, noise=False):
+        """
+        Args:
+            routers (list): router addresses, the destination is one hop after the last
+            silent (tuple): TTLs that never answer
+            closed (bool): whether the destination answers with a RST instead of a SYN-ACK
+            delay (float): seconds before a reply arrives, per hop
+            reverse (bool): make replies from further hops arrive first
+            noise (bool): send an unrelated ICMP error and TCP packet along with every reply
+        """
+        self.routers = routers
+        self.silent = set(silent)
+        self.closed = closed
+        self.delay = delay
+        self.reverse = reverse
+        self.noise = noise
+
+        # kind -> (end the tracer reads, end the network writes)
+        self._pairs = {}
+
+    def socket_factory(self, kind, dst_ip):
+        if kind == "send":
+            return FakeSendSocket(self)
+
+        reader, writer = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        reader.setblocking(False)
+        self._pairs[kind] = (reader, writer)
+        return reader
+
+    def close(self):
+        for _, writer in self._pairs.values():
+            writer.close()
+
+    def probe(self, packet):
+        """
+        Answers a probe packet
+        """
+        ihl = (packet[0] & 0x0F) * 4
+        ttl = packet[8]
+        src_port, dst_port, seq = struct.unpack("!HHI", packet[ihl:ihl + 8])
+        if ttl in self.silent:
+            return
+
+        delay = self.delay * ((64 - ttl) if self.reverse else ttl)
+        loop = asyncio.get_running_loop()
+
+        if ttl <= len(self.routers):
+            reply = _icmp_packet(self.routers[ttl - 1], packet[:ihl + 8])
+            loop.call_later(delay, self._deliver, "icmp", reply)
+        else:
+            flags = TCP_RST | TCP_ACK if self.closed else TCP_SYN | TCP_ACK
+            reply = _tcp_packet(DESTINATION_IP, dst_port, src_port, seq + 1, flags)
+            loop.call_later(delay, self._deliver, "tcp", reply)
+
+        if self.noise:
+            # someone else's traceroute through the same routers
+            other = bytearray(packet[:ihl + 8])
+            other[ihl:ihl + 2] = struct.pack("!H", src_port ^ 1)
+            loop.call_later(delay / 2, self._deliver, "icmp", _icmp_packet("198.51.100.1", bytes(other)))
+            loop.call_later(delay / 2, self._deliver, "tcp", _tcp_packet(DESTINATION_IP, 80, src_port, seq + 1, TCP_SYN | TCP_ACK))
+
+    def _deliver(self, kind, packet):
+        pair = self._pairs.get(kind)
+        if pair:
+            try:
+                pair[1].send(packet)
+            except OSError:
+                # the tracer already closed its end
+                pass
+
+class FakeSendSocket:
+    def __init__(self, network):
+        self.network = network
+
+    def send(self, packet):
+        self.network.probe(packet)
+        return len(packet)
+
+    def close(self):
+        pass
+
+class FakeRawSocketTracer(RawSocketTracer):
+    @staticmethod
+    def _source_address(dst_ip):
+        return SOURCE_IP
+
+def _ip_header(src_ip, dst_ip, protocol, payload_length):
+    return struct.pack(
+        "!BBHHHBBH4s4s",
+        (4 << 4) | 5, 0, 20 + payload_length, 0, 0, 64, protocol, 0,
+        socket.inet_aton(src_ip), socket.inet_aton(dst_ip)
+    )
+
+def _icmp_packet(router_ip, quoted):
+    icmp = struct.pack("!BBHI", ICMP_TIME_EXCEEDED, 0, 0, 0) + quoted
+    return _ip_header(router_ip, SOURCE_IP, socket.IPPROTO_ICMP, len(icmp)) + icmp
+
+def _tcp_packet(src_ip, src_port, dst_port, ack, flags):
+    tcp = struct.pack("!HHIIBBHHH", src_port, dst_port, 0, ack, 5 << 4, flags, 65535, 0, 0)
+    return _ip_header(src_ip, SOURCE_IP, socket.IPPROTO_TCP, len(tcp)) + tcp
+
+ROUTERS = [f"10.0.{i}.1" for i in range(1, 4)] + [f"198.51.100.{i}" for i in range(10, 17)]
+
+# name -> (FakeNetwork arguments, max hops)
+SCENARIOS = {
+    "open port": ({"routers": ROUTERS}, 30),
+    "closed port": ({"routers": ROUTERS, "closed": True}, 30),
+    "silent hops": ({"routers": ROUTERS, "silent": (2, 5)}, 30),
+    "bigger ttls answer first": ({"routers": ROUTERS, "reverse": True}, 30),
+    "unrelated packets": ({"routers": ROUTERS, "noise": True}, 30),
+    "max hops before the destination": ({"routers": ROUTERS}, 6),
+}
+
+def expected_hops(routers, hops, silent=(), closed=False, **_):
+    """
+    The hops the tracer should report for a scenario
+    """
+    path = [*routers, DESTINATION_IP][:hops]
+    return [
+        (ttl, None if ttl in silent else ip, None if ttl in silent or ip != DESTINATION_IP else ("closed" if closed else "open"))
+        for ttl, ip in enumerate(path, start=1)
+    ]
+
+async def run_scenario(network_args, hops, wait):
+    network = FakeNetwork(**network_args)
+    tracer = FakeRawSocketTracer(wait=wait, socket_factory=network.socket_factory)
+    try:
+        result = await tracer.trace(DESTINATION_IP, hops)
+    finally:
+        network.close()
+    return [(hop["hop"], hop["ip"], hop["marker"]) for hop in result]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="check the raw socket tracer against simulated networks")
+    parser.add_argument("--wait", type=float, default=0.3, help="tracer reply wait in seconds")
+    args = parser.parse_args()
+
+    failed = []
+    for name, (network_args, hops) in SCENARIOS.items():
+        got = asyncio.run(run_scenario(network_args, hops, args.wait))
+        expected = expected_hops(hops=hops, **network_args)
+        print(f"{'ok' if got == expected else 'FAILED':7} {name}")
+        if got != expected:
+            failed.append(name)
+            print(f"        expected {expected}\n        got      {got}")
+
+    if failed:
+        sys.exit(1)
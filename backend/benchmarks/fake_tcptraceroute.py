@@ -0,0 +1,50 @@
+import os
+import sys
+import glob
+import time
+import zlib
+
+# fake tracer: takes tcptraceroute's arguments and replays a recorded output instead of
+# sending probes, so traces work without root or a network. used through the
+# tcptraceroute engine, e.g. in /backend/.env:
+#   TRACEROUTE_COMMAND=python benchmarks/fake_tcptraceroute.py
+# FAKE_TRACE_OUTPUT picks the recorded output (default: chosen by hashing the host), and
+# FAKE_TRACE_SPEED scales the replay: 1 waits each hop's round trip time (1 second for
+# hops that timed out) like the real thing, 0 prints everything at once
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from traceroute_parser import parse_hop_line
+
+outputs_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "traceroute_outputs")
+
+def pick_output(host):
+    """
+    Picks the recorded output to replay for a host, the same one every time
+    """
+    path = os.environ.get("FAKE_TRACE_OUTPUT")
+    if path:
+        return path
+
+    outputs = sorted(glob.glob(os.path.join(outputs_dir, "*.txt")))
+    return outputs[zlib.crc32(host.encode()) % len(outputs)]
+
+def replay(path, max_hops, speed):
+    with open(path, newline="") as f:
+        lines = f.read().splitlines()
+
+    for line in lines:
+        hop = parse_hop_line(line)
+        if hop:
+            if hop.ttl > max_hops:
+                break
+            # each probe waits for its answer, or the 1 second -w timeout
+            time.sleep(sum(1.0 if rtt is None else rtt / 1000 for rtt in hop.rtts or [None]) * speed)
+        print(line, flush=True)
+
+if __name__ == "__main__":
+    # same arguments as tcptraceroute: [options] host [port]. only -m matters here
+    args = sys.argv[1:]
+    max_hops = int(args[args.index("-m") + 1]) if "-m" in args else 30
+    positional = [arg for i, arg in enumerate(args) if not arg.startswith("-") and (i == 0 or not args[i - 1].startswith("-"))]
+
+    replay(pick_output(positional[0]), max_hops, float(os.environ.get("FAKE_TRACE_SPEED", 1)))
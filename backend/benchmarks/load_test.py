@@ -0,0 +1,242 @@
+import os
+import sys
+import json
+import glob
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import httpx
+
+# end-to-end load test of /api/getLocations with no network: starts the mock upstreams
+# and a backend pointed at them, fires routes at it and reports latency percentiles and
+# throughput. run from /backend: python benchmarks/load_test.py --requests 500 --concurrency 16
+# (or --url http://127.0.0.1:8000 to load test a backend that's already running)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from traceroute_parser import parse_traceroute
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+backend_dir = os.path.dirname(benchmarks_dir)
+
+# first octets of the synthetic public addresses
+PUBLIC_OCTETS = (23, 31, 45, 62, 80, 89, 104, 130, 151, 185, 195, 203, 212)
+
+def recorded_routes():
+    """
+    Hop addresses of every recorded traceroute output
+    """
+    routes = []
+    for path in sorted(glob.glob(os.path.join(benchmarks_dir, "traceroute_outputs", "*.txt"))):
+        with open(path, newline="") as f:
+            routes.append([hop.ip for hop in parse_traceroute(f.read()) if hop.ip])
+    return routes
+
+def make_requests(n, route_length, unique, seed=0):
+    """
+    Makes the request bodies: recorded routes padded out with synthetic hops from a
+    shared pool (so routes overlap the way real ones do), and a share of addresses no
+    other request uses (so caches don't answer everything)
+
+    Args:
+        n (int): number of requests
+        route_length (int): hops per route
+        unique (float): share of each route's hops that are seen only once
+
+    Returns:
+        list: IP address lists
+    """
+    rng = random.Random(seed)
+
+    def public_ip():
+        return f"{rng.choice(PUBLIC_OCTETS)}.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(1, 255)}"
+
+    shared = [public_ip() for _ in range(200)]
+    recorded = recorded_routes()
+
+    bodies = []
+    for _ in range(n):
+        route = list(rng.choice(recorded))
+        while len(route) < route_length:
+            route.append(public_ip() if rng.random() < unique else rng.choice(shared))
+        bodies.append(route[:route_length])
+    return bodies
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+async def run_load(url, bodies, concurrency):
+    """
+    Sends every request, concurrency at a time
+
+    Returns:
+        (list, int, float): latencies of the successful requests in seconds, number of
+            failed requests, and the wall time of the whole run
+    """
+    latencies = []
+    failures = 0
+    pending = iter(bodies)
+
+    async def worker(client):
+        nonlocal failures
+        for body in pending:
+            started_at = time.perf_counter()
+            try:
+                response = await client.post("/api/getLocations", json=body)
+                response.raise_for_status()
+            except httpx.HTTPError as e:
+                failures += 1
+                print(f"request failed: {e!r}")
+                continue
+            latencies.append(time.perf_counter() - started_at)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=120) as client:
+        started_at = time.perf_counter()
+        await asyncio.gather(*[worker(client) for _ in range(concurrency)])
+        return latencies, failures, time.perf_counter() - started_at
+
+def stage_summary(url):
+    """
+    Reads the mean time per call of every instrumented stage from the backend's /metrics
+
+    Returns:
+        dict: stage -> (calls, mean seconds), empty if metrics are disabled
+    """
+    response = httpx.get(f"{url}/metrics", timeout=10)
+    if response.status_code != 200:
+        return {}
+
+    sums, counts = {}, {}
+    for line in response.text.splitlines():
+        for suffix, values in (("_sum", sums), ("_count", counts)):
+            prefix = f"traceroute_stage_duration_seconds{suffix}{{stage=\""
+            if line.startswith(prefix):
+                stage, value = line[len(prefix):].split('"} ')
+                values[stage] = float(value)
+
+    return {stage: (int(counts[stage]), sums[stage] / counts[stage]) for stage in counts if counts[stage]}
+
+def wait_until_up(url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with status {process.returncode}")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} didn't come up in {timeout}s")
+
+def start_servers(args, workdir):
+    """
+    Starts the mock upstreams and a backend that uses them
+
+    Returns:
+        (string, list): backend url and the server processes
+    """
+    mock_url = f"http://127.0.0.1:{args.mock_port}"
+    mock = subprocess.Popen([
+        sys.executable, os.path.join(benchmarks_dir, "mock_upstreams.py"),
+        "--port", str(args.mock_port),
+        "--latency", str(args.latency),
+        "--jitter", str(args.jitter),
+        "--ip-api-limit", str(args.ip_api_limit),
+        "--ip-api-batch-limit", str(args.ip_api_batch_limit),
+        "--peeringdb-rate", str(args.peeringdb_rate),
+    ])
+    wait_until_up(f"{mock_url}/mock/stats", mock)
+
+    env = {
+        **os.environ,
+        "IP_API_URL": mock_url,
+        "PEERINGDB_URL": mock_url,
+        "PEERING_DB_API_KEY": os.environ.get("PEERING_DB_API_KEY", "benchmark"),
+        # no local data sources, every lookup goes to the mocks (or the in-memory caches)
+        "PEERINGDB_MIRROR": os.path.join(workdir, "no-mirror.sqlite3"),
+        "GEO_IP_DATABASE": os.path.join(workdir, "no-ip-ranges.bin"),
+        "GEO_CACHE_DB": "",
+        "TRACEROUTE_COMMAND": f"{sys.executable} {os.path.join(benchmarks_dir, 'fake_tcptraceroute.py')}",
+        # per-stage timings for the report
+        "METRICS_ENABLED": "1",
+    }
+    if not args.real_limits:
+        # measure the backend, not the production rate limits
+        for prefix in ("IP_API", "IP_API_BATCH", "PEERINGDB"):
+            env[f"{prefix}_RATE"] = "100000"
+            env[f"{prefix}_BURST"] = "100000"
+            env[f"{prefix}_MAX_CONCURRENCY"] = "1000"
+
+    backend_url = f"http://127.0.0.1:{args.port}"
+    backend = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.port), "--log-level", "warning"],
+        cwd=backend_dir,
+        env=env,
+    )
+    try:
+        wait_until_up(f"{backend_url}/api/traceroute/stats", backend)
+    except Exception:
+        mock.terminate()
+        raise
+    return backend_url, [backend, mock]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="offline load test of /api/getLocations")
+    parser.add_argument("--url", help="load test this running backend instead of starting one")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--route-length", type=int, default=20, help="hops per request")
+    parser.add_argument("--unique", type=float, default=0.3, help="share of hops no other request has")
+    parser.add_argument("--warmup", type=int, default=20, help="requests sent before measuring")
+    parser.add_argument("--port", type=int, default=8099, help="port for the backend")
+    parser.add_argument("--mock-port", type=int, default=8100, help="port for the mock upstreams")
+    parser.add_argument("--latency", type=float, default=30, help="mock upstream latency in ms")
+    parser.add_argument("--jitter", type=float, default=20, help="extra random mock upstream latency in ms")
+    parser.add_argument("--ip-api-limit", type=int, default=0, help="mock ip-api /json limit per minute (0 = unlimited)")
+    parser.add_argument("--ip-api-batch-limit", type=int, default=0, help="mock ip-api /batch limit per minute (0 = unlimited)")
+    parser.add_argument("--peeringdb-rate", type=float, default=0, help="mock PeeringDB requests per second (0 = unlimited)")
+    parser.add_argument("--real-limits", action="store_true", help="keep the backend's default upstream rate limits")
+    parser.add_argument("--json", action="store_true", help="print the results as json")
+    args = parser.parse_args()
+
+    bodies = make_requests(args.warmup + args.requests, args.route_length, args.unique)
+
+    processes = []
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            url = args.url
+            if not url:
+                url, processes = start_servers(args, workdir)
+
+            asyncio.run(run_load(url, bodies[:args.warmup], args.concurrency))
+            latencies, failures, elapsed = asyncio.run(run_load(url, bodies[args.warmup:], args.concurrency))
+            stages = stage_summary(url)
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+
+    results = {
+        "requests": args.requests,
+        "failed": failures,
+        "concurrency": args.concurrency,
+        "requests_per_s": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1e3 if latencies else None,
+        "p90_ms": percentile(latencies, 90) * 1e3 if latencies else None,
+        "p99_ms": percentile(latencies, 99) * 1e3 if latencies else None,
+        "max_ms": max(latencies) * 1e3 if latencies else None,
+        "stages": {stage: {"calls": calls, "mean_ms": mean * 1e3} for stage, (calls, mean) in stages.items()},
+    }
+    if args.json:
+        print(json.dumps(results))
+    else:
+        print(f"{len(latencies)} ok, {failures} failed in {elapsed:.2f}s at concurrency {args.concurrency}")
+        if latencies:
+            print(f"{results['requests_per_s']:.1f} req/s   p50 {results['p50_ms']:.1f} ms   "
+                  f"p90 {results['p90_ms']:.1f} ms   p99 {results['p99_ms']:.1f} ms   max {results['max_ms']:.1f} ms")
+        for stage, (calls, mean) in sorted(stages.items()):
+            print(f"  {stage:20} {calls:7} calls   {mean * 1e3:8.3f} ms mean")
@@ -0,0 +1,131 @@
+import os
+import sys
+import json
+import time
+import glob
+import timeit
+import argparse
+
+# run from /backend: python benchmarks/microbench.py [--save baseline.json | --compare baseline.json]
+# times the hot CPU paths against the offline corpus. --compare exits with status 1 if
+# anything got slower than the baseline by more than --tolerance, for regression checks
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from traceroute_parser import parse_traceroute
+from location_operations import merge_frontend_locations, cableMapper
+from cable_matching_bench import make_pairs, TOL
+from mock_upstreams import MockUpstreams
+
+outputs_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "traceroute_outputs")
+
+def bench(function, repeat=5, min_time=0.2):
+    """
+    Times a function, best of repeat runs of enough calls to take min_time seconds
+
+    Returns:
+        float: seconds per call
+    """
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+    return min(timer.repeat(repeat, number)) / number
+
+def bench_find_nearest_cable(n=2000):
+    pairs = make_pairs(cableMapper, n)
+
+    def run():
+        for pair in pairs:
+            cableMapper.find_nearest_cable(*pair, tol=TOL)
+
+    return bench(run) / n
+
+def bench_parse_traceroute():
+    outputs = []
+    for path in sorted(glob.glob(os.path.join(outputs_dir, "*.txt"))):
+        with open(path, newline="") as f:
+            outputs.append(f.read())
+
+    def run():
+        for output in outputs:
+            parse_traceroute(output)
+
+    return bench(run) / len(outputs)
+
+def make_frontend_route(length=30):
+    """
+    Makes a route in frontend format the way get_locations hands it to
+    merge_frontend_locations: runs of hops at the same place, some sharing a facility
+    """
+    upstreams = MockUpstreams()
+    route = []
+    for i in range(length):
+        # a new place every 3 hops
+        geo = upstreams.geolocate(f"151.101.{(i // 3) * 7}.1")
+        route.append({
+            "ips": [f"151.101.{i}.1"],
+            "latitude": geo["lat"],
+            "longitude": geo["lon"],
+            "city": geo["city"],
+            "country": geo["countryCode"],
+            "facility": {"id": i // 3} if i % 2 else None,
+            "isp": geo["isp"],
+            "source_cable": None,
+            "dest_cable": None,
+            "distance_to": 0,
+            "distance_from": 0,
+        })
+    return route
+
+def bench_merge_frontend_locations(copies=2000, repeat=7):
+    route = make_frontend_route()
+
+    # merge_frontend_locations changes its input, so every call gets a fresh copy, made
+    # outside the timed loop
+    best = float("inf")
+    for _ in range(repeat):
+        routes = [[{**location, "ips": list(location["ips"])} for location in route] for _ in range(copies)]
+        started_at = time.perf_counter()
+        for copy in routes:
+            merge_frontend_locations(copy)
+        best = min(best, time.perf_counter() - started_at)
+
+    return best / copies
+
+BENCHMARKS = {
+    "find_nearest_cable": bench_find_nearest_cable,
+    "parse_traceroute": bench_parse_traceroute,
+    "merge_frontend_locations": bench_merge_frontend_locations,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="offline microbenchmarks")
+    parser.add_argument("--save", help="write the results to this baseline file")
+    parser.add_argument("--compare", help="compare the results against this baseline file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown against the baseline (0.25 = 25%%)")
+    args = parser.parse_args()
+
+    results = {}
+    for name, function in BENCHMARKS.items():
+        results[name] = function()
+        print(f"{name:28} {results[name] * 1e6:9.2f} us per call")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        regressed = []
+        for name, seconds in results.items():
+            if name not in baseline:
+                continue
+            change = seconds / baseline[name] - 1
+            print(f"{name:28} {change * 100:+7.1f}% vs baseline")
+            if change > args.tolerance:
+                regressed.append(name)
+
+        if regressed:
+            print(f"slower than the baseline: {', '.join(regressed)}")
+            sys.exit(1)
@@ -0,0 +1,263 @@
+import os
+import math
+import time
+import zlib
+import json
+import random
+import asyncio
+import argparse
+import ipaddress
+from fastapi import Body, FastAPI, Request
+from fastapi.responses import JSONResponse
+
+# stand-in for ip-api and PeeringDB, so the backend can be benchmarked without a network.
+# run from /backend: python benchmarks/mock_upstreams.py --port 8100 --latency 40
+# then point the backend at it with IP_API_URL=http://127.0.0.1:8100 and
+# PEERINGDB_URL=http://127.0.0.1:8100 (both APIs are served from the same port)
+
+responses_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "upstream_responses")
+
+# locations handed out to addresses that aren't in the recorded responses:
+# (countryCode, country, region, regionName, city, lat, lon)
+SYNTHETIC_CITIES = (
+    ("US", "United States", "CA", "California", "Los Angeles", 34.0522, -118.2437),
+    ("US", "United States", "VA", "Virginia", "Ashburn", 39.0438, -77.4874),
+    ("US", "United States", "NY", "New York", "New York", 40.7128, -74.006),
+    ("US", "United States", "TX", "Texas", "Dallas", 32.7767, -96.797),
+    ("US", "United States", "WA", "Washington", "Seattle", 47.6062, -122.3321),
+    ("GB", "United Kingdom", "ENG", "England", "London", 51.5074, -0.1278),
+    ("DE", "Germany", "HE", "Hesse", "Frankfurt am Main", 50.1109, 8.6821),
+    ("NL", "Netherlands", "NH", "North Holland", "Amsterdam", 52.3676, 4.9041),
+    ("FR", "France", "IDF", "Ile-de-France", "Paris", 48.8566, 2.3522),
+    ("JP", "Japan", "13", "Tokyo", "Tokyo", 35.6762, 139.6503),
+    ("SG", "Singapore", "01", "Central Singapore", "Singapore", 1.3521, 103.8198),
+    ("AU", "Australia", "NSW", "New South Wales", "Sydney", -33.8688, 151.2093),
+    ("BR", "Brazil", "SP", "Sao Paulo", "Sao Paulo", -23.5505, -46.6333),
+    ("ZA", "South Africa", "WC", "Western Cape", "Cape Town", -33.9249, 18.4241),
+)
+SYNTHETIC_ASNS = (
+    (3356, "Lumen"), (1299, "Arelion"), (2914, "NTT America"), (6939, "Hurricane Electric"),
+    (3257, "GTT Communications"), (6762, "Telecom Italia Sparkle"), (6453, "TATA Communications"),
+    (7018, "AT&T Services"), (701, "Verizon Business"), (16509, "Amazon.com"),
+)
+
+# synthetic fac ids start here, above the recorded ones
+SYNTHETIC_FAC_BASE = 100000
+
+def _load(name):
+    with open(os.path.join(responses_dir, name)) as f:
+        return json.load(f)
+
+class FixedWindowLimit:
+    """
+    ip-api style limit: limit requests per window seconds, reported in X-Rl / X-Ttl
+    """
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self._window_start = time.monotonic()
+        self._count = 0
+
+    def check(self):
+        """
+        Counts a request
+
+        Returns:
+            (bool, dict): whether the request is allowed, and the rate limit headers
+        """
+        now = time.monotonic()
+        if now - self._window_start >= self.window:
+            self._window_start, self._count = now, 0
+
+        self._count += 1
+        ttl = math.ceil(self.window - (now - self._window_start))
+        headers = {"X-Rl": str(max(self.limit - self._count, 0)), "X-Ttl": str(ttl)}
+        return self._count <= self.limit, headers
+
+class TokenBucketLimit:
+    """
+    PeeringDB style limit: a token bucket, 429 with Retry-After once it's empty
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+
+    def check(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True, {}
+        return False, {"Retry-After": str(math.ceil((1 - self._tokens) / self.rate))}
+
+class MockUpstreams:
+    """
+    Recorded ip-api and PeeringDB responses, with deterministic synthetic answers for
+    anything that wasn't recorded, so load tests can use as many addresses as they like
+    """
+
+    def __init__(self):
+        self.ip_api = _load("ip_api.json")
+        self.facs = {fac["id"]: fac for fac in _load("peeringdb_fac.json")["data"]}
+        self.netfacs = _load("peeringdb_netfac.json")["data"]
+        self.recorded_asns = {netfac["local_asn"] for netfac in self.netfacs}
+
+    def geolocate(self, ip):
+        if ip in self.ip_api:
+            return self.ip_api[ip]
+
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return {"status": "fail", "message": "invalid query", "query": ip}
+        if address.is_private or address.is_reserved or address.is_loopback or address.is_link_local:
+            return {"status": "fail", "message": "private range", "query": ip}
+
+        h = zlib.crc32(ip.encode())
+        country_code, country, region, region_name, city, lat, lon = SYNTHETIC_CITIES[h % len(SYNTHETIC_CITIES)]
+        asn, isp = SYNTHETIC_ASNS[(h >> 8) % len(SYNTHETIC_ASNS)]
+        return {
+            "status": "success", "country": country, "countryCode": country_code, "region": region,
+            "regionName": region_name, "city": city, "zip": "", "lat": lat, "lon": lon,
+            "timezone": "UTC", "isp": isp, "org": isp, "as": f"AS{asn} {isp}", "query": ip,
+        }
+
+    def find_netfacs(self, asn, state=None, country=None, city=None):
+        def matches(fac):
+            if state is not None:
+                return fac["state"] == state
+            return fac["country"] == country and fac["city"] == city
+
+        if asn in self.recorded_asns:
+            return [
+                netfac for netfac in self.netfacs
+                if netfac["local_asn"] == asn and matches(self.facs[netfac["fac_id"]])
+            ]
+
+        # synthetic networks are in one to three facilities in every synthetic city
+        netfacs = []
+        for i, location in enumerate(SYNTHETIC_CITIES):
+            fac = self._synthetic_fac(SYNTHETIC_FAC_BASE + i * 10)
+            if not matches(fac):
+                continue
+            for k in range((asn + i) % 3 + 1):
+                fac_id = SYNTHETIC_FAC_BASE + i * 10 + k
+                netfacs.append({"id": fac_id * 100000 + asn, "fac_id": fac_id, "local_asn": asn, "status": "ok"})
+        return netfacs
+
+    def get_fac(self, fac_id):
+        if fac_id in self.facs:
+            return self.facs[fac_id]
+        if SYNTHETIC_FAC_BASE <= fac_id < SYNTHETIC_FAC_BASE + len(SYNTHETIC_CITIES) * 10:
+            return self._synthetic_fac(fac_id)
+        return None
+
+    @staticmethod
+    def _synthetic_fac(fac_id):
+        i, k = divmod(fac_id - SYNTHETIC_FAC_BASE, 10)
+        country_code, _, region, _, city, lat, lon = SYNTHETIC_CITIES[i]
+        return {
+            "id": fac_id, "org_name": f"Colo {k}", "name": f"{city} Colo {k}", "city": city,
+            "state": region, "country": country_code,
+            "latitude": round(lat + 0.01 * k, 4), "longitude": round(lon + 0.01 * k, 4), "status": "ok",
+        }
+
+def create_mock_app(latency=0.0, jitter=0.0, ip_api_limit=0, ip_api_batch_limit=0, ip_api_window=60,
+                    peeringdb_rate=0.0, peeringdb_burst=20):
+    """
+    Creates the mock upstream app
+
+    Args:
+        latency (float): seconds every response is delayed by
+        jitter (float): up to this many extra seconds of random delay
+        ip_api_limit (int): /json requests allowed per window, 0 for no limit
+        ip_api_batch_limit (int): /batch requests allowed per window, 0 for no limit
+        ip_api_window (float): ip-api rate limit window in seconds
+        peeringdb_rate (float): PeeringDB requests per second, 0 for no limit
+        peeringdb_burst (int): PeeringDB token bucket size
+
+    Returns:
+        FastAPI: the app. GET /mock/stats reports request counts
+    """
+    app = FastAPI()
+    upstreams = MockUpstreams()
+    limits = {
+        "json": FixedWindowLimit(ip_api_limit, ip_api_window) if ip_api_limit else None,
+        "batch": FixedWindowLimit(ip_api_batch_limit, ip_api_window) if ip_api_batch_limit else None,
+        "peeringdb": TokenBucketLimit(peeringdb_rate, peeringdb_burst) if peeringdb_rate else None,
+    }
+    stats = {"requests": {}, "throttled": {}}
+
+    async def respond(endpoint, limit, build):
+        stats["requests"][endpoint] = stats["requests"].get(endpoint, 0) + 1
+        allowed, headers = limits[limit].check() if limits[limit] else (True, {})
+
+        delay = latency + random.uniform(0, jitter)
+        if delay:
+            await asyncio.sleep(delay)
+
+        if not allowed:
+            stats["throttled"][endpoint] = stats["throttled"].get(endpoint, 0) + 1
+            return JSONResponse({"message": "rate limited"}, status_code=429, headers=headers)
+        return JSONResponse(build(), headers=headers)
+
+    @app.get("/json/{ip}")
+    async def ip_api_json(ip: str):
+        return await respond("json", "json", lambda: upstreams.geolocate(ip))
+
+    @app.post("/batch")
+    async def ip_api_batch(ips: list = Body(...)):
+        return await respond("batch", "batch", lambda: [upstreams.geolocate(ip) for ip in ips])
+
+    @app.get("/api/netfac")
+    async def netfac(request: Request):
+        params = request.query_params
+        asn = int(params.get("net__asn", 0))
+        return await respond("netfac", "peeringdb", lambda: {"data": upstreams.find_netfacs(
+            asn, params.get("fac__state"), params.get("fac__country"), params.get("fac__city")
+        )})
+
+    @app.get("/api/fac")
+    async def fac(request: Request):
+        ids = [int(fac_id) for fac_id in request.query_params.get("id__in", "").split(",") if fac_id]
+        return await respond("fac", "peeringdb", lambda: {"data": [
+            fac for fac in (upstreams.get_fac(fac_id) for fac_id in ids) if fac
+        ]})
+
+    @app.get("/mock/stats")
+    def mock_stats():
+        return stats
+
+    return app
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="mock ip-api and PeeringDB servers")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency", type=float, default=0, help="response delay in ms")
+    parser.add_argument("--jitter", type=float, default=0, help="up to this much extra random delay in ms")
+    parser.add_argument("--ip-api-limit", type=int, default=0, help="/json requests per window (0 = unlimited)")
+    parser.add_argument("--ip-api-batch-limit", type=int, default=0, help="/batch requests per window (0 = unlimited)")
+    parser.add_argument("--ip-api-window", type=float, default=60, help="ip-api window in seconds")
+    parser.add_argument("--peeringdb-rate", type=float, default=0, help="PeeringDB requests per second (0 = unlimited)")
+    parser.add_argument("--peeringdb-burst", type=int, default=20)
+    args = parser.parse_args()
+
+    app = create_mock_app(
+        latency=args.latency / 1000,
+        jitter=args.jitter / 1000,
+        ip_api_limit=args.ip_api_limit,
+        ip_api_batch_limit=args.ip_api_batch_limit,
+        ip_api_window=args.ip_api_window,
+        peeringdb_rate=args.peeringdb_rate,
+        peeringdb_burst=args.peeringdb_burst,
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
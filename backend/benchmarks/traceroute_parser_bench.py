@@ -0,0 +1,126 @@
+import os
+import re
+import sys
+import glob
+import random
+import timeit
+
+# run from /backend: python benchmarks/traceroute_parser_bench.py [fuzz iterations]
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from traceroute_parser import parse_traceroute
+
+outputs_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "traceroute_outputs")
+
+ip_reg = re.compile(r'^(\d{1,3}(\.\d{1,3}){3}|[0-9a-fA-F:]+(%\w+)?)$')
+hop_number_reg = re.compile(r'^\s*\d+\s')
+
+# the two regex passes the parser replaced, to compare against
+legacy_ip_reg = re.compile(r'(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})')
+legacy_hang_time_reg = re.compile(r'(\d+\.?\d*)\s*ms')
+
+def legacy_parse(output):
+    return legacy_ip_reg.findall(output), [float(x) for x in legacy_hang_time_reg.findall(output)]
+
+def load_outputs():
+    """
+    Reads every recorded traceroute output
+
+    Returns:
+        dict: file name -> output
+    """
+    outputs = {}
+    for path in sorted(glob.glob(os.path.join(outputs_dir, "*.txt"))):
+        with open(path, newline="") as f:
+            outputs[os.path.basename(path)] = f.read()
+    return outputs
+
+def check_hops(hops):
+    """
+    Checks the invariants every parse result has to hold, whatever the input
+    """
+    for hop in hops:
+        assert isinstance(hop.ttl, int) and hop.ttl >= 0, hop
+        assert hop.ip is None or ip_reg.match(hop.ip), hop
+        assert all(rtt is None or rtt >= 0 for rtt in hop.rtts), hop
+        assert hop.marker in (None, "open", "closed"), hop
+        assert hop.ip is not None or hop.rtts, hop
+
+def check_recorded(outputs):
+    """
+    Every numbered line of a recorded output is a hop, and hops come out in order
+    """
+    for name, output in outputs.items():
+        hops = parse_traceroute(output)
+        check_hops(hops)
+
+        hop_lines = [line for line in output.splitlines() if hop_number_reg.match(line)]
+        assert len(hops) == len(hop_lines), name
+        assert [hop.ttl for hop in hops] == list(range(1, len(hops) + 1)), name
+        print(f"{name}: {len(hops)} hops, {sum(hop.ip is None for hop in hops)} timed out")
+
+def mutate(output, rng):
+    """
+    Randomly damages a traceroute output: truncates it, drops/duplicates/swaps lines,
+    changes whitespace and line endings, or sprinkles in random characters
+    """
+    lines = output.splitlines()
+    for _ in range(rng.randint(1, 4)):
+        if not lines:
+            break
+
+        i = rng.randrange(len(lines))
+        mutation = rng.randrange(7)
+        if mutation == 0:
+            lines[i] = lines[i][:rng.randrange(len(lines[i]) + 1)]
+        elif mutation == 1:
+            del lines[i]
+        elif mutation == 2:
+            lines.insert(i, lines[rng.randrange(len(lines))])
+        elif mutation == 3:
+            lines[i] = lines[i].replace(" ", rng.choice(["", "\t", "   "]))
+        elif mutation == 4:
+            chars = list(lines[i])
+            for _ in range(rng.randint(1, 5)):
+                chars.insert(rng.randint(0, len(chars)), rng.choice("0123456789.:*()[]<>ms !abcdef-%"))
+            lines[i] = "".join(chars)
+        elif mutation == 5:
+            lines[i] = "".join(chr(rng.randrange(32, 0x3000)) for _ in range(rng.randrange(40)))
+        else:
+            j = rng.randrange(len(lines))
+            lines[i], lines[j] = lines[j], lines[i]
+
+    return rng.choice(["\n", "\r\n"]).join(lines)
+
+def fuzz(outputs, iterations, seed=0):
+    """
+    Parses randomly damaged outputs. The parser must never raise and must keep its
+    invariants no matter what it's given
+    """
+    rng = random.Random(seed)
+    recorded = list(outputs.values())
+    for _ in range(iterations):
+        output = mutate(rng.choice(recorded), rng)
+        try:
+            check_hops(parse_traceroute(output))
+        except Exception:
+            print(f"parser failed on:\n{output!r}")
+            raise
+    print(f"fuzzed {iterations} outputs")
+
+def benchmark(outputs, number=2000):
+    """
+    Times the single-pass parser against the two regex passes it replaced
+    """
+    for name, output in outputs.items():
+        new = timeit.timeit(lambda: parse_traceroute(output), number=number) / number
+        old = timeit.timeit(lambda: legacy_parse(output), number=number) / number
+        print(f"{name:28} parser {new * 1e6:7.1f} us   legacy regex passes {old * 1e6:7.1f} us")
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    outputs = load_outputs()
+
+    check_recorded(outputs)
+    fuzz(outputs, iterations)
+    benchmark(outputs)
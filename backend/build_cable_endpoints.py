@@ -0,0 +1,8 @@
+from undersea_cables import write_endpoint_artifact, cable_json_path, cable_endpoints_path
+
+# Precompute cable endpoints from the GeoJSON into a compact binary file that CableMapper
+# memory-maps at startup. Re-run this whenever cable-geo.json changes (CableMapper falls back
+# to parsing the JSON if this file is missing or older than the JSON).
+n_cables, n_endpoints = write_endpoint_artifact(cable_json_path, cable_endpoints_path)
+
+print(f"Successfully created {cable_endpoints_path} with {n_cables} cables and {n_endpoints} endpoints")
@@ -0,0 +1,13 @@
+import os
+from cable_geometry import write_cable_geometry, cable_json_path, cable_geometry_dir
+
+# Simplify the cable GeoJSON for every zoom level the map asks for and precompress it, so
+# the backend can serve the map's cable layer without doing any work at startup. Re-run
+# this whenever cable-geo.json changes (the backend simplifies the JSON itself if the
+# artifacts are missing or older than the JSON).
+source_size = os.path.getsize(cable_json_path)
+for zoom, sizes in write_cable_geometry(cable_json_path, cable_geometry_dir).items():
+    encoded = ", ".join(f"{encoding} {size / 1024:.0f} KB" for encoding, size in sizes.items())
+    print(f"zoom {zoom}: {encoded} (cable-geo.json is {source_size / 1024:.0f} KB)")
+
+print(f"Successfully created simplified cable geometry in {cable_geometry_dir}")
@@ -0,0 +1,313 @@
+import os
+import gzip
+import math
+import hashlib
+import orjson
+import numpy as np
+from logging_config import get_logger
+from undersea_cables import cable_json_path, artifact_is_fresh
+
+# brotli is optional, without it the artifacts are only precompressed with gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = get_logger()
+
+# simplified geometry artifacts, written by build_cable_geometry.py
+cable_geometry_dir = "./cable-geometry"
+
+# map zoom levels geometry is simplified for. the client asks for the one that fits its
+# zoom, anything in between is served the next coarser level
+ZOOM_LEVELS = (2, 5, 8)
+
+# feature properties the map uses, the rest are dropped
+GEOMETRY_PROPERTIES = ("id", "name", "color", "feature_id")
+
+# encodings in order of preference
+ENCODINGS = ("br", "gzip", "identity") if brotli else ("gzip", "identity")
+
+# (brotli quality, gzip level). the artifacts are built offline so they get the smallest
+# output, bodies compressed in the server (the fallback when there are no artifacts and
+# single cables) use fast levels so startup and first requests don't stall on brotli 11
+MAX_COMPRESSION = (11, 9)
+FAST_COMPRESSION = (5, 6)
+
+def tolerance_for_zoom(zoom):
+    """
+    Simplification tolerance for a zoom level: the size of one pixel of a 256 pixel tile,
+    in degrees. anything smaller can't be seen at that zoom
+
+    Args:
+        zoom (int): map zoom level
+
+    Returns:
+        float: tolerance in degrees
+    """
+    return 360 / (256 * 2 ** zoom)
+
+def douglas_peucker(points, tolerance):
+    """
+    Simplifies a line with the Douglas-Peucker algorithm: keeps the point farthest from
+    the line between the ends of a stretch if it's more than tolerance away, and splits
+    the stretch there
+
+    Args:
+        points (np.ndarray): (n, 2) line coordinates
+        tolerance (float): largest distance a dropped point can be from the simplified line
+
+    Returns:
+        np.ndarray: the points that are kept, in order
+    """
+    n = len(points)
+    if n < 3:
+        return points
+
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+
+    # explicit stack of (start, end) stretches instead of recursion
+    stack = [(0, n - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+
+        a, b = points[start], points[end]
+        inner = points[start + 1:end]
+        ab = b - a
+        length_sq = ab @ ab
+        if length_sq == 0:
+            distances = np.hypot(*(inner - a).T)
+        else:
+            # distance to the segment, not the infinite line, so loops back toward the
+            # start aren't dropped
+            t = np.clip((inner - a) @ ab / length_sq, 0, 1)
+            distances = np.hypot(*(inner - (a + t[:, np.newaxis] * ab)).T)
+
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = start + 1 + farthest
+            keep[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+
+    return points[keep]
+
+def quantize(points, tolerance):
+    """
+    Rounds coordinates to the fewest decimals that keep the rounding error well under
+    tolerance, and drops points that round onto the previous one
+
+    Returns:
+        np.ndarray: the quantized points
+    """
+    decimals = max(0, math.ceil(-math.log10(tolerance))) + 1
+    points = np.round(points, decimals)
+    if len(points) > 1:
+        moved = np.any(points[1:] != points[:-1], axis=1)
+        points = points[np.concatenate(([True], moved))]
+    return points
+
+def simplify_collection(geojson, zoom):
+    """
+    Simplifies and quantizes every cable in the cable GeoJSON for a zoom level
+
+    Args:
+        geojson (dict): cable FeatureCollection
+        zoom (int): zoom level
+
+    Returns:
+        dict: FeatureCollection with the simplified MultiLineStrings
+    """
+    tolerance = tolerance_for_zoom(zoom)
+    features = []
+    for feature in geojson["features"]:
+        lines = []
+        for line in feature["geometry"]["coordinates"]:
+            simplified = quantize(douglas_peucker(np.asarray(line, dtype=np.float64), tolerance), tolerance)
+            if len(simplified) >= 2:
+                lines.append(simplified.tolist())
+
+        # a short spur can collapse to a single point at low zoom, keep its ends so the
+        # cable is still there
+        if not lines:
+            line = np.asarray(feature["geometry"]["coordinates"][0], dtype=np.float64)
+            lines.append(np.round(line[[0, -1]], 6).tolist())
+
+        features.append({
+            "type": "Feature",
+            "properties": {key: feature["properties"].get(key) for key in GEOMETRY_PROPERTIES},
+            "geometry": {"type": "MultiLineString", "coordinates": lines},
+        })
+
+    return {"type": "FeatureCollection", "features": features}
+
+def _compress(body, encoding, levels=FAST_COMPRESSION):
+    brotli_quality, gzip_level = levels
+    if encoding == "br":
+        return brotli.compress(body, quality=brotli_quality)
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=gzip_level, mtime=0)
+    return body
+
+def _etag(body):
+    return hashlib.sha256(body).hexdigest()[:16]
+
+def write_cable_geometry(source_path=cable_json_path, out_dir=cable_geometry_dir):
+    """
+    Writes the simplified geometry for every zoom level, with a precompressed copy per
+    encoding: z<zoom>.geojson, z<zoom>.geojson.gz and z<zoom>.geojson.br (if brotli is
+    installed)
+
+    Args:
+        source_path (string): path of the cable GeoJSON
+        out_dir (string): directory to write the artifacts to
+
+    Returns:
+        dict: zoom -> size in bytes of each encoding
+    """
+    with open(source_path, "rb") as f:
+        geojson = orjson.loads(f.read())
+
+    os.makedirs(out_dir, exist_ok=True)
+    sizes = {}
+    for zoom in ZOOM_LEVELS:
+        body = orjson.dumps(simplify_collection(geojson, zoom))
+        sizes[zoom] = {}
+        for encoding in ENCODINGS:
+            path = _artifact_path(out_dir, zoom, encoding)
+
+            # write to a temp file and swap it in so running workers never read a half-written file
+            with open(f"{path}.tmp", "wb") as f:
+                f.write(_compress(body, encoding, MAX_COMPRESSION))
+            os.replace(f"{path}.tmp", path)
+            sizes[zoom][encoding] = os.path.getsize(path)
+
+    return sizes
+
+def _artifact_path(out_dir, zoom, encoding):
+    suffix = {"br": ".br", "gzip": ".gz", "identity": ""}[encoding]
+    return os.path.join(out_dir, f"z{zoom}.geojson{suffix}")
+
+class EncodedBody:
+    """
+    A response body in every encoding we serve, with its ETag
+    """
+
+    __slots__ = ("etag", "bodies")
+
+    def __init__(self, body, bodies=None):
+        self.etag = _etag(body)
+
+        # encoding -> bytes, compressed up front (at the fast levels) unless given
+        self.bodies = bodies or {encoding: _compress(body, encoding) for encoding in ENCODINGS}
+
+    def negotiate(self, accept_encoding):
+        """
+        Picks the encoding to send for an Accept-Encoding header
+
+        Returns:
+            (string, bytes): the encoding and the body in it
+        """
+        accepted = set()
+        for part in (accept_encoding or "").split(","):
+            name, _, params = part.strip().partition(";")
+            # q=0 means the client refuses the encoding
+            if params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+                accepted.add(name.strip().lower())
+
+        for encoding in ENCODINGS:
+            if encoding == "identity" or encoding in accepted or "*" in accepted:
+                return encoding, self.bodies[encoding]
+
+class CableGeometryStore:
+    """
+    Simplified cable geometry, ready to serve. Reads the precompressed artifacts when
+    they're up to date, otherwise simplifies cable-geo.json at startup (it only takes a
+    moment, but the artifacts also carry the max-compression brotli/gzip bodies, the
+    fallback only compresses at the fast levels)
+    """
+
+    def __init__(self, source_path=cable_json_path, artifact_dir=cable_geometry_dir):
+        """
+        Args:
+            source_path (string): path of the cable GeoJSON
+            artifact_dir (string): directory with the build_cable_geometry.py output
+        """
+        self.source_path = source_path
+
+        # zoom -> EncodedBody of the whole collection
+        self.collections = {}
+
+        # zoom -> cable id -> features of that cable, and the EncodedBody of each cable
+        # once it's been asked for
+        self._cable_features = {}
+        self._cable_bodies = {}
+
+        if all(artifact_is_fresh(_artifact_path(artifact_dir, zoom, encoding), source_path)
+               for zoom in ZOOM_LEVELS for encoding in ENCODINGS):
+            for zoom in ZOOM_LEVELS:
+                bodies = {}
+                for encoding in ENCODINGS:
+                    with open(_artifact_path(artifact_dir, zoom, encoding), "rb") as f:
+                        bodies[encoding] = f.read()
+                self._add_zoom(zoom, orjson.loads(bodies["identity"]), EncodedBody(bodies["identity"], bodies))
+        else:
+            logger.info(f"[CableGeometryStore]: no up to date artifacts in {artifact_dir}, simplifying {source_path}")
+            with open(source_path, "rb") as f:
+                geojson = orjson.loads(f.read())
+            for zoom in ZOOM_LEVELS:
+                collection = simplify_collection(geojson, zoom)
+                self._add_zoom(zoom, collection, EncodedBody(orjson.dumps(collection)))
+
+        # changes whenever any geometry changes, so clients can cache versioned urls forever
+        self.version = _etag("".join(self.collections[zoom].etag for zoom in ZOOM_LEVELS).encode())
+
+    def _add_zoom(self, zoom, collection, body):
+        self.collections[zoom] = body
+
+        cables = {}
+        for feature in collection["features"]:
+            cables.setdefault(feature["properties"]["id"], []).append(feature)
+        self._cable_features[zoom] = cables
+        self._cable_bodies[zoom] = {}
+
+    @staticmethod
+    def zoom_level(zoom):
+        """
+        Picks the built zoom level to serve for a map zoom: the most detailed one that
+        isn't more detailed than asked for
+        """
+        if zoom is None:
+            return ZOOM_LEVELS[-1]
+        return max((level for level in ZOOM_LEVELS if level <= zoom), default=ZOOM_LEVELS[0])
+
+    def collection(self, zoom=None):
+        """
+        Gets every cable at a zoom level
+
+        Returns:
+            EncodedBody: the FeatureCollection
+        """
+        return self.collections[self.zoom_level(zoom)]
+
+    def cable(self, cable_id, zoom=None):
+        """
+        Gets a single cable at a zoom level
+
+        Returns:
+            EncodedBody: FeatureCollection of the cable's features, or None if there's no
+                cable with that id
+        """
+        level = self.zoom_level(zoom)
+        body = self._cable_bodies[level].get(cable_id)
+        if body is None:
+            features = self._cable_features[level].get(cable_id)
+            if features is None:
+                return None
+            body = self._cable_bodies[level][cable_id] = EncodedBody(
+                orjson.dumps({"type": "FeatureCollection", "features": features})
+            )
+        return body
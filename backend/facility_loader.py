@@ -0,0 +1,148 @@
+import time
+import asyncio
+from collections import OrderedDict
+from rate_limits import upstream_request, request_priority
+from api_keys import get_pdb_api_key
+from logging_config import get_logger
+
+logger = get_logger()
+
+class FacilityLoader:
+    """
+    Batching loader for PeeringDB fac objects.
+
+    Every fac id requested during one event loop tick (across every IPLocation and every
+    request being served) is collected and fetched with a single fac?id__in= query.
+    Requests for an id that is already in flight wait on the same future instead of
+    sending another query, and results are kept in a facility cache shared by everyone,
+    an LRU of at most max_entries facilities.
+    """
+
+    def __init__(self, max_batch=100, ttl=86400, max_entries=10000):
+        """
+        Args:
+            max_batch (int): most ids to put in one id__in query (keeps the url short)
+            ttl (float): seconds a fac object stays in the cache
+            max_entries (int): most fac objects to keep before evicting the least
+                recently used one
+        """
+        self.max_batch = max_batch
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        # fac id -> (expiry timestamp, fac object or None if PeeringDB doesn't have it),
+        # least recently used first
+        self._cache = OrderedDict()
+
+        # fac id -> future that resolves to the fac object, for ids queued or in flight
+        self._pending = {}
+
+        # (id, request priority) waiting for the next flush
+        self._queue = []
+        self._flush_scheduled = False
+
+        # keep references to fetch tasks so they aren't garbage collected mid-flight
+        self._tasks = set()
+
+        self.counters = {"hits": 0, "shared": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    async def load(self, fac_id):
+        """
+        Gets a fac object by id
+
+        Args:
+            fac_id (int): PeeringDB fac id
+
+        Returns:
+            dict: fac object, or None if PeeringDB has no facility with that id
+        """
+        entry = self._cache.get(fac_id)
+        if entry:
+            if entry[0] > time.time():
+                self._cache.move_to_end(fac_id)
+                self.counters["hits"] += 1
+                return entry[1]
+
+            del self._cache[fac_id]
+            self.counters["expirations"] += 1
+
+        future = self._pending.get(fac_id)
+        if future is not None:
+            self.counters["shared"] += 1
+        else:
+            self.counters["misses"] += 1
+            loop = asyncio.get_running_loop()
+            future = self._pending[fac_id] = loop.create_future()
+            self._queue.append((fac_id, request_priority.get()))
+
+            # fetch everything queued during this tick in one go
+            if not self._flush_scheduled:
+                self._flush_scheduled = True
+                loop.call_soon(self._flush)
+
+        # shield so one caller getting cancelled doesn't cancel the lookup for everyone else
+        return await asyncio.shield(future)
+
+    async def load_many(self, fac_ids):
+        """
+        Gets fac objects for a list of ids, in order
+        """
+        return await asyncio.gather(*[self.load(fac_id) for fac_id in fac_ids])
+
+    def _flush(self):
+        """
+        Sends the queued ids off in id__in batches
+        """
+        queued, self._queue = self._queue, []
+        self._flush_scheduled = False
+
+        for i in range(0, len(queued), self.max_batch):
+            chunk = queued[i:i + self.max_batch]
+
+            # a batch shared with an interactive request goes out at interactive priority
+            priority = min(priority for _, priority in chunk)
+            task = asyncio.create_task(self._fetch([fac_id for fac_id, _ in chunk], priority))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _fetch(self, fac_ids, priority):
+        """
+        Fetches a batch of fac objects and resolves everyone waiting on them
+        """
+        try:
+            peering_db_response = await upstream_request(
+                "peeringdb", "GET", "/api/fac",
+                priority=priority,
+                params={"id__in": ",".join(str(fac_id) for fac_id in fac_ids)},
+                headers={"Authorization": f"Api-Key {get_pdb_api_key()}"}
+            )
+            data = peering_db_response.json().get('data') or []
+        except Exception as e:
+            logger.error(f"[FacilityLoader._fetch]: fac lookup failed for {fac_ids}: {e}")
+            for fac_id in fac_ids:
+                future = self._pending.pop(fac_id)
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        facs = {fac["id"]: fac for fac in data}
+        expires_at = time.time() + self.ttl
+
+        for fac_id in fac_ids:
+            fac = facs.get(fac_id)
+            self._remember(fac_id, expires_at, fac)
+
+            future = self._pending.pop(fac_id)
+            if not future.done():
+                future.set_result(fac)
+
+    def _remember(self, fac_id, expires_at, fac):
+        """
+        Adds a fac object to the cache, evicting the least recently used ones if full
+        """
+        self._cache[fac_id] = (expires_at, fac)
+        self._cache.move_to_end(fac_id)
+
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+            self.counters["evictions"] += 1
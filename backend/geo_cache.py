@@ -0,0 +1,286 @@
+import os
+import json
+import time
+import sqlite3
+import asyncio
+from collections import OrderedDict
+from dotenv import load_dotenv
+from logging_config import get_logger
+
+logger = get_logger()
+
+# most addresses read from disk per query
+READ_CHUNK_SIZE = 500
+
+class GeolocationCache:
+    """
+    Two tier cache for ip-api responses.
+
+    The first tier is an in-process LRU with a TTL on every entry. The optional second
+    tier is a SQLite database on local disk, which survives restarts and is shared by
+    every worker pointed at the same file. Failed lookups (private addresses) are cached
+    too, with their own (usually shorter) TTL.
+
+    Disk writes are write-behind: new entries go into memory right away and are written
+    to SQLite in the background, many rows per transaction, on a worker thread so a
+    commit (or a database locked by another worker) never blocks the event loop. Disk
+    reads go through get_many, which looks up a whole batch of addresses in one query on
+    a worker thread, over a connection of its own so it never waits behind a write.
+    """
+
+    def __init__(self, max_entries=10000, ttl=86400, negative_ttl=3600, db_path=None):
+        """
+        Args:
+            max_entries (int): most entries to keep in memory before evicting the least
+                recently used one
+            ttl (float): seconds a successful lookup stays valid
+            negative_ttl (float): seconds a failed lookup stays valid
+            db_path (string): path of the SQLite database, or None to only cache in memory
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+        # ip -> (expiry timestamp, ip-api response dict), least recently used first
+        self._entries = OrderedDict()
+
+        self.counters = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0,
+        }
+
+        self._db = self._open_db(db_path) if db_path else None
+
+        # separate connection for reads. with WAL a read doesn't wait for a commit on the
+        # write connection to finish
+        self._reader = sqlite3.connect(db_path, check_same_thread=False) if db_path else None
+
+        # (ip, expires_at, json) rows waiting to be written to disk, and the task writing them
+        self._pending = []
+        self._flush_task = None
+
+    @staticmethod
+    def _open_db(path):
+        """
+        Opens the persistent tier and clears out expired rows
+        """
+        db = sqlite3.connect(path, check_same_thread=False)
+
+        # WAL lets workers read while another worker is writing
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS geolocation "
+            "(ip TEXT PRIMARY KEY, expires_at REAL NOT NULL, data TEXT NOT NULL)"
+        )
+        db.execute("DELETE FROM geolocation WHERE expires_at <= ?", (time.time(),))
+        db.commit()
+        return db
+
+    def get(self, ip):
+        """
+        Gets the cached ip-api response for an IP address from the memory tier only, so
+        it can be called from synchronous code on the event loop. Addresses it doesn't
+        have should go through get_many, which also checks the disk (and counts the misses)
+
+        Args:
+            ip (string): IP address to look up
+
+        Returns:
+            dict: cached ip-api response, or None if the address isn't in memory or expired
+        """
+        return self._get_memory(ip, time.time())
+
+    async def get_many(self, ips):
+        """
+        Gets the cached ip-api responses for a batch of IP addresses, from memory or else
+        from disk. The addresses that aren't in memory are read from disk in one query
+
+        Args:
+            ips (list): IP addresses to look up
+
+        Returns:
+            dict: IP address -> cached ip-api response, for the addresses that are cached
+        """
+        now = time.time()
+        found = {}
+        cold = []
+        for ip in dict.fromkeys(ips):
+            geo_dict = self._get_memory(ip, now)
+            if geo_dict is None:
+                cold.append(ip)
+            else:
+                found[ip] = geo_dict
+
+        rows = []
+        if self._reader and cold:
+            try:
+                rows = await asyncio.to_thread(self._read, cold, now)
+            except sqlite3.Error as e:
+                logger.error(f"[GeolocationCache]: failed to read {len(cold)} entries from disk: {e}")
+
+            for ip, expires_at, data in rows:
+                # promote to the memory tier so the next lookup doesn't touch disk
+                geo_dict = json.loads(data)
+                self._remember(ip, expires_at, geo_dict)
+                found[ip] = geo_dict
+            self.counters["disk_hits"] += len(rows)
+
+        self.counters["misses"] += len(cold) - len(rows)
+        return found
+
+    def _get_memory(self, ip, now):
+        entry = self._entries.get(ip)
+        if entry is None:
+            return None
+
+        expires_at, geo_dict = entry
+        if expires_at > now:
+            self._entries.move_to_end(ip)
+            self.counters["memory_hits"] += 1
+            return geo_dict
+
+        del self._entries[ip]
+        self.counters["expirations"] += 1
+        return None
+
+    def _read(self, ips, now):
+        rows = []
+        # stay under SQLite's limit on query parameters
+        for i in range(0, len(ips), READ_CHUNK_SIZE):
+            chunk = ips[i:i + READ_CHUNK_SIZE]
+            rows.extend(self._reader.execute(
+                f"SELECT ip, expires_at, data FROM geolocation WHERE ip IN ({','.join('?' * len(chunk))}) AND expires_at > ?",
+                (*chunk, now)
+            ).fetchall())
+        return rows
+
+    def set(self, ip, geo_dict):
+        """
+        Caches an ip-api response for an IP address
+
+        Args:
+            ip (string): IP address the response is for
+            geo_dict (dict): ip-api response
+        """
+        self.set_many([(ip, geo_dict)])
+
+    def set_many(self, items):
+        """
+        Caches a batch of ip-api responses. They're written to disk together, in one
+        transaction
+
+        Args:
+            items (list): (IP address, ip-api response) pairs
+        """
+        now = time.time()
+        rows = []
+        for ip, geo_dict in items:
+            ttl = self.negative_ttl if geo_dict.get("status") == "fail" else self.ttl
+            self._remember(ip, now + ttl, geo_dict)
+            rows.append((ip, now + ttl, json.dumps(geo_dict)))
+
+        if self._db and rows:
+            self._pending.extend(rows)
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        """
+        Starts writing the pending rows to disk, unless a write is already running (it
+        picks up the new rows when it's done)
+        """
+        if self._flush_task and not self._flush_task.done():
+            return
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # no event loop (e.g. a script), just write them now
+            self._write(self._take_pending())
+            return
+        self._flush_task = loop.create_task(self._flush())
+
+    def _take_pending(self):
+        rows, self._pending = self._pending, []
+        return rows
+
+    async def _flush(self):
+        while self._pending:
+            rows = self._take_pending()
+            try:
+                await asyncio.to_thread(self._write, rows)
+            except sqlite3.Error as e:
+                # the entries are still in memory, they just won't survive a restart
+                logger.error(f"[GeolocationCache]: failed to write {len(rows)} entries to disk: {e}")
+
+    def _write(self, rows):
+        if not self._db:
+            return
+        self._db.executemany(
+            "INSERT OR REPLACE INTO geolocation (ip, expires_at, data) VALUES (?, ?, ?)",
+            rows
+        )
+        self._db.commit()
+
+    async def flush(self):
+        """
+        Waits until every entry cached so far is written to disk
+        """
+        while self._flush_task and not self._flush_task.done():
+            await self._flush_task
+
+    def _remember(self, ip, expires_at, geo_dict):
+        """
+        Adds an entry to the memory tier, evicting the least recently used entries if full
+        """
+        self._entries[ip] = (expires_at, geo_dict)
+        self._entries.move_to_end(ip)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    def stats(self):
+        """
+        Returns the cache counters along with the current size and hit ratio
+        """
+        hits = self.counters["memory_hits"] + self.counters["disk_hits"]
+        lookups = hits + self.counters["misses"]
+        return {
+            **self.counters,
+            "size": len(self._entries),
+            "hit_ratio": hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        """
+        Closes the database. Call flush first to wait for background writes, anything
+        still pending is written here
+        """
+        if self._db:
+            if self._pending:
+                self._write(self._take_pending())
+            self._db.close()
+            self._db = None
+        if self._reader:
+            self._reader.close()
+            self._reader = None
+
+def create_geolocation_cache():
+    """
+    Creates a GeolocationCache configured from .env:
+        GEO_CACHE_SIZE: most entries kept in memory (default 10000)
+        GEO_CACHE_TTL: seconds a lookup stays valid (default 1 day)
+        GEO_CACHE_NEGATIVE_TTL: seconds a failed lookup stays valid (default 1 hour)
+        GEO_CACHE_DB: path of the SQLite database. the persistent tier is off if unset
+    """
+    load_dotenv()
+    return GeolocationCache(
+        max_entries=int(os.environ.get("GEO_CACHE_SIZE", 10000)),
+        ttl=float(os.environ.get("GEO_CACHE_TTL", 86400)),
+        negative_ttl=float(os.environ.get("GEO_CACHE_NEGATIVE_TTL", 3600)),
+        db_path=os.environ.get("GEO_CACHE_DB") or None,
+    )
@@ -0,0 +1,132 @@
+import numpy as np
+
+# mean earth radius in km, same value the haversine package uses for Unit.KILOMETERS
+EARTH_RADIUS_KM = 6371.0088
+
+def haversine_distances(lat, lon, lats, lons):
+    """
+    Batched haversine kernel. Computes great-circle distances between a point and
+    an array of points in one pass (or elementwise between two arrays of points)
+
+    Inputs:
+        lat (float or np.ndarray): latitude(s) of the first point(s) in radians
+        lon (float or np.ndarray): longitude(s) of the first point(s) in radians
+        lats (np.ndarray): latitudes of the second points in radians
+        lons (np.ndarray): longitudes of the second points in radians
+
+    Outputs:
+        np.ndarray: distances in km, broadcast to the shape of the inputs
+    """
+    d = (np.sin((lats - lat) * 0.5) ** 2
+         + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) * 0.5) ** 2)
+
+    # rounding can push d a hair past 1 for antipodal points, which arcsin doesn't like
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(d, 1.0)))
+
+def distance_km(lat_A, lon_A, lat_B, lon_B):
+    """
+    Computes the haversine distance between two locations given in degrees
+
+    Inputs:
+        lat_A (float): latitude of location A
+        lon_A (float): longitude of location A
+        lat_B (float): latitude of location B
+        lon_B (float): longitude of location B
+
+    Outputs:
+        float: distance between A and B in km
+    """
+    lat_A, lon_A, lat_B, lon_B = np.radians((lat_A, lon_A, lat_B, lon_B))
+    return float(haversine_distances(lat_A, lon_A, lat_B, lon_B))
+
+def unit_vectors(lat, lon):
+    """
+    Converts latitudes/longitudes to points on the unit sphere
+
+    Inputs:
+        lat (float or np.ndarray): latitude(s) in radians
+        lon (float or np.ndarray): longitude(s) in radians
+
+    Outputs:
+        np.ndarray: x, y, z coordinates along a new last axis
+    """
+    cos_lat = np.cos(lat)
+    return np.stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)), axis=-1)
+
+def unit_vector_to_lat_lon(v):
+    """
+    Converts a point on the unit sphere back to latitude/longitude
+
+    Inputs:
+        v (np.ndarray): x, y, z coordinates
+
+    Outputs:
+        (float, float): latitude and longitude in degrees
+    """
+    x, y, z = v
+    return float(np.degrees(np.arctan2(z, np.hypot(x, y)))), float(np.degrees(np.arctan2(y, x)))
+
+def arc_geometry(a, b):
+    """
+    Precomputes what arc_distances needs to know about a set of great-circle arcs
+
+    Inputs:
+        a (np.ndarray): start of each arc as a unit vector, shape (n, 3)
+        b (np.ndarray): end of each arc as a unit vector, shape (n, 3)
+
+    Outputs:
+        np.ndarray: shape (n, 5, 3). for each arc: its start and end, the unit normal of
+            its great circle (all zeros when the ends are the same point), and the normals
+            of the planes through the circle's poles and each end. a point is beside the
+            arc (between its ends) exactly when it's on the positive side of both planes
+    """
+    normals = np.cross(a, b)
+    norms = np.linalg.norm(normals, axis=1)[:, np.newaxis]
+    normals = np.divide(normals, norms, out=np.zeros_like(normals), where=norms > 1e-15)
+    return np.stack((a, b, normals, np.cross(normals, a), np.cross(b, normals)), axis=1)
+
+def arc_distances(p, arcs):
+    """
+    Great-circle distances from a point to many great-circle arcs (segments). Works on
+    unit vectors, so there's no special casing for the poles or the antimeridian
+
+    Inputs:
+        p (np.ndarray): the point as a unit vector, shape (3,)
+        arcs (np.ndarray): arc_geometry of the arcs
+
+    Outputs:
+        (np.ndarray, np.ndarray): distance in km to each arc, and whether the nearest
+            point of each arc is between its ends (otherwise it's the nearer end)
+    """
+    # every dot product we need in one go: p with both ends, the normal and both end planes
+    dots = arcs @ p
+
+    # angle from p to the nearer end (p and the ends are unit vectors)
+    to_ends = np.arccos(np.clip(np.maximum(dots[:, 0], dots[:, 1]), -1.0, 1.0))
+
+    # if p is beside the arc, the nearest point is p projected onto the arc's great
+    # circle and the distance is how far p is off the circle's plane. arcs whose ends
+    # are the same point have a zero normal and so are never beside anything
+    s = np.abs(dots[:, 2])
+    beside = (dots[:, 3] > 0) & (dots[:, 4] > 0) & (s < 1.0)
+
+    distances = np.where(beside, np.arcsin(s), to_ends)
+    return distances * EARTH_RADIUS_KM, beside
+
+def nearest_arc_points(p, arcs, beside):
+    """
+    Gets the point on each arc nearest to p
+
+    Inputs:
+        p, arcs: same as arc_distances
+        beside (np.ndarray): second output of arc_distances
+
+    Outputs:
+        np.ndarray: the nearest point on each arc as a unit vector, shape (n, 3)
+    """
+    nearest = np.where(((arcs[:, 0] @ p) >= (arcs[:, 1] @ p))[:, np.newaxis], arcs[:, 0], arcs[:, 1])
+
+    normals = arcs[beside, 2]
+    projected = p - (normals @ p)[:, np.newaxis] * normals
+    nearest[beside] = projected / np.linalg.norm(projected, axis=1)[:, np.newaxis]
+    return nearest
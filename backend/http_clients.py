@@ -0,0 +1,78 @@
+import os
+import httpx
+from dotenv import load_dotenv
+from logging_config import get_logger
+
+logger = get_logger()
+
+# upstream name -> (env var prefix, default base url, use http/2)
+UPSTREAMS = {
+    "ip_api": ("IP_API", "http://ip-api.com", False),
+    "peeringdb": ("PEERINGDB", "https://www.peeringdb.com", True),
+}
+
+# application-scoped clients, one per upstream. opened in main.py's lifespan
+_clients = {}
+
+def _env_number(name, default, cast=int):
+    value = os.environ.get(name)
+    return cast(value) if value else default
+
+def _create_client(name):
+    """
+    Creates a pooled client for an upstream. Connection limits, keep-alive and timeouts
+    can be set per upstream in .env, e.g. PEERINGDB_MAX_CONNECTIONS=10
+
+    Args:
+        name (string): upstream name (key of UPSTREAMS)
+
+    Returns:
+        httpx.AsyncClient: client with a connection pool for the upstream
+    """
+    load_dotenv()
+    prefix, default_url, http2 = UPSTREAMS[name]
+
+    limits = httpx.Limits(
+        max_connections=_env_number(f"{prefix}_MAX_CONNECTIONS", 20),
+        max_keepalive_connections=_env_number(f"{prefix}_MAX_KEEPALIVE", 10),
+        keepalive_expiry=_env_number(f"{prefix}_KEEPALIVE_EXPIRY", 60.0, float),
+    )
+
+    return httpx.AsyncClient(
+        base_url=os.environ.get(f"{prefix}_URL", default_url),
+        limits=limits,
+        timeout=_env_number(f"{prefix}_TIMEOUT", 10.0, float),
+        http2=http2,
+    )
+
+def get_client(name):
+    """
+    Gets the shared client for an upstream. Requests made through it reuse warm
+    connections instead of doing a new TCP/TLS handshake every time.
+
+    The client is created on first use if open_clients hasn't been called (e.g. when
+    IPLocation is used from a script instead of the app)
+
+    Args:
+        name (string): upstream name (key of UPSTREAMS)
+    """
+    client = _clients.get(name)
+    if client is None or client.is_closed:
+        client = _clients[name] = _create_client(name)
+    return client
+
+def open_clients():
+    """
+    Opens a client for every upstream. Called on app startup
+    """
+    for name in UPSTREAMS:
+        get_client(name)
+
+async def close_clients():
+    """
+    Closes every client and its pooled connections. Called on app shutdown
+    """
+    for name, client in list(_clients.items()):
+        await client.aclose()
+        del _clients[name]
+    logger.debug("[close_clients]: closed upstream http clients")
@@ -1,21 +1,141 @@
 import re
-import httpx
+from rate_limits import upstream_request
 from logging_config import get_logger
+from metrics import timed
 from api_keys import get_pdb_api_key
 import asyncio
-import haversine
+import numpy as np
+from geo_math import haversine_distances
+from geo_cache import create_geolocation_cache
+from ip_ranges import open_geolocation_providers
+from peeringdb_mirror import open_peeringdb_mirror
+from facility_loader import FacilityLoader
 
 logger = get_logger()
 
+# ip-api accepts at most 100 addresses per batch request
+IP_API_BATCH_SIZE = 100
+
+asn_reg = re.compile(r'[0-9]+')
+
+# facility fields the frontend uses. the rest of the PeeringDB fac object is dropped once
+# the nearest facility is picked, so big sweeps don't hold on to thousands of full objects
+FRONTEND_FAC_FIELDS = ("id", "name", "org_name", "latitude", "longitude")
+
+# cache of ip-api responses shared by every IPLocation in this process
+geolocation_cache = create_geolocation_cache()
+
+# local geolocation sources (e.g. the IP range database) asked before ip-api, which is
+# only used for addresses none of them know
+geolocation_providers = open_geolocation_providers()
+
+def _lookup_local(ip):
+    """
+    Asks the local geolocation providers for an IP address, in order
+
+    Returns:
+        dict: ip-api style response from the first provider that knows the address, or None
+    """
+    for provider in geolocation_providers:
+        geo_dict = provider.lookup(ip)
+        if geo_dict is not None:
+            return geo_dict
+    return None
+
+# local PeeringDB snapshot. None if it hasn't been synced, in which case we query peeringdb.com
+peeringdb_mirror = open_peeringdb_mirror()
+
+# batches and caches live fac lookups across every IPLocation in this process
+facility_loader = FacilityLoader()
+
 class IPLocation():
+    # no per-instance __dict__, bulk sweeps keep tens of thousands of these around
+    __slots__ = (
+        "ip", "country", "country_code", "region", "regionName", "city", "zip_code",
+        "latitude", "longitude", "isp", "asn", "_netfac_candidates", "_fac_candidates",
+        "fac", "is_private", "source_cable_info", "destination_cable_info",
+        "distance_to", "distance_from",
+    )
+
     @classmethod
     async def create(cls, ip):
         instance = cls(ip)
         await instance._get_geolocation()
         return instance
 
+    @classmethod
+    async def create_batch(cls, ips):
+        """
+        Creates IPLocation instances for a whole list of IP addresses using ip-api's
+        batch endpoint, so a route costs one request per 100 hops instead of one per hop
+
+        Args:
+            ips (list): IP addresses to locate
+
+        Returns:
+            list: IPLocation instances in the same order as ips
+        """
+        instances = [cls(ip) for ip in ips]
+
+        # fill in locally known and cached (in memory) addresses right away, only look up the rest
+        misses = [instance for instance in instances if not instance._set_known_geolocation()]
+
+        await cls.locate_batch(misses)
+        return instances
+
+    @classmethod
+    def create_known(cls, ip):
+        """
+        Creates an IPLocation from the local providers or the memory tier of the cache
+        only, without touching the disk or asking ip-api
+
+        Returns:
+            IPLocation: the located instance, or None if the address isn't known locally
+        """
+        instance = cls(ip)
+        return instance if instance._set_known_geolocation() else None
+
+    @classmethod
+    async def locate_batch(cls, instances):
+        """
+        Locates instances from the disk tier of the cache, in one read, then the rest
+        with ip-api's batch endpoint, IP_API_BATCH_SIZE per request
+
+        Args:
+            instances (list): IPLocation instances that aren't known locally
+        """
+        cached = await geolocation_cache.get_many([instance.ip for instance in instances])
+        for instance in instances:
+            if instance.ip in cached:
+                instance._set_geolocation(cached[instance.ip])
+        instances = [instance for instance in instances if instance.ip not in cached]
+
+        chunks = [
+            instances[i:i + IP_API_BATCH_SIZE]
+            for i in range(0, len(instances), IP_API_BATCH_SIZE)
+        ]
+
+        await asyncio.gather(*[cls._get_geolocation_batch(chunk) for chunk in chunks])
+
+    def _set_known_geolocation(self):
+        """
+        Fills in location information from the local providers or the memory tier of the cache
+
+        Returns:
+            bool: whether either of them knew the address
+        """
+        geo_dict = _lookup_local(self.ip)
+        if geo_dict is None:
+            geo_dict = geolocation_cache.get(self.ip)
+        if geo_dict is None:
+            return False
+
+        self._set_geolocation(geo_dict)
+        return True
+
     def __init__(self, ip):
         self.ip = ip
+        self.country = None
         self.country_code = None
         self.region = None
         self.regionName = None
@@ -62,6 +182,9 @@ class IPLocation():
         Wrapper function for getting the nearest facility.
         NOTE: Flow of this is subject to change.
         """
+        # PeeringDB is searched by ASN, without one there's nothing to look for
+        if self.asn is None:
+            return
 
         # get nearby facilities with matching asn
         await self._find_netfac_candidates()
@@ -72,112 +195,164 @@ class IPLocation():
         # get nearest facility to original ping latitude and longitude
         self._compute_nearest_fac()
 
+    @timed("geolocate")
     async def _get_geolocation(self):
         """
         Uses ip-api to get location information about an instance's IP address
 
         Called asynchronously as part of class initialization
         """
-        async with httpx.AsyncClient() as client:
-            ip_api_response = await client.get(
-                f"http://ip-api.com/json/{self.ip}"
-            )
+        # local providers first, then the cache, and only then ip-api
+        geo_dict = _lookup_local(self.ip)
+        if geo_dict is None:
+            geo_dict = (await geolocation_cache.get_many([self.ip])).get(self.ip)
+
+        if geo_dict is None:
+            # rate limited per upstream, retried if ip-api throttles us
+            ip_api_response = await upstream_request("ip_api", "GET", f"/json/{self.ip}")
             logger.debug(f"for {self.ip=}: {ip_api_response.json()=}")
             geo_dict = ip_api_response.json()
+            geolocation_cache.set(self.ip, geo_dict)
 
-            # IP-api requests will only fail when the IP address is private.
-            # mark these addresses and move on
-            if geo_dict.get("status") == "fail":
-                self.is_private = True
-                return
+        self._set_geolocation(geo_dict)
 
-            self.country = geo_dict.get("country")
-            self.country_code = geo_dict.get("countryCode")
-            self.region = geo_dict.get("region")
-            self.regionName = geo_dict.get("regionName")
-            self.city = geo_dict.get("city")
-            self.zip_code = geo_dict.get("zip")
-            self.latitude = geo_dict.get("lat")
-            self.longitude = geo_dict.get("lon")
-            self.isp = geo_dict.get("isp")
-
-            # extract digits of asn ID using regex
-            asn_reg = re.compile(r'[0-9]+')
-            self.asn = geo_dict.get("as")
-            match = asn_reg.search(self.asn)
-            if match:
-                self.asn = match.group()
-            else:
-                logger.error(f"[_get_geolocation]: failed to match ASN in {self.asn}")
-                return
+    @staticmethod
+    @timed("geolocate_batch")
+    async def _get_geolocation_batch(instances):
+        """
+        Uses ip-api's batch endpoint to get location information for up to
+        IP_API_BATCH_SIZE instances in one request
 
-    async def _find_netfac_candidates(self):
+        Args:
+            instances (list): IPLocation instances to locate
         """
-        Uses PeeringDB to search for netfac objects using ASN and region
+        ip_api_response = await upstream_request(
+            "ip_api_batch", "POST", "/batch",
+            json=[instance.ip for instance in instances]
+        )
+        logger.debug(f"for {len(instances)} ips: {ip_api_response.json()=}")
+
+        # ip-api returns results in the same order as the request
+        geo_dicts = ip_api_response.json()
+
+        # cached as one disk write instead of one per address
+        geolocation_cache.set_many([(instance.ip, geo_dict) for instance, geo_dict in zip(instances, geo_dicts)])
+
+        for instance, geo_dict in zip(instances, geo_dicts):
+            instance._set_geolocation(geo_dict)
+
+    def _set_geolocation(self, geo_dict):
         """
-        async with httpx.AsyncClient() as client:
-            # check for country code to narrow down results and avoid rate limiting
-            if self.country_code == "US":
-                # if in US, search by state
-                peering_db_response = await client.get(
-                    f"https://www.peeringdb.com/api/netfac?net__asn={self.asn}&fac__state={self.region}",
-                    headers={"Authorization": f"Api-Key {get_pdb_api_key()}"}
-                )
-            else:
-                # if outside US, search by city
-                peering_db_response = await client.get(
-                    f"https://www.peeringdb.com/api/netfac?net__asn={self.asn}&fac__country={self.country_code}&fac__city={self.city}",
-                    headers={"Authorization": f"Api-Key {get_pdb_api_key()}"}
-                )
-
-            self._netfac_candidates = peering_db_response.json().get('data')
+        Fills in location information from an ip-api response object
 
-    @staticmethod
-    async def _find_fac_by_id(fac_id):
+        Args:
+            geo_dict (dict): ip-api response for this instance's IP address
+        """
+        # IP-api requests will only fail when the IP address is private.
+        # mark these addresses and move on
+        if geo_dict.get("status") == "fail":
+            self.is_private = True
+            return
+
+        self.country = geo_dict.get("country")
+        self.country_code = geo_dict.get("countryCode")
+        self.region = geo_dict.get("region")
+        self.regionName = geo_dict.get("regionName")
+        self.city = geo_dict.get("city")
+        self.zip_code = geo_dict.get("zip")
+        self.latitude = geo_dict.get("lat")
+        self.longitude = geo_dict.get("lon")
+        self.isp = geo_dict.get("isp")
+
+        # extract digits of asn ID using regex. local providers may not know the ASN at all
+        self.asn = geo_dict.get("as") or None
+        if self.asn is None:
+            return
+        match = asn_reg.search(self.asn)
+        if match:
+            self.asn = match.group()
+        else:
+            logger.error(f"[_set_geolocation]: failed to match ASN in {self.asn}")
+            return
+
+    @timed("netfac")
+    async def _find_netfac_candidates(self):
         """
-        Uses PeeringDB to get fac object using netfac object fac_id
+        Uses PeeringDB to search for netfac objects using ASN and region
         """
-        async with httpx.AsyncClient() as client:
-            peering_db_response = await client.get(
-                f"https://www.peeringdb.com/api/fac?id={fac_id}",
+        # use the local mirror when we have one
+        if peeringdb_mirror:
+            self._netfac_candidates = peeringdb_mirror.find_netfacs(
+                self.asn, self.country_code, self.region, self.city
+            )
+            return
+
+        # check for country code to narrow down results and avoid rate limiting
+        if self.country_code == "US":
+            # if in US, search by state
+            peering_db_response = await upstream_request(
+                "peeringdb", "GET", f"/api/netfac?net__asn={self.asn}&fac__state={self.region}",
+                headers={"Authorization": f"Api-Key {get_pdb_api_key()}"}
+            )
+        else:
+            # if outside US, search by city
+            peering_db_response = await upstream_request(
+                "peeringdb", "GET",
+                f"/api/netfac?net__asn={self.asn}&fac__country={self.country_code}&fac__city={self.city}",
                 headers={"Authorization": f"Api-Key {get_pdb_api_key()}"}
             )
-            data = peering_db_response.json().get('data')
-            return data[0] if data else None
 
+        self._netfac_candidates = peering_db_response.json().get('data')
+
+    @timed("fac")
     async def _find_fac_candidates(self):
         if self._netfac_candidates != None:
             fac_ids = [netfac["fac_id"] for netfac in self._netfac_candidates]
 
-            self._fac_candidates = await asyncio.gather(
-                *[self._find_fac_by_id(fac_id) for fac_id in fac_ids]
-            )
+            # use the local mirror when we have one
+            if peeringdb_mirror:
+                self._fac_candidates = peeringdb_mirror.get_facs(fac_ids)
+                return
+
+            # ids requested by every hop in the same tick go out as one fac?id__in= query
+            self._fac_candidates = await facility_loader.load_many(fac_ids)
 
+    @timed("nearest_fac")
     def _compute_nearest_fac(self):
         """
         Uses haversine distance formula to find the nearest candidate facility
         to original IP location
         """
 
-        min_dist = float("inf")
         nearest_fac = None
 
-        # if no fac candidates, we can skip
-        if self._fac_candidates:
-            for fac in self._fac_candidates:
-                # if fac in list is none, skip it
-                if not fac or not fac['latitude'] or not fac['longitude']:
-                    continue
-                fac_pos = (fac['latitude'], fac['longitude'])
-                ip_pos = (self.latitude, self.longitude)
+        # if no fac candidates, we can skip. if fac in list is none or has no position, skip it
+        facs = [
+            fac for fac in (self._fac_candidates or [])
+            if fac and fac['latitude'] and fac['longitude']
+        ]
+
+        if facs:
+            fac_pos = np.radians([(fac['latitude'], fac['longitude']) for fac in facs])
+
+            # check distance between ip and every facility at once and take the min
+            distances = haversine_distances(
+                np.radians(self.latitude),
+                np.radians(self.longitude),
+                fac_pos[:, 0],
+                fac_pos[:, 1]
+            )
+            nearest_fac = facs[int(np.argmin(distances))]
 
-                # check distance between ip and facility and update min
-                distance = abs(haversine.haversine(fac_pos, ip_pos))
-                if distance < min_dist:
-                    nearest_fac = fac
+            # only keep what the frontend needs
+            nearest_fac = {field: nearest_fac.get(field) for field in FRONTEND_FAC_FIELDS}
 
         self.fac = nearest_fac
 
+        # the candidates aren't needed anymore, let them go
+        self._netfac_candidates = None
+        self._fac_candidates = None
+
     def set_source_cable_info(self, cable_id, entry_point):
         """
         Updates source cable info given a cable id and latitude/longitude pair
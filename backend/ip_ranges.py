@@ -0,0 +1,453 @@
+import os
+import sys
+import csv
+import itertools
+import mmap
+import struct
+import bisect
+import ipaddress
+from abc import ABC, abstractmethod
+from dotenv import load_dotenv
+from logging_config import get_logger
+
+logger = get_logger()
+default_database_path = "./ip-ranges.bin"
+
+# database layout:
+#   header (little endian): magic, number of IPv4 ranges, number of IPv6 ranges, number of
+#       records, number of strings
+#   IPv4 ranges: big endian 4 byte range starts, then range ends, then little endian uint32
+#       record numbers
+#   IPv6 ranges: same with 16 byte starts and ends
+#   records: RECORD (latitude, longitude, then the string number of every RECORD_FIELDS field)
+#   strings: little endian uint32 offsets (number of strings + 1), then the utf-8 text
+# range keys are big endian so comparing their bytes compares the addresses, which lets
+# bisect search them straight out of the mapping
+_DATABASE_MAGIC = b"IPRANGE1"
+_DATABASE_HEADER = struct.Struct("<8sQQQQ")
+
+# string fields of a record, named after the ip-api response fields they fill in
+RECORD_FIELDS = ("countryCode", "country", "region", "regionName", "city", "zip", "as", "isp")
+RECORD = struct.Struct(f"<dd{len(RECORD_FIELDS)}I")
+
+class GeolocationProvider(ABC):
+    """
+    Something that can geolocate IP addresses without going to ip-api. IPLocation asks
+    its providers first and only calls ip-api for addresses none of them know.
+    """
+
+    @abstractmethod
+    def lookup(self, ip):
+        """
+        Locates an IP address
+
+        Args:
+            ip (string): IPv4 or IPv6 address
+
+        Returns:
+            dict: location in ip-api's response format (status "fail" for addresses that
+                can't be located, e.g. private ones), or None if the provider doesn't know
+                the address
+        """
+
+class _Keys:
+    """
+    Read-only sequence view of fixed width keys in a buffer, for bisect
+    """
+
+    def __init__(self, buf, offset, width, count):
+        self.buf = buf
+        self.offset = offset
+        self.width = width
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        start = self.offset + i * self.width
+        return self.buf[start:start + self.width]
+
+class IPRangeDatabase(GeolocationProvider):
+    """
+    Local IP range -> location table in a memory-mapped file (see write_ip_range_database).
+    A lookup is a binary search over the sorted ranges, with nothing loaded into memory
+    up front, so every worker process shares the same pages.
+    """
+
+    def __init__(self, path=default_database_path):
+        self.path = path
+        with open(path, "rb") as f:
+            # the mapping stays open after the file is closed
+            self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, n_v4, n_v6, n_records, n_strings = _DATABASE_HEADER.unpack_from(self._buf, 0)
+        if magic != _DATABASE_MAGIC:
+            raise ValueError(f"{path} is not an IP range database")
+
+        pos = _DATABASE_HEADER.size
+        self._tables = {}
+        for version, width, count in ((4, 4, n_v4), (6, 16, n_v6)):
+            starts = _Keys(self._buf, pos, width, count)
+            ends = _Keys(self._buf, pos + width * count, width, count)
+            records = pos + 2 * width * count
+            self._tables[version] = (starts, ends, records)
+            pos = records + 4 * count
+
+        self._records = pos
+        self._string_offsets = self._records + RECORD.size * n_records
+        self._strings = self._string_offsets + 4 * (n_strings + 1)
+
+    def lookup(self, ip):
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return {"status": "fail", "message": "invalid query", "query": ip}
+
+        # ip-api doesn't locate private addresses either, so answer for them here. checked
+        # before the table, older databases may still have rows for private space
+        if address.is_private or address.is_reserved or address.is_loopback or address.is_link_local:
+            return {"status": "fail", "message": "private range", "query": ip}
+
+        key = address.packed
+        starts, ends, records = self._tables[address.version]
+        i = bisect.bisect_right(starts, key) - 1
+        if i < 0 or ends[i] < key:
+            return None
+
+        record, = struct.unpack_from("<I", self._buf, records + 4 * i)
+        lat, lon, *strings = RECORD.unpack_from(self._buf, self._records + RECORD.size * record)
+
+        return {
+            "status": "success",
+            "query": ip,
+            "lat": lat,
+            "lon": lon,
+            **{field: self._string(n) for field, n in zip(RECORD_FIELDS, strings)},
+        }
+
+    def _string(self, n):
+        start, end = struct.unpack_from("<II", self._buf, self._string_offsets + 4 * n)
+        return self._buf[self._strings + start:self._strings + end].decode("utf-8")
+
+    def close(self):
+        self._buf.close()
+
+# CSV column names we recognize for each field, lowercase. covers our own column names,
+# DB-IP and IP2Location style dumps
+CSV_COLUMNS = {
+    "start": ("start", "start_ip", "ip_start", "ip_from", "range_start", "first_ip"),
+    "end": ("end", "end_ip", "ip_end", "ip_to", "range_end", "last_ip"),
+    "lat": ("lat", "latitude"),
+    "lon": ("lon", "lng", "longitude"),
+    "countryCode": ("countrycode", "country_code", "country_iso_code", "country"),
+    "country": ("country_name",),
+    "region": ("region", "region_code", "state_code", "subdivision_1_iso_code"),
+    "regionName": ("regionname", "region_name", "stateprov", "state", "subdivision_1_name"),
+    "city": ("city", "city_name"),
+    "zip": ("zip", "zip_code", "postcode", "postal_code"),
+    "as": ("as", "asn", "as_number", "autonomous_system_number"),
+    "isp": ("isp", "as_name", "as_organisation", "organization", "autonomous_system_organization"),
+}
+
+# column order of the dumps that come without a header row. IP2Location LITE (DB5, and
+# DB9/DB11 with the extra zip code and time zone columns) writes the range boundaries as
+# integers, DB-IP lite city writes them as addresses
+IP2LOCATION_COLUMNS = (
+    "ip_from", "ip_to", "country_code", "country_name", "region_name", "city_name",
+    "latitude", "longitude", "zip_code", "time_zone",
+)
+DBIP_COLUMNS = ("start_ip", "end_ip", "continent", "country", "stateprov", "city", "latitude", "longitude")
+
+# the lite city dumps have no ASN, which PeeringDB facilities are matched by. it comes
+# from a separate ASN dump (IP2Location LITE ASN or DB-IP lite ASN), merged in at import
+IP2LOCATION_ASN_COLUMNS = ("ip_from", "ip_to", "cidr", "asn", "as_name")
+DBIP_ASN_COLUMNS = ("start_ip", "end_ip", "asn", "as_name")
+
+def _parse_address(value):
+    """
+    Parses a range boundary, which dumps write either as an address or as an integer
+    """
+    value = value.strip()
+    if value.isdigit():
+        number = int(value)
+        return ipaddress.IPv4Address(number) if number < 2**32 else ipaddress.IPv6Address(number)
+    return ipaddress.ip_address(value)
+
+def _read_csv(f, csv_path, layouts, required):
+    """
+    Works out the columns of a CSV dump, from its header row or else from the headerless
+    layouts (integer ranges, address ranges)
+
+    Returns:
+        (dict, iterator): field -> column number, and the data rows
+    """
+    reader = csv.reader(f)
+    first_row = next(reader)
+    try:
+        # a header row doesn't start with an address
+        _parse_address(first_row[0])
+    except (ValueError, IndexError):
+        header = [name.strip().lower() for name in first_row]
+        rows = reader
+    else:
+        layout = layouts[0] if first_row[0].strip().isdigit() else layouts[1]
+        header = list(layout[:len(first_row)])
+        rows = itertools.chain([first_row], reader)
+
+    columns = {}
+    for field, names in CSV_COLUMNS.items():
+        for name in names:
+            if name in header and header.index(name) not in columns.values():
+                columns[field] = header.index(name)
+                break
+
+    missing = set(required) - columns.keys()
+    if missing:
+        raise ValueError(f"{csv_path} has no column for {', '.join(sorted(missing))}")
+
+    return columns, rows
+
+def read_csv_ranges(csv_path):
+    """
+    Reads IP ranges from a CSV dump. Dumps with a header row can have their columns in any
+    order (see CSV_COLUMNS for the names we understand), start, end, lat and lon are
+    required. Headerless dumps are read as IP2Location LITE or DB-IP lite city files
+
+    Args:
+        csv_path (string): path of the CSV dump
+
+    Returns:
+        list: (start address, end address, record) tuples, where record is a tuple of
+            (lat, lon, *RECORD_FIELDS values)
+    """
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        columns, rows = _read_csv(f, csv_path, (IP2LOCATION_COLUMNS, DBIP_COLUMNS), ("start", "end", "lat", "lon"))
+
+        ranges = []
+        unlocated = 0
+        for row in rows:
+            if not row:
+                continue
+            try:
+                start = _parse_address(row[columns["start"]])
+                end = _parse_address(row[columns["end"]])
+                lat = float(row[columns["lat"]])
+                lon = float(row[columns["lon"]])
+            except (ValueError, IndexError) as e:
+                logger.warning(f"[read_csv_ranges]: skipping row {row}: {e}")
+                continue
+
+            if start.version != end.version or start > end:
+                logger.warning(f"[read_csv_ranges]: skipping bad range {start} - {end}")
+                continue
+
+            strings = tuple(row[columns[field]].strip() if field in columns else "" for field in RECORD_FIELDS)
+
+            # dumps cover private and reserved space too, with "-" for the country and
+            # 0, 0 for the position. leaving them out keeps them from being plotted there
+            country_code = strings[RECORD_FIELDS.index("countryCode")]
+            if ("countryCode" in columns and country_code in ("", "-")) or (lat == 0 and lon == 0):
+                unlocated += 1
+                continue
+
+            ranges.append((start, end, (lat, lon, *strings)))
+
+    if unlocated:
+        logger.info(f"[read_csv_ranges]: skipped {unlocated} ranges without a location (private or reserved space)")
+
+    return ranges
+
+def read_csv_asn_ranges(csv_path):
+    """
+    Reads IP range -> ASN from a CSV dump. Dumps with a header row need start, end and
+    ASN columns (see CSV_COLUMNS), headerless dumps are read as IP2Location LITE ASN or
+    DB-IP lite ASN files
+
+    Args:
+        csv_path (string): path of the CSV dump
+
+    Returns:
+        list: (start address, end address, "as", "isp") tuples, with "as" in ip-api's
+            format, e.g. "AS15169 Google LLC"
+    """
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        columns, rows = _read_csv(f, csv_path, (IP2LOCATION_ASN_COLUMNS, DBIP_ASN_COLUMNS), ("start", "end", "as"))
+
+        ranges = []
+        for row in rows:
+            if not row:
+                continue
+            try:
+                start = _parse_address(row[columns["start"]])
+                end = _parse_address(row[columns["end"]])
+                asn = row[columns["as"]].strip().upper().removeprefix("AS")
+                name = row[columns["isp"]].strip() if "isp" in columns else ""
+            except (ValueError, IndexError) as e:
+                logger.warning(f"[read_csv_asn_ranges]: skipping row {row}: {e}")
+                continue
+
+            # unallocated space is written with "-" or 0
+            if not asn.isdigit() or asn == "0" or start.version != end.version or start > end:
+                continue
+
+            ranges.append((start, end, f"AS{asn} {name}".strip(), name))
+
+    return ranges
+
+def add_asn_ranges(ranges, asn_ranges):
+    """
+    Fills in the ASN of location ranges that don't have one. Ranges that span more than
+    one ASN range are split at the ASN range boundaries
+
+    Args:
+        ranges (list): read_csv_ranges output
+        asn_ranges (list): read_csv_asn_ranges output
+
+    Returns:
+        list: ranges in the same format, sorted
+    """
+    as_index = 2 + RECORD_FIELDS.index("as")
+    isp_index = 2 + RECORD_FIELDS.index("isp")
+    address_class = {4: ipaddress.IPv4Address, 6: ipaddress.IPv6Address}
+
+    def key(r):
+        return (r[0].version, r[0])
+
+    asn_ranges = sorted(asn_ranges, key=key)
+    merged = []
+    j = 0
+    for start, end, record in sorted(ranges, key=key):
+        if record[as_index]:
+            merged.append((start, end, record))
+            continue
+
+        # skip the ASN ranges that end before this range (or are of the other version)
+        while j < len(asn_ranges) and (asn_ranges[j][0].version, asn_ranges[j][1]) < (start.version, start):
+            j += 1
+
+        # walk the ASN ranges that overlap this one, with integer addresses so the pieces
+        # can be cut at boundary + 1
+        version = start.version
+        current, last = int(start), int(end)
+        k = j
+        while current <= last and k < len(asn_ranges) and asn_ranges[k][0].version == version and int(asn_ranges[k][0]) <= last:
+            asn_start, asn_end, as_name, isp = asn_ranges[k]
+            asn_start, asn_end = int(asn_start), int(asn_end)
+            if asn_end < current:
+                k += 1
+                continue
+            if asn_start > current:
+                merged.append((address_class[version](current), address_class[version](asn_start - 1), record))
+                current = asn_start
+
+            piece_end = min(last, asn_end)
+            filled = list(record)
+            filled[as_index] = as_name
+            filled[isp_index] = record[isp_index] or isp
+            merged.append((address_class[version](current), address_class[version](piece_end), tuple(filled)))
+            current = piece_end + 1
+            if asn_end > last:
+                # the ASN range carries on into the next location range
+                break
+            k += 1
+
+        if current <= last:
+            merged.append((address_class[version](current), end, record))
+        j = k
+
+    return merged
+
+def write_ip_range_database(ranges, path=default_database_path):
+    """
+    Writes an IP range database
+
+    Args:
+        ranges (list): read_csv_ranges output
+        path (string): path to write the database to
+
+    Returns:
+        (int, int): number of IPv4 ranges and IPv6 ranges written
+    """
+    strings = {"": 0}
+    records = {}
+
+    def string_number(value):
+        return strings.setdefault(value, len(strings))
+
+    tables = {4: [], 6: []}
+    for start, end, record in sorted(ranges, key=lambda r: (r[0].version, r[0])):
+        # lots of ranges share a location, store each distinct one once
+        lat, lon, *values = record
+        packed = RECORD.pack(lat, lon, *[string_number(value) for value in values])
+        number = records.setdefault(packed, len(records))
+
+        table = tables[start.version]
+        if table and table[-1][1] >= start:
+            logger.warning(f"[write_ip_range_database]: {start} - {end} overlaps the previous range, skipping it")
+            continue
+        table.append((start, end, number))
+
+    text = [value.encode("utf-8") for value in strings]
+    offsets = [0]
+    for value in text:
+        offsets.append(offsets[-1] + len(value))
+
+    # write to a temp file and swap it in so running workers never map a half-written file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_DATABASE_HEADER.pack(_DATABASE_MAGIC, len(tables[4]), len(tables[6]), len(records), len(strings)))
+        for version in (4, 6):
+            table = tables[version]
+            f.write(b"".join(start.packed for start, _, _ in table))
+            f.write(b"".join(end.packed for _, end, _ in table))
+            f.write(struct.pack(f"<{len(table)}I", *[number for _, _, number in table]))
+        f.write(b"".join(records))
+        f.write(struct.pack(f"<{len(offsets)}I", *offsets))
+        f.write(b"".join(text))
+    os.replace(tmp_path, path)
+
+    return len(tables[4]), len(tables[6])
+
+def get_database_path():
+    """
+    Gets the database path from GEO_IP_DATABASE in .env, or the default path
+    """
+    load_dotenv()
+    return os.environ.get("GEO_IP_DATABASE", default_database_path)
+
+def open_geolocation_providers():
+    """
+    Opens the local geolocation providers that are set up
+
+    Returns:
+        list: GeolocationProvider instances to ask before ip-api, in order
+    """
+    providers = []
+
+    path = get_database_path()
+    if os.path.exists(path):
+        providers.append(IPRangeDatabase(path))
+
+    return providers
+
+if __name__ == "__main__":
+    # usage: python ip_ranges.py import <csv dump> [<asn csv dump>]
+    if len(sys.argv) not in (3, 4) or sys.argv[1] != "import":
+        print("usage: python ip_ranges.py import <csv dump> [<asn csv dump>]")
+        sys.exit(1)
+
+    ranges = read_csv_ranges(sys.argv[2])
+    if len(sys.argv) == 4:
+        ranges = add_asn_ranges(ranges, read_csv_asn_ranges(sys.argv[3]))
+
+    as_index = 2 + RECORD_FIELDS.index("as")
+    if not any(record[as_index] for _, _, record in ranges):
+        logger.warning(
+            f"[ip_ranges]: {sys.argv[2]} has no ASNs. facilities are matched by ASN, so hops "
+            f"located from this database won't get one. pass an ASN dump too to fill them in"
+        )
+
+    path = get_database_path()
+    n_v4, n_v6 = write_ip_range_database(ranges, path)
+    print(f"Successfully created {path} with {n_v4} IPv4 ranges and {n_v6} IPv6 ranges")
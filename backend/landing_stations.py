@@ -0,0 +1,137 @@
+import math
+import numpy as np
+from geo_math import EARTH_RADIUS_KM, haversine_distances, unit_vectors, unit_vector_to_lat_lon
+from spatial_index import EndpointGrid, PointKDTree
+
+class LandingStations:
+    """
+    Landing station adjacency graph derived from the cable endpoints.
+
+    Endpoints closer together than station_km are clustered into one landing station,
+    and every pair of stations is mapped to the cables that land at both. Looking up a
+    pair of hops is then a nearest-station search per hop (k-d tree) and a dict lookup,
+    instead of a distance computation against every candidate endpoint.
+    """
+
+    def __init__(self, cable_ids, offsets, lat_deg, lon_deg, station_km=5):
+        """
+        Inputs:
+            cable_ids (list): cable ids, in cable position order
+            offsets (np.ndarray): endpoints of cable i live at [offsets[i], offsets[i + 1])
+            lat_deg (np.ndarray): latitude of every endpoint in degrees
+            lon_deg (np.ndarray): longitude of every endpoint in degrees
+            station_km (float): endpoints closer together than this are the same station
+        """
+        self.cable_ids = cable_ids
+        self.station_km = station_km
+
+        station_of = self._cluster(lat_deg, lon_deg, station_km)
+        n_stations = int(station_of.max()) + 1 if len(station_of) else 0
+
+        # each station sits at the center of its endpoints
+        vectors = unit_vectors(np.radians(lat_deg), np.radians(lon_deg))
+        centers = np.zeros((n_stations, 3))
+        np.add.at(centers, station_of, vectors)
+        centers /= np.linalg.norm(centers, axis=1)[:, np.newaxis]
+        self.stations = [unit_vector_to_lat_lon(center) for center in centers]
+        self._tree = PointKDTree(centers)
+
+        # (station, station) -> cable positions landing at both, and
+        # (cable position, station) -> the cable's endpoint at that station
+        self.cables_between = {}
+        self._landing = {}
+        for cable in range(len(cable_ids)):
+            landings = {}
+            for i in range(offsets[cable], offsets[cable + 1]):
+                landings.setdefault(int(station_of[i]), {"lat": float(lat_deg[i]), "lon": float(lon_deg[i])})
+
+            for station, endpoint in landings.items():
+                self._landing[(cable, station)] = endpoint
+
+            stations = sorted(landings)
+            for i, station_A in enumerate(stations):
+                for station_B in stations[i + 1:]:
+                    self.cables_between.setdefault((station_A, station_B), []).append(cable)
+
+        # duplicate cables between the same stations are ordered by id, so the pick doesn't
+        # depend on the order of the cable file
+        for cables in self.cables_between.values():
+            cables.sort(key=lambda cable: cable_ids[cable])
+
+    @staticmethod
+    def _cluster(lat_deg, lon_deg, station_km):
+        """
+        Groups endpoints that are within station_km of each other (or linked by a chain of
+        such endpoints) into stations
+
+        Outputs:
+            np.ndarray: station number of every endpoint, numbered in order of first endpoint
+        """
+        n = len(lat_deg)
+        parent = list(range(n))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        grid = EndpointGrid(zip(lat_deg.tolist(), lon_deg.tolist(), range(n)), cell_km=max(station_km, 1))
+        lat, lon = np.radians(lat_deg), np.radians(lon_deg)
+        for i in range(n):
+            near = np.array(sorted(grid.query(lat_deg[i], lon_deg[i], station_km)), dtype=np.int64)
+            near = near[near > i]
+            near = near[haversine_distances(lat[i], lon[i], lat[near], lon[near]) <= station_km]
+            for j in near.tolist():
+                parent[find(j)] = find(i)
+
+        # number stations by their first endpoint so the numbering is stable
+        roots = [find(i) for i in range(n)]
+        numbers = {}
+        return np.array([numbers.setdefault(root, len(numbers)) for root in roots], dtype=np.int64)
+
+    def snap(self, lat, lon):
+        """
+        Finds the landing station nearest to a location
+
+        Outputs:
+            (int, float): station number (-1 if there are none) and the great-circle distance
+                to it in km
+        """
+        lat, lon = math.radians(lat), math.radians(lon)
+        point = (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat))
+
+        station, chord = self._tree.nearest(point)
+        return station, 2 * EARTH_RADIUS_KM * math.asin(min(chord / 2, 1.0))
+
+    def find_cable(self, snapped_A, snapped_B, tol):
+        """
+        Finds the cable connecting the stations two locations snapped to
+
+        inputs:
+            snapped_A (tuple): snap result for location A
+            snapped_B (tuple): snap result for location B
+            tol (float): largest acceptable average distance from the stations
+
+        outputs:
+            None if the locations snapped to the same station, are too far from their
+            stations, or no cable connects their stations; otherwise a dict with the cable
+            id and the cable's endpoints at the two stations (same as find_nearest_cable)
+        """
+        station_A, distance_A = snapped_A
+        station_B, distance_B = snapped_B
+
+        # both hops are at the same landing station (e.g. the same metro), no cable between them
+        if station_A == station_B or (distance_A + distance_B) / 2 > tol:
+            return None
+
+        cables = self.cables_between.get((min(station_A, station_B), max(station_A, station_B)))
+        if not cables:
+            return None
+
+        cable = cables[0]
+        return {
+            "id": self.cable_ids[cable],
+            "endpoint_A": self._landing[(cable, station_A)],
+            "endpoint_B": self._landing[(cable, station_B)]
+        }
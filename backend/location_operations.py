@@ -1,9 +1,17 @@
-from haversine import haversine
-from undersea_cables import CableMapper
+import os
+from dotenv import load_dotenv
+from geo_math import distance_km
+from undersea_cables import CableMapper, MATCH_ENDPOINTS
 from logging_config import get_logger
+from metrics import timed
 
 logger = get_logger()
-cableMapper = CableMapper()
+load_dotenv()
+
+# CABLE_MATCH_MODE=geometry matches hops against the full cable paths instead of only
+# their endpoints, CABLE_MATCH_MODE=stations snaps hops to landing stations and looks up
+# the cables between them (see CableMapper)
+cableMapper = CableMapper(mode=os.environ.get("CABLE_MATCH_MODE", MATCH_ENDPOINTS))
 
 def _distance(lat_A, lon_A, lat_B, lon_B):
     """
@@ -15,10 +23,7 @@ def _distance(lat_A, lon_A, lat_B, lon_B):
     :param lat_B: Latitude of location B
     :param lon_B: Longitude of location B
     """
-    pos_A = (lat_A, lon_A)
-    pos_B = (lat_B, lon_B)
-    dist = abs(haversine(pos_A, pos_B))
-    return dist
+    return distance_km(lat_A, lon_A, lat_B, lon_B)
 
 def populate_neighbor_information(loc_A, loc_B):
     """
@@ -39,7 +44,6 @@ def populate_neighbor_information(loc_A, loc_B):
 
     # location A is the source of the cable connection and location B is the destination
     if cable_info:
-        logger.info(f"{cable_info=}") #TODO: Remove
         loc_A.set_source_cable_info(cable_info["id"], cable_info["endpoint_A"])
         loc_B.set_destination_cable_info(cable_info["id"], cable_info["endpoint_B"])
 
@@ -55,6 +59,39 @@ def populate_neighbor_information(loc_A, loc_B):
     loc_A.set_distance_from(dist)
     loc_B.set_distance_to(dist)
 
+@timed("populate_route")
+def populate_route_information(locations):
+    """
+    populate_neighbor_information for every adjacent pair of locations along a route.
+    Runs the cable search for the whole route at once instead of once per pair
+
+    :param locations: list of Location objects, in route order
+    """
+    # find info about nearest cable for every pair in one pass
+    cable_infos = cableMapper.find_nearest_cables_for_route(
+        [(loc.latitude, loc.longitude) for loc in locations],
+        tol=30
+    )
+
+    for loc_A, loc_B, cable_info in zip(locations, locations[1:], cable_infos):
+        # location A is the source of the cable connection and location B is the destination
+        if cable_info:
+            loc_A.set_source_cable_info(cable_info["id"], cable_info["endpoint_A"])
+            loc_B.set_destination_cable_info(cable_info["id"], cable_info["endpoint_B"])
+
+        # compute haversine distance between locations A and B
+        dist = _distance(
+            loc_A.latitude,
+            loc_A.longitude,
+            loc_B.latitude,
+            loc_B.longitude
+        )
+
+        # the computed distance is the distance leaving location A and coming to location B
+        loc_A.set_distance_from(dist)
+        loc_B.set_distance_to(dist)
+
+@timed("merge_locations")
 def merge_frontend_locations(frontend_locations):
     """
     Merges duplicate locations in frontend format
@@ -1,12 +1,23 @@
 import asyncio
+import orjson
+from contextlib import asynccontextmanager
 from typing import Union
 import re
-from fastapi import Body, FastAPI, HTTPException, status
+from fastapi import Body, FastAPI, HTTPException, Request, Response, status
+from fastapi.responses import ORJSONResponse, PlainTextResponse, StreamingResponse
 import logging_config
-from traceroute import get_route
-from ip_location import IPLocation
+import http_clients
+from traceroute import get_route, stream_route, get_traceroute_stats, TracerouteBusyError, TracerouteFailedError
+from ip_location import IPLocation, geolocation_cache, facility_loader
 from fastapi.middleware.cors import CORSMiddleware
-from location_operations import merge_frontend_locations, populate_neighbor_information
+from location_operations import merge_frontend_locations, populate_route_information
+from route_pipeline import RoutePipeline
+from route_cache import create_route_cache
+from batch_trace import BatchTrace, BATCH_MAX_HOSTS
+from route_monitor import RouteMonitor, RouteMonitorFullError
+from rate_limits import get_limiter_stats
+from metrics import METRICS_ENABLED, register_collector, render_metrics
+from cable_geometry import CableGeometryStore, ZOOM_LEVELS
 
 # Create a logger instance
 logging_config.setup_logging()
@@ -14,8 +25,39 @@ logger = logging_config.get_logger()
 
 logger.debug("Logger active!")
 
+# recent traceroute results, shared by every request to this worker
+route_cache = create_route_cache()
+
+async def _monitor_trace(host, hops):
+    # monitoring traces are always fresh, so they also refresh the route cache
+    route = await get_route(host, hops)
+    route_cache.put(route_cache.key("route", host, hops), route)
+    return route
+
+# destinations being re-traced to catch route changes
+route_monitor = RouteMonitor(trace=_monitor_trace)
+
+# simplified, precompressed cable geometry for the map
+cable_geometry = CableGeometryStore()
+
+# versioned geometry urls never change, everything else is revalidated with its ETag daily
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+GEOMETRY_CACHE_CONTROL = "public, max-age=86400"
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Opens the shared upstream http clients on startup and closes them (and the
+    geolocation cache) on shutdown
+    """
+    http_clients.open_clients()
+    yield
+    await http_clients.close_clients()
+    await geolocation_cache.flush()
+    geolocation_cache.close()
+
 # initialize app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -25,10 +67,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-@app.post("/api/traceroute")
-def traceroute(host: str, hops: int):
+def _validate_host(host):
     """
-    Perform a traceroute and return the list of visited IP addresses
+    Raises an HTTPException if host isn't a valid web address
     """
 
     # if host is not a web address does not start with alphas and end with .[a-zA-Z]{2,}, the address
@@ -41,7 +82,375 @@ def traceroute(host: str, hops: int):
             detail="invalid web address"
         )
 
-    return get_route(host, hops)
+def _sse(event, data):
+    """
+    Formats a server-sent event
+    """
+    return f"event: {event}\ndata: {orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY).decode()}\n\n"
+
+@app.post("/api/traceroute")
+async def traceroute(host: str, hops: int):
+    """
+    Perform a traceroute and return the list of visited IP addresses
+    """
+    _validate_host(host)
+
+    try:
+        # popular hosts are served from the cache, and concurrent requests share one probe
+        route = await route_cache.get(
+            route_cache.key("route", host, hops),
+            lambda: get_route(host, hops)
+        )
+    except TracerouteBusyError:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="too many traceroutes in progress, try again shortly"
+        )
+    except TracerouteFailedError:
+        raise HTTPException(
+            status_code=status.HTTP_502_BAD_GATEWAY,
+            detail="traceroute failed"
+        )
+
+    # serialize straight to json with orjson, skipping FastAPI's jsonable_encoder copy
+    return ORJSONResponse(route)
+
+@app.get("/api/traceroute/stream")
+async def traceroute_stream(host: str, hops: int, enrich: bool = False):
+    """
+    Perform a traceroute and stream each hop to the client (server-sent events) as soon
+    as it's discovered. With enrich=true, each hop is also geolocated and matched to a
+    facility while the traceroute keeps running.
+
+    events:
+        hop: {"hop", "ip", "rtt"} as soon as the hop is printed by the traceroute
+        location: {"hop", "location"} once a hop's location (frontend format) is ready
+        error: {"detail"} if the traceroute couldn't run
+        done: {} once the traceroute and all enrichment are finished
+    """
+    _validate_host(host)
+
+    async def enrich_hop(hop, events):
+        try:
+            location = await IPLocation.create(hop["ip"])
+            if not location.is_private:
+                await location.find_facility()
+                await events.put(_sse("location", {"hop": hop["hop"], "location": location.get_frontend_format()}))
+        except Exception as e:
+            logger.error(f"[traceroute_stream]: failed to enrich hop {hop}: {e}")
+
+    async def run_trace(events, enrichments):
+        try:
+            async for hop in stream_route(host, hops):
+                await events.put(_sse("hop", hop))
+
+                # start enrichment right away instead of after the traceroute finishes
+                if enrich and hop["ip"]:
+                    enrichments.append(asyncio.create_task(enrich_hop(hop, events)))
+        except TracerouteBusyError:
+            await events.put(_sse("error", {"detail": "too many traceroutes in progress, try again shortly"}))
+        except TracerouteFailedError:
+            await events.put(_sse("error", {"detail": "traceroute failed"}))
+
+        await asyncio.gather(*enrichments, return_exceptions=True)
+        await events.put(None)
+
+    async def event_stream():
+        events = asyncio.Queue()
+        enrichments = []
+        runner = asyncio.create_task(run_trace(events, enrichments))
+        try:
+            while (event := await events.get()) is not None:
+                yield event
+            yield _sse("done", {})
+        finally:
+            # the client may have disconnected, stop the traceroute and any lookups
+            for task in [runner, *enrichments]:
+                task.cancel()
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+@app.get("/api/traceAndLocate")
+async def trace_and_locate(host: str, hops: int):
+    """
+    Perform a traceroute and locate every hop in a single request. Hops are enriched as
+    soon as they're discovered and results are streamed (server-sent events) as each
+    stage finishes, see RoutePipeline.run for the events.
+
+    Recently traced routes come from the route cache instead: only the final route
+    event is sent (with "cached": true), and a stale route is refreshed in the background.
+    """
+    _validate_host(host)
+
+    async def event_stream():
+        live_events = asyncio.Queue()
+
+        async def compute(events=None):
+            pipeline = RoutePipeline(host, hops)
+            async for event in pipeline.run():
+                # a background refresh has nobody to stream to
+                if events is not None:
+                    await events.put(event)
+            return {"route": pipeline.route, "locations": pipeline.merged_locations}
+
+        # answers from the cache, joins a trace of the same host that's already running,
+        # or runs the pipeline (which streams its events into live_events). a stale route
+        # is refreshed without events, this response is done before the refresh is
+        lookup = asyncio.create_task(route_cache.get(
+            route_cache.key("locations", host, hops),
+            lambda: compute(live_events),
+            refresh=compute,
+        ))
+        streamed_route = False
+
+        try:
+            while True:
+                next_event = asyncio.ensure_future(live_events.get())
+                await asyncio.wait({next_event, lookup}, return_when=asyncio.FIRST_COMPLETED)
+                if not next_event.done():
+                    next_event.cancel()
+                    break
+
+                event, data = next_event.result()
+                streamed_route |= event == "route"
+                yield _sse(event, data)
+
+            # the pipeline may have queued its last events right before finishing
+            while not live_events.empty():
+                event, data = live_events.get_nowait()
+                streamed_route |= event == "route"
+                yield _sse(event, data)
+
+            result = lookup.result()
+            if not streamed_route:
+                yield _sse("route", {"locations": result["locations"], "cached": True})
+        except TracerouteBusyError:
+            yield _sse("error", {"detail": "too many traceroutes in progress, try again shortly"})
+        except TracerouteFailedError:
+            yield _sse("error", {"detail": "traceroute failed"})
+        finally:
+            lookup.cancel()
+
+        yield _sse("done", {})
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+@app.post("/api/traceroute/batch")
+async def traceroute_batch(hops: int, hosts: list[str] = Body(...)):
+    """
+    Perform traceroutes to a list of hosts and locate their hops as one sweep. Every
+    router IP shared between routes is only located once, and each host's result is
+    streamed (server-sent events) as soon as it's ready, see BatchTrace.run for the events.
+    Routes come from the route cache when they were traced recently.
+
+    events:
+        route / error: one per host, in the order the hosts finish
+        done: {"hosts", "failed", "hops", "unique_ips"} once every host is finished
+    """
+    if not hosts or len(hosts) > BATCH_MAX_HOSTS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"expected between 1 and {BATCH_MAX_HOSTS} hosts"
+        )
+    for host in hosts:
+        _validate_host(host)
+
+    async def trace(host, hops):
+        return await route_cache.get(
+            route_cache.key("route", host, hops),
+            lambda: get_route(host, hops)
+        )
+
+    async def event_stream():
+        batch = BatchTrace(hosts, hops, trace=trace)
+        async for event, data in batch.run():
+            yield _sse(event, data)
+        yield _sse("done", batch.stats)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+@app.get("/api/monitor")
+async def monitor(host: str, hops: int, interval: float = 300):
+    """
+    Re-trace a host every interval seconds (at least MONITOR_MIN_INTERVAL) for as long as
+    the client stays connected, and stream (server-sent events) every route change. Only
+    hops that weren't on the last route are located again, see RouteMonitor.
+
+    events:
+        watching: {"host", "hops", "interval"} once the host is being monitored
+        route: {"host", "hops", "time", "ip_addresses", "locations"} the current route,
+            as soon as it's known
+        change: same as route, plus {"changes": [{"hop", "from", "to"}, ...]}
+        unchanged: {"host", "hops", "time"} after every trace that found the same route
+        error: {"host", "detail"} if a trace failed. it's retried next interval
+    """
+    _validate_host(host)
+
+    # claim the destination before the response starts, so a full monitor is a 503
+    try:
+        events = route_monitor.watch(host, hops, interval)
+        first_event = await events.__anext__()
+    except RouteMonitorFullError:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="too many monitored destinations, try again later"
+        )
+
+    async def event_stream():
+        try:
+            yield _sse(*first_event)
+            async for event, data in events:
+                yield _sse(event, data)
+        finally:
+            # the client disconnected, stop watching
+            await events.aclose()
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+@app.get("/api/monitor/history")
+def monitor_history(host: str, hops: int):
+    """
+    Returns the route changes recorded for a monitored host, see RouteMonitor.history
+    """
+    history = route_monitor.history(host, hops)
+    if history is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="host isn't monitored"
+        )
+    return ORJSONResponse(history)
+
+@app.get("/api/traceroute/stats")
+def traceroute_stats():
+    """
+    Returns traceroute queue depth and wait/run time metrics, plus the state of the
+    route cache, the route monitor and the upstream rate limiters
+    """
+    return {
+        **get_traceroute_stats(),
+        "route_cache": route_cache.stats(),
+        "route_monitor": route_monitor.stats(),
+        "upstreams": get_limiter_stats(),
+    }
+
+def _collect_stats():
+    """
+    Reports the counters the caches, the traceroute queue and the rate limiters keep
+    anyway, for /metrics
+    """
+    geo, route, fac = geolocation_cache.stats(), route_cache.stats(), facility_loader.counters
+
+    # (hits, misses) of each cache. a route or fac joining a lookup already in flight counts as a hit
+    caches = {
+        "geolocation": (geo["memory_hits"] + geo["disk_hits"], geo["misses"]),
+        "route": (route["hits"] + route["stale_hits"] + route["shared"], route["misses"]),
+        "facility": (fac["hits"] + fac["shared"], fac["misses"]),
+    }
+    trace_stats = get_traceroute_stats()
+    limiters = get_limiter_stats()
+    monitor = route_monitor.stats()
+
+    return [
+        ("cache_hits_total", "counter", "Cache lookups answered from the cache",
+            [({"cache": cache}, hits) for cache, (hits, _) in caches.items()]),
+        ("cache_misses_total", "counter", "Cache lookups that had to go upstream",
+            [({"cache": cache}, misses) for cache, (_, misses) in caches.items()]),
+        ("cache_hit_ratio", "gauge", "Share of cache lookups answered from the cache",
+            [({"cache": cache}, hits / (hits + misses) if hits + misses else 0.0) for cache, (hits, misses) in caches.items()]),
+        ("traceroutes_total", "counter", "Finished or rejected traceroutes by outcome",
+            [({"outcome": outcome}, trace_stats[outcome]) for outcome in ("completed", "failed", "timed_out", "rejected")]),
+        ("traceroutes_running", "gauge", "Traceroutes holding a slot", [({}, trace_stats["running"])]),
+        ("traceroutes_queued", "gauge", "Traceroutes waiting for a slot", [({}, trace_stats["queued"])]),
+        ("route_monitor_checks_total", "counter", "Monitoring traces by result",
+            [({"result": "changed"}, monitor["changes"]), ({"result": "unchanged"}, monitor["checks"] - monitor["changes"]),
+             ({"result": "failed"}, monitor["failed"])]),
+        ("route_monitor_hops_total", "counter", "Hops of monitoring traces, reused from the last route or located anew",
+            [({"outcome": "reused"}, monitor["hops_reused"]), ({"outcome": "located"}, monitor["hops_located"])]),
+        ("route_monitor_destinations", "gauge", "Destinations being watched", [({}, monitor["watched"])]),
+        ("upstream_concurrency_limit", "gauge", "Current AIMD in flight limit of each upstream limiter",
+            [({"upstream": name}, stats["concurrency_limit"]) for name, stats in limiters.items()]),
+        ("upstream_rate_limit", "gauge", "Current request rate of each upstream limiter's token bucket, per second",
+            [({"upstream": name}, stats["rate"]) for name, stats in limiters.items()]),
+        ("upstream_queued_requests", "gauge", "Requests waiting for an upstream limiter",
+            [({"upstream": name}, stats["queued"]) for name, stats in limiters.items()]),
+        ("upstream_throttled_total", "counter", "Throttled upstream responses (429/503)",
+            [({"upstream": name}, stats["throttled"]) for name, stats in limiters.items()]),
+        ("upstream_retries_total", "counter", "Retried upstream requests",
+            [({"upstream": name}, stats["retries"]) for name, stats in limiters.items()]),
+    ]
+
+if METRICS_ENABLED:
+    register_collector(_collect_stats)
+
+@app.get("/metrics")
+def metrics():
+    """
+    Returns stage latencies, upstream calls, cache hit ratios and traceroute durations in
+    the Prometheus text format. Only available with METRICS_ENABLED=1 in .env
+    """
+    if not METRICS_ENABLED:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="metrics are disabled"
+        )
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+def _geometry_response(request, body, version):
+    """
+    Serves an EncodedBody in the best encoding the client accepts, or a 304 if the client's
+    copy is still current
+
+    Args:
+        request (Request): the request, for its Accept-Encoding and If-None-Match headers
+        body (EncodedBody): the geometry to serve
+        version (string): the v query parameter the client sent, if any
+    """
+    encoding, content = body.negotiate(request.headers.get("accept-encoding"))
+
+    # every encoding is a different representation, so it gets its own ETag
+    etag = f'"{body.etag}"' if encoding == "identity" else f'"{body.etag}-{encoding}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL if version == cable_geometry.version else GEOMETRY_CACHE_CONTROL,
+        "Vary": "Accept-Encoding",
+    }
+
+    if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(content, media_type="application/geo+json", headers=headers)
+
+@app.get("/api/cables/manifest")
+def cables_manifest():
+    """
+    Returns the current geometry version and the zoom levels it's simplified for. Geometry
+    requested with ?v=<version> can be cached forever
+    """
+    return {"version": cable_geometry.version, "zooms": ZOOM_LEVELS}
+
+@app.get("/api/cables")
+def cables(request: Request, zoom: Union[int, None] = None, v: Union[str, None] = None):
+    """
+    Returns every cable as a GeoJSON FeatureCollection, simplified for the given map zoom
+    (the most detailed zoom level that's built if no zoom is given)
+    """
+    return _geometry_response(request, cable_geometry.collection(zoom), v)
+
+@app.get("/api/cables/{cable_id}")
+def cable(request: Request, cable_id: str, zoom: Union[int, None] = None, v: Union[str, None] = None):
+    """
+    Returns a single cable as a GeoJSON FeatureCollection, so the client only has to fetch
+    the cables on the route it's showing
+    """
+    body = cable_geometry.cable(cable_id, zoom)
+    if body is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="unknown cable"
+        )
+    return _geometry_response(request, body, v)
 
 @app.post("/api/getLocations")
 async def get_locations(ip_addresses: list = Body(...)):
@@ -50,10 +459,8 @@ async def get_locations(ip_addresses: list = Body(...)):
     Location objects and return frontend representations
     """
 
-    # create IPLocation instance for each IP address in list
-    ip_locations = await asyncio.gather(
-        *[IPLocation.create(ip) for ip in ip_addresses]
-    )
+    # create IPLocation instance for each IP address in list (batched geolocation lookup)
+    ip_locations = await IPLocation.create_batch(ip_addresses)
 
     ip_locations = [ip_location for ip_location in ip_locations if not ip_location.is_private]
 
@@ -62,17 +469,11 @@ async def get_locations(ip_addresses: list = Body(...)):
         *[ip_location.find_facility() for ip_location in ip_locations]
     )
 
-    # use sliding window to setup cable info and compute distances
-    for i in range(len(ip_locations) - 1):
-        # get sliding window locations
-        loc_A = ip_locations[i]
-        loc_B = ip_locations[i + 1]
-
-        # populate neighbor info for locations A and B
-        populate_neighbor_information(loc_A, loc_B)
+    # setup cable info and compute distances for every adjacent pair of locations
+    populate_route_information(ip_locations)
 
     # convert locations to frontend format
     frontend_form_locations = [loc.get_frontend_format() for loc in ip_locations]
 
-    # merge duplicate locations and return
-    return merge_frontend_locations(frontend_form_locations)
+    # merge duplicate locations and return them serialized straight to json with orjson
+    return ORJSONResponse(merge_frontend_locations(frontend_form_locations))
@@ -0,0 +1,204 @@
+import os
+import time
+import bisect
+import inspect
+import functools
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# metrics are off unless METRICS_ENABLED is set in .env. it's read once at import: when
+# off, timed() hands back the undecorated function, so instrumented code runs exactly
+# as it would without it
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "").lower() in ("1", "true", "yes")
+
+# upper bounds (seconds) of the latency histogram buckets, from in-process CPU work up
+# to full traceroutes
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# every metric and collector, in the order they're rendered
+_metrics = []
+_collectors = []
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    """
+    Monotonic counter, one value per combination of label values
+    """
+
+    def __init__(self, name, help, labels=()):
+        """
+        Args:
+            name (string): metric name
+            help (string): description shown in the exposition
+            labels (tuple): label names, inc() takes their values in the same order
+        """
+        self.name = name
+        self.help = help
+        self.labels = labels
+
+        # label values tuple -> count
+        self._values = {}
+        _metrics.append(self)
+
+    def inc(self, *label_values, amount=1):
+        if not METRICS_ENABLED:
+            return
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+class Histogram:
+    """
+    Histogram with fixed buckets, one set of buckets per combination of label values
+    """
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        """
+        Args:
+            name (string): metric name
+            help (string): description shown in the exposition
+            labels (tuple): label names, observe() takes their values in the same order
+            buckets (tuple): ascending bucket upper bounds, +Inf is added on top
+        """
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+
+        # label values tuple -> [per-bucket counts (last one is +Inf), sum, count].
+        # counts aren't cumulative until they're rendered
+        self._values = {}
+        _metrics.append(self)
+
+    def observe(self, value, *label_values):
+        if not METRICS_ENABLED:
+            return
+        entry = self._values.get(label_values)
+        if entry is None:
+            entry = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                le = _format_labels(self.labels, label_values, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+# latency of each stage of locating a route
+stage_latency = Histogram(
+    "traceroute_stage_duration_seconds",
+    "Time spent in each stage of tracing and locating a route",
+    ("stage",)
+)
+
+# requests to ip-api and PeeringDB, by limiter and response status ("error" if the
+# upstream couldn't be reached)
+upstream_requests = Counter(
+    "upstream_requests_total",
+    "Requests sent to upstream APIs by response status",
+    ("upstream", "status")
+)
+upstream_latency = Histogram(
+    "upstream_request_duration_seconds",
+    "Upstream API response times",
+    ("upstream",)
+)
+
+# time traceroutes (subprocess or raw tracer) spend waiting for a slot and running
+traceroute_wait = Histogram(
+    "traceroute_queue_wait_seconds",
+    "Time traceroutes wait for a free slot",
+    ("engine",)
+)
+traceroute_run = Histogram(
+    "traceroute_run_duration_seconds",
+    "Time traceroutes hold a slot, i.e. subprocess or raw tracer run time",
+    ("engine",)
+)
+
+def timed(stage):
+    """
+    Decorator that times every call of a function (sync or async) as a stage. Leaves the
+    function untouched when metrics are disabled
+
+    Args:
+        stage (string): stage label
+    """
+    def decorator(function):
+        if not METRICS_ENABLED:
+            return function
+
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                started_at = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    stage_latency.observe(time.perf_counter() - started_at, stage)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stage_latency.observe(time.perf_counter() - started_at, stage)
+        return wrapper
+
+    return decorator
+
+def register_collector(collect):
+    """
+    Registers a function that's called on every scrape to report values other modules
+    already keep track of (cache counters, queue depths), so they cost nothing between
+    scrapes
+
+    Args:
+        collect (function): returns a list of (name, type, help, samples) tuples, where
+            type is "counter" or "gauge" and samples is a list of (labels dict, value)
+    """
+    _collectors.append(collect)
+
+def render_metrics():
+    """
+    Renders every metric in the Prometheus text exposition format
+
+    Returns:
+        string: the exposition
+    """
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+
+    for collect in _collectors:
+        for name, kind, help, samples in collect():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(labels.keys(), labels.values())} {value}")
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,215 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import asyncio
+from dotenv import load_dotenv
+from http_clients import close_clients
+from rate_limits import upstream_request, PRIORITY_BATCH
+from api_keys import get_pdb_api_key
+from logging_config import get_logger
+
+logger = get_logger()
+default_mirror_path = "./peeringdb.sqlite3"
+
+# tables synced from PeeringDB and the columns pulled out of each object for indexing.
+# the full object is kept in the data column so queries can return it as-is
+MIRROR_TABLES = {
+    "net": ("asn",),
+    "fac": ("country", "city", "state"),
+    "netfac": ("net_id", "fac_id", "local_asn"),
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS net (id INTEGER PRIMARY KEY, asn INTEGER, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS fac (id INTEGER PRIMARY KEY, country TEXT, city TEXT, state TEXT, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS netfac (id INTEGER PRIMARY KEY, net_id INTEGER, fac_id INTEGER, local_asn INTEGER, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS sync_state (tbl TEXT PRIMARY KEY, synced_at INTEGER NOT NULL);
+
+CREATE INDEX IF NOT EXISTS net_asn ON net (asn);
+CREATE INDEX IF NOT EXISTS fac_country_city ON fac (country, city);
+CREATE INDEX IF NOT EXISTS fac_state ON fac (state);
+CREATE INDEX IF NOT EXISTS netfac_net ON netfac (net_id);
+CREATE INDEX IF NOT EXISTS netfac_fac ON netfac (fac_id);
+CREATE INDEX IF NOT EXISTS netfac_local_asn ON netfac (local_asn);
+"""
+
+# bulk dumps of the larger tables take a while to generate on PeeringDB's side
+SYNC_TIMEOUT = 300
+
+class PeeringDBMirror:
+    """
+    Local SQLite snapshot of PeeringDB's net, netfac and fac tables. Answers the same
+    netfac and fac queries IPLocation used to send to peeringdb.com.
+    """
+
+    def __init__(self, path=default_mirror_path):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+
+    def is_synced(self):
+        """
+        Checks that every table has been synced at least once
+        """
+        synced = self._db.execute("SELECT COUNT(*) FROM sync_state").fetchone()[0]
+        return synced == len(MIRROR_TABLES)
+
+    async def sync(self):
+        """
+        Downloads every mirrored table from PeeringDB. The first sync pulls full tables,
+        later syncs only pull objects changed since the last one (?since=)
+
+        Returns:
+            dict: table name -> number of objects updated or deleted
+        """
+        changed = {}
+        for table in MIRROR_TABLES:
+            changed[table] = await self._sync_table(table)
+        return changed
+
+    async def _sync_table(self, table):
+        """
+        Syncs a single table. deleted objects come back with status "deleted" on
+        incremental syncs and are removed from the mirror
+        """
+        row = self._db.execute("SELECT synced_at FROM sync_state WHERE tbl = ?", (table,)).fetchone()
+        since = row[0] if row else 0
+
+        # take the timestamp before the request so changes made during the download are
+        # picked up by the next sync
+        started_at = int(time.time())
+
+        params = {"since": since} if since else {}
+        # goes behind any interactive lookups sharing the PeeringDB limiter
+        response = await upstream_request(
+            "peeringdb", "GET", f"/api/{table}",
+            priority=PRIORITY_BATCH,
+            params=params,
+            headers={"Authorization": f"Api-Key {get_pdb_api_key()}"},
+            timeout=SYNC_TIMEOUT
+        )
+        response.raise_for_status()
+        objects = response.json().get("data", [])
+
+        columns = MIRROR_TABLES[table]
+        live = [obj for obj in objects if obj.get("status") != "deleted"]
+        deleted = [(obj["id"],) for obj in objects if obj.get("status") == "deleted"]
+
+        with self._db:
+            self._db.executemany(
+                f"INSERT OR REPLACE INTO {table} (id, {', '.join(columns)}, data) "
+                f"VALUES ({', '.join('?' * (len(columns) + 2))})",
+                [(obj["id"], *[obj.get(c) for c in columns], json.dumps(obj)) for obj in live]
+            )
+            self._db.executemany(f"DELETE FROM {table} WHERE id = ?", deleted)
+            self._db.execute(
+                "INSERT OR REPLACE INTO sync_state (tbl, synced_at) VALUES (?, ?)",
+                (table, started_at)
+            )
+
+        logger.info(f"[PeeringDBMirror._sync_table]: {table}: {len(live)} updated, {len(deleted)} deleted ({since=})")
+        return len(objects)
+
+    def find_netfacs(self, asn, country_code, region, city):
+        """
+        Local version of the netfac search IPLocation does against PeeringDB
+        (net__asn plus fac__state in the US, or fac__country and fac__city elsewhere)
+
+        Args:
+            asn (string): ASN of the network
+            country_code (string): two letter country code of the IP location
+            region (string): region (state) code of the IP location
+            city (string): city of the IP location
+
+        Returns:
+            list: matching netfac objects
+        """
+        try:
+            asn = int(asn)
+        except (TypeError, ValueError):
+            return []
+
+        query = (
+            "SELECT netfac.data FROM netfac "
+            "JOIN net ON net.id = netfac.net_id "
+            "JOIN fac ON fac.id = netfac.fac_id "
+            "WHERE net.asn = ? "
+        )
+
+        # check for country code to narrow down results, same as the live query
+        if country_code == "US":
+            rows = self._db.execute(query + "AND fac.state = ?", (asn, region))
+        else:
+            rows = self._db.execute(query + "AND fac.country = ? AND fac.city = ?", (asn, country_code, city))
+
+        return [json.loads(data) for (data,) in rows]
+
+    def get_facs(self, fac_ids):
+        """
+        Gets fac objects by id
+
+        Args:
+            fac_ids (list): fac ids to look up
+
+        Returns:
+            list: fac object (or None if it isn't in the mirror) for each id, in order
+        """
+        if not fac_ids:
+            return []
+
+        rows = self._db.execute(
+            f"SELECT id, data FROM fac WHERE id IN ({', '.join('?' * len(fac_ids))})",
+            list(fac_ids)
+        )
+        facs = {fac_id: json.loads(data) for fac_id, data in rows}
+        return [facs.get(fac_id) for fac_id in fac_ids]
+
+    def close(self):
+        self._db.close()
+
+def get_mirror_path():
+    """
+    Gets the mirror path from PEERINGDB_MIRROR in .env, or the default path
+    """
+    load_dotenv()
+    return os.environ.get("PEERINGDB_MIRROR", default_mirror_path)
+
+def open_peeringdb_mirror():
+    """
+    Opens the local PeeringDB mirror if it has been synced
+
+    Returns:
+        PeeringDBMirror: the mirror, or None if there's no synced mirror (IPLocation
+            falls back to live PeeringDB queries in that case)
+    """
+    path = get_mirror_path()
+    if not os.path.exists(path):
+        return None
+
+    mirror = PeeringDBMirror(path)
+    if not mirror.is_synced():
+        logger.warning(f"[open_peeringdb_mirror]: {path} has never been synced, using live PeeringDB")
+        mirror.close()
+        return None
+
+    return mirror
+
+async def _sync_command(path):
+    mirror = PeeringDBMirror(path)
+    try:
+        changed = await mirror.sync()
+    finally:
+        mirror.close()
+        await close_clients()
+    print(f"Successfully synced {path}: {changed}")
+
+if __name__ == "__main__":
+    # usage: python peeringdb_mirror.py sync
+    if sys.argv[1:] != ["sync"]:
+        print("usage: python peeringdb_mirror.py sync")
+        sys.exit(1)
+
+    asyncio.run(_sync_command(get_mirror_path()))
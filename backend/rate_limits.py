@@ -0,0 +1,400 @@
+import os
+import time
+import heapq
+import random
+import asyncio
+import itertools
+import contextvars
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+import httpx
+from dotenv import load_dotenv
+from http_clients import get_client, _env_number
+from logging_config import get_logger
+from metrics import upstream_requests, upstream_latency
+
+logger = get_logger()
+
+# request priorities, lower goes first. interactive requests (someone is waiting on a
+# route in the browser) are let through before batch sweeps and mirror syncs
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+
+# priority of the upstream requests made by the current task. asyncio tasks copy the
+# context they're created in, so everything a batch task spawns inherits its priority
+request_priority = contextvars.ContextVar("request_priority", default=PRIORITY_INTERACTIVE)
+
+# responses that mean we're going too fast: back off, slow down and retry
+THROTTLE_STATUSES = (429, 503)
+
+# responses worth retrying that don't say anything about our rate
+RETRY_STATUSES = (500, 502, 504)
+
+# limiter name -> (upstream client name, env prefix, requests per second, burst, most
+# requests in flight). every value can be overridden in .env, e.g. PEERINGDB_RATE=0.5,
+# PEERINGDB_BURST=10, PEERINGDB_MAX_CONCURRENCY=4, PEERINGDB_RETRIES=5
+LIMITS = {
+    # ip-api's free endpoints allow 45 single and 15 batch lookups a minute, counted
+    # separately. both report what's left of the window in X-Rl / X-Ttl
+    "ip_api": ("ip_api", "IP_API", 45 / 60, 45, 10),
+    "ip_api_batch": ("ip_api", "IP_API_BATCH", 15 / 60, 15, 4),
+    # PeeringDB allows 20 queries a minute anonymously (40 with an API key, see
+    # AUTHENTICATED_LIMITS) and answers 429 with a Retry-After once we go over
+    "peeringdb": ("peeringdb", "PEERINGDB", 20 / 60, 10, 4),
+}
+
+# limiter name -> (env var with the upstream's API key, requests per second, burst) used
+# instead of the LIMITS defaults when the key is set
+AUTHENTICATED_LIMITS = {
+    "peeringdb": ("PEERING_DB_API_KEY", 40 / 60, 20),
+}
+
+# a throttled response halves the bucket's refill rate (down to 1/16 of the configured
+# rate), and every successful one gives back this share of the configured rate
+RATE_INCREASE = 0.05
+MIN_RATE_SHARE = 1 / 16
+
+@contextmanager
+def request_priority_scope(priority):
+    """
+    Runs the block (and every task created in it) with the given request priority
+    """
+    token = request_priority.set(priority)
+    try:
+        yield
+    finally:
+        request_priority.reset(token)
+
+def _parse_retry_after(value):
+    """
+    Parses a Retry-After header, which is either a number of seconds or an http date
+
+    Returns:
+        float: seconds to wait, or None if the header is missing or malformed
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class UpstreamLimiter:
+    """
+    Rate limiter and concurrency governor for one upstream API.
+
+    A token bucket caps the request rate and an AIMD limit caps the requests in flight:
+    every successful response raises the limit by 1/limit (about one more request per
+    round trip), and a throttled response or timeout halves it. The bucket's refill rate
+    is AIMD too: a throttled response halves it and successful responses add it back a
+    little at a time, up to the configured rate, so a limit we've misjudged isn't run
+    into again right after every pause. The bucket is kept in
+    line with the upstream's own accounting when it reports it: ip-api's X-Rl (requests
+    left in the window) and X-Ttl (seconds until it resets) let us spend exactly what's
+    left and then wait for the reset instead of running into 429s, and a Retry-After
+    pauses every request to the upstream, not just the one that got it.
+
+    Requests waiting for a slot are served by priority, then in arrival order, so
+    interactive lookups overtake a batch sweep that's already queued. Failed requests
+    are retried with full-jitter exponential backoff.
+    """
+
+    def __init__(self, name, upstream, rate, burst, max_concurrency, retries=3, backoff=0.5, max_backoff=30.0):
+        """
+        Args:
+            name (string): limiter name, for logs and stats
+            upstream (string): http_clients upstream the requests go to
+            rate (float): requests per second the bucket refills at, at most
+            burst (int): bucket size, most requests that can go out back to back
+            max_concurrency (int): ceiling for the AIMD in flight limit
+            retries (int): times to retry a throttled or failed request
+            backoff (float): base backoff in seconds, doubled every retry
+            max_backoff (float): longest backoff in seconds
+        """
+        self.name = name
+        self.upstream = upstream
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.tokens = float(burst)
+        self._refilled_at = time.monotonic()
+
+        # AIMD in flight limit, starts wide open and backs off once the upstream pushes back
+        self.concurrency = float(max_concurrency)
+        self.in_flight = 0
+
+        # nothing goes out before this (monotonic) time, and the bucket holds
+        # _tokens_after_block tokens once it passes
+        self._blocked_until = 0.0
+        self._tokens_after_block = 1.0
+
+        # only requests sent after the last decrease can decrease the limit again, so a
+        # burst of 429s for requests that were already in flight only halves it once
+        self._decreased_at = 0.0
+        self._rate_decreased_at = 0.0
+
+        # (priority, arrival number, future) of every request waiting for a slot
+        self._waiters = []
+        self._arrivals = itertools.count()
+        self._timer = None
+
+        self.counters = {"requests": 0, "throttled": 0, "retries": 0, "failures": 0}
+
+    async def request(self, method, url, priority=None, **kwargs):
+        """
+        Sends a request to the upstream once the limiter lets it through, retrying
+        throttled and failed attempts
+
+        Args:
+            method (string): http method
+            url (string): url, relative to the upstream's base url
+            priority (int): request priority, defaults to the current request_priority
+            **kwargs: passed on to httpx.AsyncClient.request
+
+        Returns:
+            httpx.Response: the first response that isn't throttled or a server error
+
+        Raises:
+            httpx.HTTPStatusError: if every attempt was throttled or failed on the server
+            httpx.TransportError: if the last attempt couldn't reach the upstream
+        """
+        if priority is None:
+            priority = request_priority.get()
+
+        client = get_client(self.upstream)
+        for attempt in range(self.retries + 1):
+            await self._acquire(priority)
+            sent_at = time.monotonic()
+            self.counters["requests"] += 1
+            try:
+                response = await client.request(method, url, **kwargs)
+                error = None
+            except httpx.TransportError as e:
+                # timeouts and refused connections are congestion too
+                response, error = None, e
+                self._decrease(sent_at)
+                upstream_requests.inc(self.name, "error")
+            else:
+                self._observe(response, sent_at)
+                upstream_requests.inc(self.name, str(response.status_code))
+            finally:
+                self._release()
+                upstream_latency.observe(time.monotonic() - sent_at, self.name)
+
+            if response is not None and response.status_code not in THROTTLE_STATUSES + RETRY_STATUSES:
+                self._increase()
+                return response
+
+            if attempt == self.retries:
+                break
+
+            # throttled requests also wait for the block _observe set before they're let
+            # through again, the jitter keeps retries from going out in lockstep
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+            logger.warning(
+                f"[UpstreamLimiter.request]: {self.name} {method} {url} "
+                f"{error or response.status_code}, retrying in {delay:.2f}s"
+            )
+            self.counters["retries"] += 1
+            await asyncio.sleep(delay)
+
+        self.counters["failures"] += 1
+        if error:
+            raise error
+        response.raise_for_status()
+
+    async def _acquire(self, priority):
+        """
+        Waits for a token and an in flight slot
+        """
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._arrivals), future))
+        self._dispatch()
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            # cancelled right after being let through, give the slot back
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+
+    def _release(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    def _refill(self, now):
+        if self._blocked_until:
+            if now < self._blocked_until:
+                return
+            self._blocked_until = 0.0
+            self.tokens = self._tokens_after_block
+        else:
+            self.tokens = min(self.burst, self.tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def _dispatch(self):
+        """
+        Lets waiting requests through while there are tokens and free slots, and sets a
+        timer for when the next token comes in (or the block ends) if some are left waiting
+        """
+        now = time.monotonic()
+        self._refill(now)
+
+        while self._waiters:
+            future = self._waiters[0][2]
+            if future.done():
+                # cancelled while waiting
+                heapq.heappop(self._waiters)
+                continue
+            if self.in_flight >= int(self.concurrency) or self._blocked_until or self.tokens < 1:
+                break
+
+            heapq.heappop(self._waiters)
+            self.tokens -= 1
+            self.in_flight += 1
+            future.set_result(None)
+
+        # when every slot is busy the next release dispatches again, otherwise we're
+        # waiting on the clock
+        if self._waiters and self._timer is None and self.in_flight < int(self.concurrency):
+            if self._blocked_until:
+                delay = self._blocked_until - now
+            else:
+                delay = (1 - self.tokens) / self.rate
+            self._timer = asyncio.get_running_loop().call_later(max(delay, 0.0), self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._dispatch()
+
+    def _block(self, seconds, tokens_after):
+        """
+        Holds every request back for a number of seconds
+        """
+        until = time.monotonic() + seconds
+        if until > self._blocked_until:
+            self._blocked_until = until
+            self._tokens_after_block = tokens_after
+        self.tokens = 0.0
+
+    def _increase(self):
+        self.concurrency = min(float(self.max_concurrency), self.concurrency + 1 / self.concurrency)
+        self.rate = min(self.max_rate, self.rate + self.max_rate * RATE_INCREASE)
+
+    def _decrease(self, sent_at):
+        if sent_at >= self._decreased_at:
+            self.concurrency = max(1.0, self.concurrency / 2)
+            self._decreased_at = time.monotonic()
+
+    def _decrease_rate(self, sent_at):
+        # same once per round of requests rule as _decrease
+        if sent_at >= self._rate_decreased_at:
+            self.rate = max(self.max_rate * MIN_RATE_SHARE, self.rate / 2)
+            self._rate_decreased_at = time.monotonic()
+
+    def _observe(self, response, sent_at):
+        """
+        Updates the limiter from a response's status and rate limit headers
+        """
+        headers = response.headers
+
+        # ip-api: requests left in the current window and seconds until it resets
+        window_ttl = None
+        try:
+            remaining, window_ttl = int(headers["X-Rl"]), int(headers["X-Ttl"])
+        except (KeyError, ValueError):
+            pass
+        else:
+            # the other requests in flight come out of what's left too
+            left = remaining - (self.in_flight - 1)
+            if left < 1:
+                # spent, wait for the window to reset and start it with a full bucket
+                self._block(window_ttl, float(self.burst))
+            else:
+                self.tokens = min(self.tokens, float(left))
+
+        if response.status_code in THROTTLE_STATUSES:
+            self.counters["throttled"] += 1
+            self._decrease(sent_at)
+            self._decrease_rate(sent_at)
+
+            wait = _parse_retry_after(headers.get("Retry-After"))
+            if wait is None:
+                wait = window_ttl if window_ttl is not None else self.backoff
+            self._block(wait, 1.0)
+            logger.warning(f"[UpstreamLimiter._observe]: {self.name} throttled, pausing for {wait:.1f}s")
+
+    def stats(self):
+        """
+        Returns the limiter's current state and counters
+        """
+        self._refill(time.monotonic())
+        return {
+            "concurrency_limit": round(self.concurrency, 2),
+            "rate": round(self.rate, 4),
+            "in_flight": self.in_flight,
+            "queued": sum(not waiter[2].done() for waiter in self._waiters),
+            "tokens": round(self.tokens, 2),
+            "blocked_for": round(max(0.0, self._blocked_until - time.monotonic()), 2),
+            **self.counters,
+        }
+
+# one limiter per LIMITS entry, shared by every request in this process
+_limiters = {}
+
+def get_limiter(name):
+    """
+    Gets the shared limiter for a LIMITS entry, creating it on first use
+
+    Args:
+        name (string): limiter name (key of LIMITS)
+    """
+    limiter = _limiters.get(name)
+    if limiter is None:
+        load_dotenv()
+        upstream, prefix, rate, burst, max_concurrency = LIMITS[name]
+        if name in AUTHENTICATED_LIMITS:
+            key_env, authenticated_rate, authenticated_burst = AUTHENTICATED_LIMITS[name]
+            if os.environ.get(key_env):
+                rate, burst = authenticated_rate, authenticated_burst
+
+        configured_rate = _env_number(f"{prefix}_RATE", rate, float)
+        if configured_rate <= 0:
+            # a zero rate would never refill the bucket (and divides by zero)
+            logger.error(f"[get_limiter]: {prefix}_RATE must be more than 0, using the default of {rate:.3f}/s")
+            configured_rate = rate
+
+        limiter = _limiters[name] = UpstreamLimiter(
+            name,
+            upstream,
+            rate=configured_rate,
+            burst=_env_number(f"{prefix}_BURST", burst),
+            max_concurrency=_env_number(f"{prefix}_MAX_CONCURRENCY", max_concurrency),
+            retries=_env_number(f"{prefix}_RETRIES", 3),
+        )
+    return limiter
+
+async def upstream_request(name, method, url, priority=None, **kwargs):
+    """
+    Sends a request through a limiter, see UpstreamLimiter.request
+
+    Args:
+        name (string): limiter name (key of LIMITS)
+    """
+    return await get_limiter(name).request(method, url, priority=priority, **kwargs)
+
+def get_limiter_stats():
+    """
+    Returns the stats of every limiter that has been used
+    """
+    return {name: limiter.stats() for name, limiter in _limiters.items()}
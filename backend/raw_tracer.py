@@ -0,0 +1,291 @@
+import sys
+import time
+import random
+import socket
+import struct
+import asyncio
+from logging_config import get_logger
+
+logger = get_logger()
+
+ICMP_DEST_UNREACHABLE = 3
+ICMP_TIME_EXCEEDED = 11
+
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_ACK = 0x10
+
+def _checksum(data):
+    """
+    Internet checksum (RFC 1071) of a byte string
+    """
+    if len(data) % 2:
+        data += b"\0"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+def default_socket_factory(kind, dst_ip):
+    """
+    Opens the raw sockets the tracer needs. Needs root or CAP_NET_RAW
+
+    Args:
+        kind (string): "send" for the socket probes are written to, "icmp" for the
+            socket ICMP replies are read from, "tcp" for the socket the destination's
+            SYN-ACK/RST replies are read from
+        dst_ip (string): address being traced
+
+    Returns:
+        socket.socket: non-blocking socket
+    """
+    if kind == "send":
+        # IPPROTO_RAW means we write the whole IP header ourselves (so we can set the TTL
+        # and ID per packet). connect so plain send() goes to the destination
+        sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_RAW)
+        sock.connect((dst_ip, 0))
+    elif kind == "icmp":
+        sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_TCP)
+
+    sock.setblocking(False)
+    return sock
+
+class RawSocketTracer:
+    """
+    In-process TCP SYN traceroute over raw sockets (Linux, IPv4).
+
+    Instead of probing one TTL at a time like tcptraceroute, the probes for every TTL are
+    sent at once and the replies are matched back to their TTL, so a trace takes about
+    one round trip plus the timeout instead of hops x timeout. Like Paris traceroute,
+    every probe uses the same addresses and ports, so load balancers that hash on the
+    flow send every probe down the same path. The TTL is encoded in the TCP sequence
+    number (and IP ID) instead, which ICMP errors quote back to us.
+    """
+
+    def __init__(self, port=443, wait=1.0, socket_factory=default_socket_factory):
+        """
+        Args:
+            port (int): destination TCP port
+            wait (float): seconds to wait for replies after the last probe is sent
+            socket_factory (function): opens the sockets (see default_socket_factory).
+                swap this out to run the tracer against fake sockets or a network namespace
+        """
+        self.port = port
+        self.wait = wait
+        self.socket_factory = socket_factory
+
+    async def trace(self, host, hops=50):
+        """
+        Traces the route to a host
+
+        Args:
+            host (string): the address to trace
+            hops (int): the maximum number of hops
+
+        Returns:
+            list: one dict per hop up to the destination (or hops): hop number, IP address
+                (None if the hop didn't answer), round trip time in ms (None if the hop
+                didn't answer) and marker ("open"/"closed" if the destination answered)
+        """
+        loop = asyncio.get_running_loop()
+        dst_ip = (await loop.getaddrinfo(host, self.port, family=socket.AF_INET, type=socket.SOCK_STREAM))[0][4][0]
+        src_ip = self._source_address(dst_ip)
+
+        # the flow identifier (addresses and ports) stays the same for every probe
+        src_port = random.randint(33000, 65000)
+        seq_base = random.randint(0, 2**31)
+
+        replies = {}
+        sent_at = {}
+        destination_ttl = [None]
+        sockets = []
+        try:
+            # opened one at a time so the ones already open get closed if the next one fails
+            for kind in ("send", "icmp", "tcp"):
+                sockets.append(self.socket_factory(kind, dst_ip))
+            send_sock, icmp_sock, tcp_sock = sockets
+
+            for ttl in range(1, hops + 1):
+                packet = self._build_probe(src_ip, dst_ip, src_port, seq_base + ttl, ttl)
+                sent_at[ttl] = time.monotonic()
+                send_sock.send(packet)
+
+            ctx = (dst_ip, src_port, seq_base, hops, sent_at, replies, destination_ttl)
+            readers = [
+                asyncio.create_task(self._read_icmp(loop, icmp_sock, ctx)),
+                asyncio.create_task(self._read_tcp(loop, tcp_sock, ctx)),
+            ]
+
+            # stop once every hop up to the destination has answered, or the wait runs out
+            deadline = time.monotonic() + self.wait
+            while time.monotonic() < deadline and not self._complete(replies, destination_ttl[0]):
+                await asyncio.sleep(min(0.01, max(0, deadline - time.monotonic())))
+
+            for reader in readers:
+                reader.cancel()
+            await asyncio.gather(*readers, return_exceptions=True)
+        finally:
+            for sock in sockets:
+                sock.close()
+
+        last_hop = destination_ttl[0] or hops
+        return [
+            {"hop": ttl, **replies.get(ttl, {"ip": None, "rtt": None, "marker": None})}
+            for ttl in range(1, last_hop + 1)
+        ]
+
+    @staticmethod
+    def _complete(replies, destination_ttl):
+        return destination_ttl is not None and all(ttl in replies for ttl in range(1, destination_ttl + 1))
+
+    @staticmethod
+    def _source_address(dst_ip):
+        """
+        Gets the local address the kernel would use to reach dst_ip (connecting a UDP
+        socket doesn't send anything)
+        """
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+            probe.connect((dst_ip, 9))
+            return probe.getsockname()[0]
+
+    def _build_probe(self, src_ip, dst_ip, src_port, seq, ttl):
+        """
+        Builds an IPv4 + TCP SYN packet
+
+        Returns:
+            bytes: the packet
+        """
+        src = socket.inet_aton(src_ip)
+        dst = socket.inet_aton(dst_ip)
+
+        # TCP header with a zero checksum, then the checksum over the pseudo-header
+        tcp = struct.pack("!HHIIBBHHH", src_port, self.port, seq, 0, 5 << 4, TCP_SYN, 65535, 0, 0)
+        pseudo = struct.pack("!4s4sBBH", src, dst, 0, socket.IPPROTO_TCP, len(tcp))
+        tcp = tcp[:16] + struct.pack("!H", _checksum(pseudo + tcp)) + tcp[18:]
+
+        # IP header. the ID carries the TTL too, for routers that mangle the TCP header
+        ip = struct.pack(
+            "!BBHHHBBH4s4s",
+            (4 << 4) | 5, 0, 20 + len(tcp), ttl, 0, ttl, socket.IPPROTO_TCP, 0, src, dst
+        )
+        ip = ip[:10] + struct.pack("!H", _checksum(ip)) + ip[12:]
+        return ip + tcp
+
+    @staticmethod
+    def _record(ctx, ttl, ip, marker=None):
+        """
+        Records the first reply for a TTL
+        """
+        dst_ip, src_port, seq_base, hops, sent_at, replies, destination_ttl = ctx
+        if ttl < 1 or ttl > hops or ttl in replies:
+            return
+
+        rtt = (time.monotonic() - sent_at[ttl]) * 1000
+        replies[ttl] = {"ip": ip, "rtt": round(rtt, 3), "marker": marker}
+
+        # probes with a bigger TTL than the first one that reached the destination also
+        # reach it, only the smallest one is the real hop count
+        if ip == dst_ip and (destination_ttl[0] is None or ttl < destination_ttl[0]):
+            destination_ttl[0] = ttl
+
+    async def _read_icmp(self, loop, sock, ctx):
+        """
+        Reads ICMP time exceeded (from routers) and destination unreachable replies and
+        matches them to the probe they quote
+        """
+        dst_ip, src_port, seq_base = ctx[0], ctx[1], ctx[2]
+        while True:
+            data = await loop.sock_recv(sock, 65535)
+            reply = self.parse_icmp_reply(data)
+            if not reply:
+                continue
+
+            icmp_type, router_ip, quoted_dst, quoted_src_port, quoted_dst_port, quoted_seq = reply
+            if quoted_dst != dst_ip or quoted_src_port != src_port or quoted_dst_port != self.port:
+                continue
+
+            marker = "unreachable" if icmp_type == ICMP_DEST_UNREACHABLE else None
+            self._record(ctx, quoted_seq - seq_base, router_ip, marker)
+
+    async def _read_tcp(self, loop, sock, ctx):
+        """
+        Reads the destination's SYN-ACK (port open) or RST (port closed) replies. The
+        reply acknowledges our sequence number + 1, which gives us the TTL
+        """
+        dst_ip, src_port, seq_base = ctx[0], ctx[1], ctx[2]
+        while True:
+            data = await loop.sock_recv(sock, 65535)
+            reply = self.parse_tcp_reply(data)
+            if not reply:
+                continue
+
+            reply_src, reply_src_port, reply_dst_port, ack, flags = reply
+            if reply_src != dst_ip or reply_src_port != self.port or reply_dst_port != src_port:
+                continue
+
+            marker = "closed" if flags & TCP_RST else "open"
+            self._record(ctx, ack - 1 - seq_base, reply_src, marker)
+
+    @staticmethod
+    def parse_icmp_reply(data):
+        """
+        Parses an ICMP error packet (including its IP header)
+
+        Returns:
+            tuple: (icmp type, router address, quoted destination address, quoted source
+                port, quoted destination port, quoted sequence number), or None if the
+                packet isn't an ICMP error quoting a TCP packet
+        """
+        if len(data) < 20:
+            return None
+        ihl = (data[0] & 0x0F) * 4
+        router_ip = socket.inet_ntoa(data[12:16])
+
+        icmp = data[ihl:]
+        if len(icmp) < 8 or icmp[0] not in (ICMP_TIME_EXCEEDED, ICMP_DEST_UNREACHABLE):
+            return None
+
+        # the error quotes the IP header and at least the first 8 bytes of our probe
+        quoted = icmp[8:]
+        if len(quoted) < 20:
+            return None
+        quoted_ihl = (quoted[0] & 0x0F) * 4
+        if quoted[9] != socket.IPPROTO_TCP or len(quoted) < quoted_ihl + 8:
+            return None
+
+        quoted_dst = socket.inet_ntoa(quoted[16:20])
+        src_port, dst_port, seq = struct.unpack("!HHI", quoted[quoted_ihl:quoted_ihl + 8])
+        return icmp[0], router_ip, quoted_dst, src_port, dst_port, seq
+
+    @staticmethod
+    def parse_tcp_reply(data):
+        """
+        Parses a TCP packet (including its IP header)
+
+        Returns:
+            tuple: (source address, source port, destination port, ack number, flags), or
+                None if the packet is too short
+        """
+        if len(data) < 20:
+            return None
+        ihl = (data[0] & 0x0F) * 4
+        if len(data) < ihl + 14:
+            return None
+
+        src = socket.inet_ntoa(data[12:16])
+        src_port, dst_port, _, ack, _, flags = struct.unpack("!HHIIBB", data[ihl:ihl + 14])
+        return src, src_port, dst_port, ack, flags
+
+def raw_sockets_available():
+    """
+    Checks whether this process can open raw sockets
+    """
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP).close()
+        return True
+    except OSError:
+        return False
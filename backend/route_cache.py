@@ -0,0 +1,176 @@
+import os
+import time
+import socket
+import asyncio
+from collections import OrderedDict
+from dotenv import load_dotenv
+from logging_config import get_logger
+
+logger = get_logger()
+
+class RouteCache:
+    """
+    Cache for traceroute results, keyed by (kind, host, hops, vantage).
+
+    Entries are fresh for ttl seconds. After that they're stale for another stale_ttl
+    seconds: a stale entry is still returned right away, but a background refresh is
+    started so the next request gets a fresh one (stale-while-revalidate). Concurrent
+    requests that need the same entry share one computation (single-flight), so a
+    popular host is only probed once no matter how many users ask for it at once.
+    """
+
+    def __init__(self, ttl=300, stale_ttl=3600, max_entries=1000, vantage=None):
+        """
+        Args:
+            ttl (float): seconds an entry is fresh
+            stale_ttl (float): seconds an entry can be served stale after it stops being fresh
+            max_entries (int): most entries to keep before evicting the least recently used
+            vantage (string): name of the machine the traceroutes run from. routes from
+                different vantage points are different routes
+        """
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.vantage = vantage or socket.gethostname()
+
+        # key -> (fresh until timestamp, value), least recently used first
+        self._entries = OrderedDict()
+
+        # key -> task for the computation currently running for that key
+        self._in_flight = {}
+
+        self.counters = {"hits": 0, "stale_hits": 0, "misses": 0, "shared": 0, "refreshes": 0}
+
+    def key(self, kind, host, hops):
+        """
+        Builds a cache key
+
+        Args:
+            kind (string): what's being cached, e.g. "route" for raw get_route output or
+                "locations" for merged frontend locations
+            host (string): traced host
+            hops (int): max hops of the trace
+        """
+        return (kind, host.lower(), hops, self.vantage)
+
+    async def get(self, key, compute, refresh=None):
+        """
+        Gets a cached value, computing it if there isn't a usable one
+
+        Args:
+            key (tuple): cache key from self.key
+            compute (function): async function with no arguments that computes the value
+            refresh (function): async function with no arguments used instead of compute
+                to refresh a stale value in the background, for when compute does work
+                only the caller needs (e.g. streaming progress to it)
+
+        Returns:
+            the cached or computed value
+        """
+        now = time.time()
+        entry = self._entries.get(key)
+
+        if entry:
+            fresh_until, value = entry
+            if now < fresh_until:
+                self._entries.move_to_end(key)
+                self.counters["hits"] += 1
+                return value
+
+            if now < fresh_until + self.stale_ttl:
+                # serve the stale value now and refresh it for next time
+                self._entries.move_to_end(key)
+                self.counters["stale_hits"] += 1
+                self._refresh_in_background(key, refresh or compute)
+                return value
+
+            del self._entries[key]
+
+        if key in self._in_flight:
+            self.counters["shared"] += 1
+        else:
+            self.counters["misses"] += 1
+
+        return await self._single_flight(key, compute)
+
+    def is_cached(self, key):
+        """
+        Checks whether get would answer from the cache (fresh or stale) or by joining a
+        computation that's already running, instead of starting a new one
+        """
+        entry = self._entries.get(key)
+        if entry and time.time() < entry[0] + self.stale_ttl:
+            return True
+        return key in self._in_flight
+
+    def put(self, key, value):
+        """
+        Stores a value, evicting the least recently used entries if full
+        """
+        self._entries[key] = (time.time() + self.ttl, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def _single_flight(self, key, compute):
+        """
+        Waits for the computation of a key, starting it unless it's already running
+        """
+        return await asyncio.shield(self._start(key, compute))
+
+    def _start(self, key, compute):
+        """
+        Starts computing a key as its own task, or gets the task that's already computing
+        it. The task isn't tied to any one request, so the shared probe keeps going (and
+        gets cached) even if the request that started it goes away
+        """
+        task = self._in_flight.get(key)
+        if task is None:
+            task = self._in_flight[key] = asyncio.create_task(compute())
+            task.add_done_callback(lambda task: self._finish(key, task))
+        return task
+
+    def _finish(self, key, task):
+        """
+        Stores the result of a finished computation
+        """
+        del self._in_flight[key]
+
+        if task.cancelled():
+            return
+
+        # a failed computation (e.g. a traceroute that timed out) isn't cached. everyone
+        # waiting on it gets the error, and the next request tries again
+        if task.exception():
+            logger.error(f"[RouteCache]: computing {key} failed: {task.exception()}")
+            return
+
+        self.put(key, task.result())
+
+    def _refresh_in_background(self, key, compute):
+        """
+        Recomputes a stale entry without making anyone wait for it
+        """
+        if key not in self._in_flight:
+            self.counters["refreshes"] += 1
+            self._start(key, compute)
+
+    def stats(self):
+        return {**self.counters, "size": len(self._entries), "in_flight": len(self._in_flight)}
+
+def create_route_cache():
+    """
+    Creates a RouteCache configured from .env:
+        ROUTE_CACHE_TTL: seconds a route is fresh (default 5 minutes)
+        ROUTE_CACHE_STALE_TTL: seconds a route can be served while refreshing (default 1 hour)
+        ROUTE_CACHE_SIZE: most routes to keep (default 1000)
+        TRACE_VANTAGE: name of this vantage point (default the hostname)
+    """
+    load_dotenv()
+    return RouteCache(
+        ttl=float(os.environ.get("ROUTE_CACHE_TTL", 300)),
+        stale_ttl=float(os.environ.get("ROUTE_CACHE_STALE_TTL", 3600)),
+        max_entries=int(os.environ.get("ROUTE_CACHE_SIZE", 1000)),
+        vantage=os.environ.get("TRACE_VANTAGE"),
+    )
@@ -0,0 +1,380 @@
+import os
+import copy
+import time
+import asyncio
+from collections import OrderedDict, deque
+from dotenv import load_dotenv
+from traceroute import get_route, TracerouteBusyError, TracerouteFailedError
+from ip_location import IPLocation
+from location_operations import merge_frontend_locations, populate_neighbor_information
+from rate_limits import request_priority, PRIORITY_BATCH
+from logging_config import get_logger
+
+logger = get_logger()
+load_dotenv()
+
+# shortest time between two traces of the same destination, in seconds
+MONITOR_MIN_INTERVAL = float(os.environ.get("MONITOR_MIN_INTERVAL", 60))
+
+# most destinations kept (and monitored) at once
+MONITOR_MAX_DESTINATIONS = int(os.environ.get("MONITOR_MAX_DESTINATIONS", 100))
+
+# route changes remembered per destination
+MONITOR_HISTORY = int(os.environ.get("MONITOR_HISTORY", 100))
+
+class RouteMonitorFullError(Exception):
+    """
+    Raised when every destination slot is taken by a destination that's being watched
+    """
+
+class MonitoredRoute:
+    """
+    The last enriched route to a destination, and its history
+    """
+
+    def __init__(self, host, hops):
+        self.host = host
+        self.hops = hops
+
+        # ttl -> IP address of the last trace (None for hops that never answered)
+        self.hop_ips = None
+        self.ip_addresses = []
+
+        # IP address -> located IPLocation of every hop on the last route, without any
+        # cable or distance info. copied for every new route, never changed
+        self.locations = {}
+
+        # (IP address A, IP address B) -> (source cable, destination cable, distance) of
+        # every adjacent pair of locations on the last route
+        self.links = {}
+
+        # merged frontend locations of the last route
+        self.merged_locations = None
+        self.updated_at = None
+
+        # (timestamp, ((ttl, old IP address, new IP address), ...)) of every trace that
+        # changed the route. the full route of any point in the history can be rebuilt by
+        # undoing the changes after it, so only the diffs are stored
+        self.history = deque(maxlen=MONITOR_HISTORY)
+
+        # stable traces since the last change
+        self.unchanged = 0
+
+        # event queue -> interval of everyone watching, traced at the shortest of them
+        self.interval = None
+        self.subscribers = {}
+        self.task = None
+        self.lock = asyncio.Lock()
+
+    def snapshot(self):
+        return {
+            "host": self.host,
+            "hops": self.hops,
+            "time": self.updated_at,
+            "ip_addresses": self.ip_addresses,
+            "locations": self.merged_locations,
+        }
+
+class RouteMonitor:
+    """
+    Re-traces destinations on an interval and reports when their routes change.
+
+    The last enriched route of every destination is kept. A new trace is diffed against
+    it hop by hop, and only the addresses that weren't on the last route are geolocated
+    and matched to a facility, and only the adjacent pairs that weren't on it go through
+    the cable search. A trace with the same hops as the last one reuses its locations as
+    they are, so a stable route costs nothing but the traceroute itself.
+    """
+
+    def __init__(self, trace=get_route, max_destinations=MONITOR_MAX_DESTINATIONS, min_interval=MONITOR_MIN_INTERVAL):
+        """
+        Args:
+            trace (function): async function (host, hops) -> get_route output
+            max_destinations (int): most destinations to keep
+            min_interval (float): shortest time between two traces of a destination
+        """
+        self.trace = trace
+        self.max_destinations = max_destinations
+        self.min_interval = min_interval
+
+        # (host, hops) -> MonitoredRoute, least recently used first
+        self._destinations = OrderedDict()
+
+        self.counters = {"checks": 0, "changes": 0, "failed": 0, "hops_reused": 0, "hops_located": 0, "links_computed": 0}
+
+    def _destination(self, host, hops, create=True):
+        """
+        Gets the MonitoredRoute for a destination, making room for it if it's new
+        """
+        key = (host, hops)
+        if key in self._destinations:
+            self._destinations.move_to_end(key)
+            return self._destinations[key]
+        if not create:
+            return None
+
+        while len(self._destinations) >= self.max_destinations:
+            # forget the least recently used destination nobody is watching
+            idle = next((k for k, d in self._destinations.items() if not d.subscribers), None)
+            if idle is None:
+                raise RouteMonitorFullError()
+            del self._destinations[idle]
+
+        destination = self._destinations[key] = MonitoredRoute(host, hops)
+        return destination
+
+    async def check(self, host, hops):
+        """
+        Traces a destination once and updates its route
+
+        Returns:
+            (string, dict): the event for the trace:
+                route: MonitoredRoute.snapshot the first time the destination is traced
+                change: the snapshot plus {"changes": [{"hop", "from", "to"}, ...]} if the
+                    route changed
+                unchanged: {"host", "hops", "time"} if it didn't
+                error: {"host", "detail"} if no hop answered, the route is left as it was
+        """
+        destination = self._destination(host, hops)
+
+        # one trace of a destination at a time, so each is diffed against the one before
+        async with destination.lock:
+            route = await self.trace(host, hops)
+            return await self._update(destination, route)
+
+    async def _update(self, destination, route):
+        if not any(hop["ip"] for hop in route["hops"]):
+            # nothing to diff against, it'd look like every hop disappeared
+            self.counters["failed"] += 1
+            return ("error", {"host": destination.host, "detail": "traceroute found no hops"})
+
+        self.counters["checks"] += 1
+        now = time.time()
+
+        hop_ips = {hop["hop"]: hop["ip"] for hop in route["hops"]}
+        if destination.hop_ips is not None:
+            # a router that answered last time and not this time is most likely still
+            # there (routers often rate limit their replies), so it isn't a change
+            for ttl, ip in hop_ips.items():
+                if ip is None:
+                    hop_ips[ttl] = destination.hop_ips.get(ttl)
+
+        ip_addresses = [ip for _, ip in sorted(hop_ips.items()) if ip]
+        first = destination.hop_ips is None
+        changes = [] if first else _diff_hops(destination.hop_ips, hop_ips)
+
+        if not first and ip_addresses == destination.ip_addresses and all(ip in destination.locations for ip in ip_addresses):
+            # same route as before, its locations are already enriched (hops that failed to
+            # locate last time aren't, and are retried)
+            self.counters["hops_reused"] += len(ip_addresses)
+        else:
+            destination.merged_locations = await self._enrich(destination, ip_addresses)
+
+        destination.hop_ips = hop_ips
+        destination.ip_addresses = ip_addresses
+        destination.updated_at = now
+
+        if first:
+            destination.history.append((now, tuple((ttl, None, ip) for ttl, ip in sorted(hop_ips.items()) if ip)))
+            return ("route", destination.snapshot())
+
+        if not changes:
+            destination.unchanged += 1
+            return ("unchanged", {"host": destination.host, "hops": destination.hops, "time": now})
+
+        self.counters["changes"] += 1
+        destination.history.append((now, tuple((change["hop"], change["from"], change["to"]) for change in changes)))
+        destination.unchanged = 0
+        return ("change", {**destination.snapshot(), "changes": changes})
+
+    async def _enrich(self, destination, ip_addresses):
+        """
+        Locates a route, reusing whatever was already worked out for the last route
+
+        Returns:
+            list: merged frontend locations of the route
+        """
+        new_ips = [ip for ip in dict.fromkeys(ip_addresses) if ip not in destination.locations]
+        located = {ip: destination.locations[ip] for ip in ip_addresses if ip in destination.locations}
+        self.counters["hops_reused"] += len(ip_addresses) - len(new_ips)
+        if new_ips:
+            self.counters["hops_located"] += len(new_ips)
+            try:
+                located.update(await self._lookup(new_ips))
+            except Exception as e:
+                # the hops are left out of this route and looked up again next time
+                logger.error(f"[RouteMonitor._enrich]: failed to locate hops of {destination.host}: {e}")
+
+        # copies, since the cable and distance info filled in below belongs to this route only
+        locations = [
+            copy.copy(located[ip]) for ip in ip_addresses
+            if ip in located and not located[ip].is_private
+        ]
+
+        links = {}
+        for loc_A, loc_B in zip(locations, locations[1:]):
+            pair = (loc_A.ip, loc_B.ip)
+            link = destination.links.get(pair)
+            if link is None:
+                # copies start out without cable info, so whatever is set now is this pair's
+                populate_neighbor_information(loc_A, loc_B)
+                link = (loc_A.source_cable_info, loc_B.destination_cable_info, loc_B.distance_to)
+                self.counters["links_computed"] += 1
+            else:
+                source_cable, dest_cable, dist = link
+                if source_cable:
+                    loc_A.source_cable_info = source_cable
+                    loc_B.destination_cable_info = dest_cable
+                loc_A.set_distance_from(dist)
+                loc_B.set_distance_to(dist)
+            links[pair] = link
+
+        destination.locations = located
+        destination.links = links
+
+        frontend_form_locations = [loc.get_frontend_format() for loc in locations]
+        return merge_frontend_locations(frontend_form_locations)
+
+    async def _lookup(self, ips):
+        """
+        Geolocates a list of new addresses in one batch and finds their facilities
+
+        Returns:
+            dict: IP address -> IPLocation
+        """
+        ip_locations = await IPLocation.create_batch(ips)
+
+        public = [ip_location for ip_location in ip_locations if not ip_location.is_private]
+        results = await asyncio.gather(
+            *[ip_location.find_facility() for ip_location in public],
+            return_exceptions=True
+        )
+        for ip_location, result in zip(public, results):
+            # the location is still useful without a facility
+            if isinstance(result, Exception):
+                logger.error(f"[RouteMonitor._lookup]: failed to find facility for {ip_location.ip}: {result}")
+
+        return {ip_location.ip: ip_location for ip_location in ip_locations}
+
+    async def watch(self, host, hops, interval):
+        """
+        Monitors a destination for as long as the caller keeps iterating. Everyone
+        watching the same destination shares one trace loop, run at the shortest
+        interval any of them asked for
+
+        Args:
+            host (string): the address to monitor
+            hops (int): the maximum number of hops for each traceroute
+            interval (float): seconds between traces, at least min_interval
+
+        Yields:
+            (string, dict): (event name, event data) pairs: the events of check, plus
+                watching: {"host", "hops", "interval"} right away, with the interval the
+                    destination is traced at
+                error: {"host", "detail"} if a trace failed (it's retried next interval)
+                the current route is sent after watching if the destination was already traced
+
+        Raises:
+            RouteMonitorFullError: on the first iteration, if there's no room for a new destination
+        """
+        destination = self._destination(host, hops)
+        events = asyncio.Queue()
+        destination.subscribers[events] = max(interval, self.min_interval)
+        destination.interval = min(destination.subscribers.values())
+
+        try:
+            yield ("watching", {"host": host, "hops": hops, "interval": destination.interval})
+            if destination.merged_locations is not None:
+                yield ("route", destination.snapshot())
+            if destination.task is None:
+                destination.task = asyncio.create_task(self._run(destination))
+
+            while True:
+                yield await events.get()
+        finally:
+            del destination.subscribers[events]
+            if destination.subscribers:
+                # the shortest interval may have been this subscriber's
+                destination.interval = min(destination.subscribers.values())
+            else:
+                # nobody is watching anymore. the route and history are kept until the
+                # destination is evicted
+                destination.interval = None
+                if destination.task:
+                    destination.task.cancel()
+                    destination.task = None
+
+    async def _run(self, destination):
+        """
+        Trace loop of a watched destination
+        """
+        # monitoring runs in the background, so its lookups go behind interactive requests
+        request_priority.set(PRIORITY_BATCH)
+
+        while True:
+            try:
+                event = await self.check(destination.host, destination.hops)
+            except TracerouteBusyError:
+                self.counters["failed"] += 1
+                event = ("error", {"host": destination.host, "detail": "too many traceroutes in progress"})
+            except TracerouteFailedError:
+                self.counters["failed"] += 1
+                event = ("error", {"host": destination.host, "detail": "traceroute failed"})
+            except Exception as e:
+                logger.error(f"[RouteMonitor._run]: failed to trace {destination.host}: {e}")
+                self.counters["failed"] += 1
+                event = ("error", {"host": destination.host, "detail": "traceroute failed"})
+
+            for events in destination.subscribers:
+                events.put_nowait(event)
+
+            await asyncio.sleep(destination.interval)
+
+    def history(self, host, hops):
+        """
+        Gets a destination's route changes, oldest first. The first entry is the route as
+        it was first traced (or the oldest change still remembered)
+
+        Returns:
+            dict: {"host", "hops", "ip_addresses", "unchanged", "changes": [{"time",
+                "changes": [{"hop", "from", "to"}, ...]}, ...]}, or None if the destination
+                isn't known
+        """
+        destination = self._destination(host, hops, create=False)
+        if destination is None:
+            return None
+
+        return {
+            "host": host,
+            "hops": hops,
+            "ip_addresses": destination.ip_addresses,
+            "unchanged": destination.unchanged,
+            "changes": [
+                {"time": changed_at, "changes": [{"hop": ttl, "from": old, "to": new} for ttl, old, new in changes]}
+                for changed_at, changes in destination.history
+            ],
+        }
+
+    def stats(self):
+        return {
+            **self.counters,
+            "destinations": len(self._destinations),
+            "watched": sum(1 for destination in self._destinations.values() if destination.subscribers),
+        }
+
+def _diff_hops(old, new):
+    """
+    Compares two routes hop by hop
+
+    Args:
+        old (dict): ttl -> IP address of the earlier route
+        new (dict): ttl -> IP address of the later route
+
+    Returns:
+        list: {"hop", "from", "to"} for every hop whose address changed, in hop order
+    """
+    return [
+        {"hop": ttl, "from": old.get(ttl), "to": new.get(ttl)}
+        for ttl in sorted(old.keys() | new.keys())
+        if old.get(ttl) != new.get(ttl)
+    ]
@@ -0,0 +1,265 @@
+import os
+import asyncio
+from dotenv import load_dotenv
+from traceroute import stream_route
+from ip_location import IPLocation, IP_API_BATCH_SIZE
+from location_operations import merge_frontend_locations, populate_neighbor_information
+from logging_config import get_logger
+
+logger = get_logger()
+load_dotenv()
+
+# how many geolocation batches can be in flight at once, and how many hops can be in the
+# facility stage at once
+GEO_CONCURRENCY = int(os.environ.get("PIPELINE_GEO_CONCURRENCY", 8))
+FACILITY_CONCURRENCY = int(os.environ.get("PIPELINE_FACILITY_CONCURRENCY", 8))
+
+# seconds the geolocation stage waits for more hops to put in the same batch request.
+# the traceroute prints answering hops in quick bursts, so this groups a route into a
+# few batches instead of spending ip-api's 45/min single lookup limit on every hop
+GEO_BATCH_WINDOW = float(os.environ.get("PIPELINE_GEO_BATCH_WINDOW", 0.5))
+
+class RoutePipeline:
+    """
+    Traces a route and enriches it as an asyncio pipeline.
+
+    Every hop moves through traceroute -> geolocate -> facility -> neighbor cable as soon
+    as its own inputs are ready, with a queue per stage. A slow hop only holds up the
+    hops that depend on it (the cable stage has to go in route order), not every other
+    hop in the same stage. Hops that are known locally or cached are geolocated right
+    away, the rest are grouped into batch requests as they arrive.
+    """
+
+    def __init__(self, host, hops, geo_concurrency=GEO_CONCURRENCY, facility_concurrency=FACILITY_CONCURRENCY,
+                 geo_batch_window=GEO_BATCH_WINDOW):
+        """
+        Args:
+            host (string): the address to run the traceroute on
+            hops (int): the maximum number of hops for the traceroute
+            geo_concurrency (int): most geolocation batch requests in flight
+            facility_concurrency (int): number of facility lookup workers
+            geo_batch_window (float): seconds to wait for more hops before sending a
+                geolocation batch
+        """
+        self.host = host
+        self.hops = hops
+        self.geo_concurrency = geo_concurrency
+        self.facility_concurrency = facility_concurrency
+        self.geo_batch_window = geo_batch_window
+
+        # raw hops from the traceroute, in order
+        self.route = []
+
+        # non-private locations in route order, filled in by the cable stage
+        self.locations = []
+
+        # merged frontend locations, set once the pipeline finishes
+        self.merged_locations = None
+
+    async def run(self):
+        """
+        Runs the pipeline
+
+        Yields:
+            (string, dict): (event name, event data) pairs:
+                hop: {"hop", "ip", "rtt"} as soon as the traceroute prints a hop
+                location: {"index", "location"} once a hop is geolocated and matched to a facility
+                link: {"from", "to", "source_cable", "dest_cable", "distance"} once two
+                    adjacent locations (by location index) are ready and their cable/distance
+                    info is computed
+                route: {"locations"} merged frontend locations once everything is finished
+        """
+        events = asyncio.Queue()
+        geo_queue = asyncio.Queue()
+        facility_queue = asyncio.Queue()
+        cable_queue = asyncio.Queue()
+
+        workers = [
+            asyncio.create_task(self._geo_stage(geo_queue, facility_queue, cable_queue)),
+            *[asyncio.create_task(self._facility_worker(facility_queue, cable_queue, events)) for _ in range(self.facility_concurrency)],
+        ]
+        cable_stage = asyncio.create_task(self._cable_stage(cable_queue, events))
+
+        async def supervise():
+            try:
+                await self._trace(geo_queue, events)
+
+                # no more hops are coming, send whatever is waiting for a batch
+                await geo_queue.put(None)
+
+                # wait for every hop to drain through the enrichment stages, then let the
+                # cable stage finish off the route
+                await geo_queue.join()
+                await facility_queue.join()
+                await cable_queue.put(None)
+                await cable_stage
+            finally:
+                await events.put(None)
+
+        supervisor = asyncio.create_task(supervise())
+        try:
+            while (event := await events.get()) is not None:
+                yield event
+
+            # surface errors from the traceroute (TracerouteBusyError, TracerouteFailedError)
+            await supervisor
+        finally:
+            for task in [supervisor, cable_stage, *workers]:
+                task.cancel()
+
+    async def _trace(self, geo_queue, events):
+        """
+        Traceroute stage. Hands every responding hop to the geolocation stage right away
+        """
+        index = 0
+        async for hop in stream_route(self.host, self.hops):
+            self.route.append(hop)
+            await events.put(("hop", hop))
+
+            if hop["ip"]:
+                await geo_queue.put((index, hop["ip"]))
+                index += 1
+
+    async def _geo_stage(self, geo_queue, facility_queue, cable_queue):
+        """
+        Geolocation stage. Hops known locally or cached move on right away. The rest wait
+        up to geo_batch_window for more hops and are located together in one batch
+        request, sent when the window closes, the batch is full or the trace is over
+        (a None on geo_queue)
+        """
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.geo_concurrency)
+        batches = set()
+        batch = []
+        deadline = None
+
+        try:
+            while True:
+                window_closed = False
+                try:
+                    item = await asyncio.wait_for(geo_queue.get(), deadline - loop.time() if batch else None)
+                except asyncio.TimeoutError:
+                    item, window_closed = None, True
+
+                if item is not None:
+                    index, ip = item
+                    try:
+                        location = IPLocation.create_known(ip)
+                    except Exception as e:
+                        logger.error(f"[RoutePipeline._geo_stage]: failed to geolocate {ip}: {e}")
+                        await cable_queue.put((index, None))
+                        geo_queue.task_done()
+                        continue
+
+                    if location is None:
+                        if not batch:
+                            deadline = loop.time() + self.geo_batch_window
+                        batch.append((index, IPLocation(ip)))
+                    else:
+                        await self._geolocated(index, location, facility_queue, cable_queue)
+                        geo_queue.task_done()
+
+                if batch and (item is None or len(batch) >= IP_API_BATCH_SIZE):
+                    await slots.acquire()
+                    task = asyncio.create_task(self._geo_batch(batch, slots, geo_queue, facility_queue, cable_queue))
+                    batches.add(task)
+                    task.add_done_callback(batches.discard)
+                    batch = []
+
+                if item is None and not window_closed:
+                    geo_queue.task_done()
+        finally:
+            for task in batches:
+                task.cancel()
+
+    async def _geo_batch(self, batch, slots, geo_queue, facility_queue, cable_queue):
+        """
+        Locates a batch of (index, IPLocation) hops in one request and passes them on
+        """
+        located = True
+        try:
+            await IPLocation.locate_batch([location for _, location in batch])
+        except Exception as e:
+            logger.error(f"[RoutePipeline._geo_batch]: failed to geolocate {len(batch)} hops: {e}")
+            located = False
+        finally:
+            slots.release()
+
+        for index, location in batch:
+            try:
+                if located:
+                    await self._geolocated(index, location, facility_queue, cable_queue)
+                else:
+                    await cable_queue.put((index, None))
+            finally:
+                geo_queue.task_done()
+
+    @staticmethod
+    async def _geolocated(index, location, facility_queue, cable_queue):
+        """
+        Passes a geolocated hop on. Private addresses skip straight to the cable stage so
+        it knows not to wait on them
+        """
+        if location.is_private:
+            await cable_queue.put((index, None))
+        else:
+            await facility_queue.put((index, location))
+
+    async def _facility_worker(self, facility_queue, cable_queue, events):
+        """
+        Facility stage
+        """
+        while True:
+            index, location = await facility_queue.get()
+            try:
+                await location.find_facility()
+            except Exception as e:
+                # the location is still useful without a facility
+                logger.error(f"[RoutePipeline._facility_worker]: failed to find facility for {location.ip}: {e}")
+            finally:
+                await events.put(("location", {"index": index, "location": location.get_frontend_format()}))
+                await cable_queue.put((index, location))
+                facility_queue.task_done()
+
+    async def _cable_stage(self, cable_queue, events):
+        """
+        Neighbor cable stage. Hops can finish the earlier stages out of order, so hold on
+        to them until every hop before them is done, then pair each location with the
+        previous non-private one
+        """
+        finished = {}
+        next_index = 0
+        previous = None
+        previous_index = None
+
+        while (item := await cable_queue.get()) is not None:
+            index, location = item
+            finished[index] = location
+
+            while next_index in finished:
+                index = next_index
+                location = finished.pop(index)
+                next_index += 1
+
+                # private or failed hop, nothing to pair
+                if location is None:
+                    continue
+
+                if previous:
+                    populate_neighbor_information(previous, location)
+                    await events.put(("link", {
+                        "from": previous_index,
+                        "to": index,
+                        "source_cable": previous.source_cable_info,
+                        "dest_cable": location.destination_cable_info,
+                        "distance": location.distance_to,
+                    }))
+
+                self.locations.append(location)
+                previous = location
+                previous_index = index
+
+        # convert locations to frontend format, merge duplicate locations and send them off
+        frontend_form_locations = [loc.get_frontend_format() for loc in self.locations]
+        self.merged_locations = merge_frontend_locations(frontend_form_locations)
+        await events.put(("route", {"locations": self.merged_locations}))
@@ -0,0 +1,280 @@
+import math
+import numpy as np
+from itertools import product
+from geo_math import EARTH_RADIUS_KM
+
+def _to_unit_sphere(lat, lon):
+    """
+    Converts a latitude/longitude pair (degrees) to a point on the unit sphere
+
+    Inputs:
+        lat (float): latitude in degrees
+        lon (float): longitude in degrees
+
+    Outputs:
+        (float, float, float): x, y, z coordinates of the point on the unit sphere
+    """
+    lat_r = math.radians(lat)
+    lon_r = math.radians(lon)
+    cos_lat = math.cos(lat_r)
+    return (cos_lat * math.cos(lon_r), cos_lat * math.sin(lon_r), math.sin(lat_r))
+
+class EndpointGrid:
+    """
+    Uniform voxel grid over unit-sphere coordinates of cable endpoints.
+
+    Points are bucketed by their 3D position on the unit sphere instead of by lat/lon,
+    so cells don't get squashed near the poles and there's no special casing for the
+    antimeridian. A great-circle radius maps to a straight-line (chord) radius, which
+    is all we need to pick the cells to look in.
+    """
+
+    def __init__(self, points, cell_km=100):
+        """
+        Inputs:
+            points (iterable): (lat, lon, value) tuples. value is what gets returned by
+                queries (for the cable mapper this is the position of the cable)
+            cell_km (float): approximate edge length of a grid cell in km
+        """
+        self.cell = cell_km / EARTH_RADIUS_KM
+        self.cells = {}
+        self.values = set()
+
+        # neighbor cell offsets for each search reach, built on first use
+        self._neighborhoods = {}
+
+        for lat, lon, value in points:
+            self.cells.setdefault(self._key(_to_unit_sphere(lat, lon)), set()).add(value)
+            self.values.add(value)
+
+    def _key(self, xyz):
+        return tuple(math.floor(c / self.cell) for c in xyz)
+
+    def query(self, lat, lon, radius_km):
+        """
+        Gets every value with at least one point within radius_km of (lat, lon)
+
+        NOTE: this can return a few extra values whose points are just outside of the
+        radius (anything that shares a cell with the search ball). It never misses one,
+        so callers that need exact distances should still compute them.
+
+        Inputs:
+            lat (float): latitude of the search center
+            lon (float): longitude of the search center
+            radius_km (float): great-circle search radius in km
+
+        Outputs:
+            set: values with a point inside the search ball
+        """
+        # the search ball covers (almost) the whole sphere, no point in walking cells
+        if radius_km >= EARTH_RADIUS_KM:
+            return set(self.values)
+
+        # convert great-circle distance to a chord on the unit sphere. pad it slightly so
+        # floating point error can never drop a point sitting right on the boundary
+        chord = 2 * math.sin(radius_km / (2 * EARTH_RADIUS_KM)) * 1.0001 + 1e-12
+        reach = math.ceil(chord / self.cell)
+
+        # a huge radius would have us looping over a lot of empty cells
+        if (2 * reach + 1) ** 3 > len(self.cells):
+            return set(self.values)
+
+        if reach not in self._neighborhoods:
+            self._neighborhoods[reach] = list(product(range(-reach, reach + 1), repeat=3))
+
+        cx, cy, cz = self._key(_to_unit_sphere(lat, lon))
+        found = set()
+        for ox, oy, oz in self._neighborhoods[reach]:
+            bucket = self.cells.get((cx + ox, cy + oy, cz + oz))
+            if bucket:
+                found |= bucket
+
+        return found
+
+def _str_order(centers, fanout):
+    """
+    Sort-Tile-Recursive ordering: sorts boxes into slabs along x, each slab into slabs
+    along y, and so on, so runs of fanout consecutive boxes are spatially close
+
+    Inputs:
+        centers (np.ndarray): box centers, shape (n, dims)
+        fanout (int): boxes per leaf node
+
+    Outputs:
+        np.ndarray: permutation of the boxes
+    """
+    dims = centers.shape[1]
+
+    def pack(idx, dim):
+        idx = idx[np.argsort(centers[idx, dim], kind="stable")]
+        if dim == dims - 1 or len(idx) <= fanout:
+            return idx
+
+        leaves = math.ceil(len(idx) / fanout)
+        slabs = math.ceil(leaves ** (1 / (dims - dim)))
+        slab_size = fanout * math.ceil(leaves / slabs)
+        return np.concatenate([pack(idx[i:i + slab_size], dim + 1) for i in range(0, len(idx), slab_size)])
+
+    return pack(np.arange(len(centers)), 0)
+
+class SegmentRTree:
+    """
+    Static R-tree over 3D bounding boxes, packed with Sort-Tile-Recursive.
+
+    The cable mapper stores a box per cable segment in unit-sphere coordinates, so like
+    EndpointGrid there's no special casing for the poles or the antimeridian. Every
+    level of the tree is a pair of numpy arrays and the children of node i are entries
+    [i * fanout, (i + 1) * fanout) of the level below, so a query walks the tree one
+    whole level at a time instead of one node at a time. Levels are padded to a multiple
+    of fanout with empty boxes so every node has exactly fanout children.
+    """
+
+    # levels this small are cheaper to scan outright than to descend into from above
+    SCAN_SIZE = 1024
+
+    def __init__(self, mins, maxs, fanout=32):
+        """
+        Inputs:
+            mins (np.ndarray): lower corner of each box, shape (n, 3)
+            maxs (np.ndarray): upper corner of each box, shape (n, 3)
+            fanout (int): children per node
+        """
+        self.fanout = fanout
+        self._children = np.arange(fanout)
+
+        # box position in the packed leaf level -> index of the box the caller gave us
+        order = _str_order((mins + maxs) / 2, fanout)
+        self.order = np.pad(order, (0, -len(order) % fanout))
+
+        # levels from the leaves up to the root, each (mins, maxs)
+        self.levels = [self._padded(mins[order], maxs[order])]
+        while len(self.levels[-1][0]) > fanout:
+            child_mins, child_maxs = self.levels[-1]
+            self.levels.append(self._padded(
+                child_mins.reshape(-1, fanout, 3).min(axis=1),
+                child_maxs.reshape(-1, fanout, 3).max(axis=1),
+            ))
+
+        # start queries from the biggest level that's still cheap to scan outright
+        self._start = len(self.levels) - 1
+        while self._start > 0 and len(self.levels[self._start - 1][0]) <= self.SCAN_SIZE:
+            self._start -= 1
+
+    def _padded(self, mins, maxs):
+        """
+        Pads a level with empty boxes (they never intersect anything) up to a multiple of fanout
+        """
+        pad = -len(mins) % self.fanout
+        return (
+            np.concatenate((mins, np.full((pad, 3), np.inf))),
+            np.concatenate((maxs, np.full((pad, 3), -np.inf))),
+        )
+
+    @staticmethod
+    def _in_ball(mins, maxs, center, radius):
+        """
+        Checks which boxes intersect a ball
+        """
+        # distance from the center to each box along each axis (0 if inside the box's span)
+        gap = np.maximum(mins - center, center - maxs)
+        np.maximum(gap, 0, out=gap)
+        return np.einsum("ij,ij->i", gap, gap) <= radius * radius
+
+    def query_ball(self, center, radius):
+        """
+        Gets every box within radius of a point
+
+        Inputs:
+            center (np.ndarray): the point, shape (3,)
+            radius (float): straight-line search radius
+
+        Outputs:
+            np.ndarray: sorted indices of the boxes that intersect the search ball
+        """
+        mins, maxs = self.levels[self._start]
+        nodes = np.flatnonzero(self._in_ball(mins, maxs, center, radius))
+
+        for depth in range(self._start - 1, -1, -1):
+            if not len(nodes):
+                break
+
+            # expand every hit into its children on the level below
+            nodes = (nodes[:, np.newaxis] * self.fanout + self._children).ravel()
+            mins, maxs = self.levels[depth]
+            nodes = nodes[self._in_ball(mins[nodes], maxs[nodes], center, radius)]
+
+        return np.sort(self.order[nodes])
+
+class PointKDTree:
+    """
+    k-d tree over 3D points for nearest neighbor queries.
+
+    Like the other indexes here it's meant for unit-sphere coordinates: the nearest point
+    by straight-line distance is also the nearest by great-circle distance. Ties go to
+    the point that was passed in first, so results don't depend on how the tree splits.
+    """
+
+    def __init__(self, points):
+        """
+        Inputs:
+            points (np.ndarray): the points, shape (n, 3)
+        """
+        self.points = np.asarray(points, dtype=np.float64).tolist()
+
+        # (point index, split axis, left child, right child), -1 for a missing child
+        self._nodes = []
+        self._root = self._build(list(range(len(self.points))), 0)
+
+    def _build(self, idx, depth):
+        if not idx:
+            return -1
+
+        axis = depth % 3
+        idx.sort(key=lambda i: (self.points[i][axis], i))
+        mid = len(idx) // 2
+
+        node = len(self._nodes)
+        self._nodes.append(None)
+        left = self._build(idx[:mid], depth + 1)
+        right = self._build(idx[mid + 1:], depth + 1)
+        self._nodes[node] = (idx[mid], axis, left, right)
+        return node
+
+    def nearest(self, point):
+        """
+        Finds the point nearest to a given point
+
+        Inputs:
+            point (sequence): x, y, z of the query point
+
+        Outputs:
+            (int, float): index of the nearest point (-1 if the tree is empty) and its
+                straight-line distance from the query point
+        """
+        x, y, z = point
+        query = (x, y, z)
+        best_dist, best = math.inf, -1
+
+        # (node, squared distance from the query to the node's side of its parent's split)
+        stack = [(self._root, 0.0)]
+        while stack:
+            node, bound = stack.pop()
+
+            # everything under this node is further away than the best point so far
+            if node < 0 or bound > best_dist:
+                continue
+
+            i, axis, left, right = self._nodes[node]
+            px, py, pz = self.points[i]
+            dist = (px - x) ** 2 + (py - y) ** 2 + (pz - z) ** 2
+            if dist < best_dist or (dist == best_dist and i < best):
+                best_dist, best = dist, i
+
+            # look at the query's side of the split first. the other side is at least as
+            # far away as the splitting plane
+            diff = query[axis] - self.points[i][axis]
+            near, far = (left, right) if diff < 0 else (right, left)
+            stack.append((far, diff * diff))
+            stack.append((near, bound))
+
+        return best, math.sqrt(best_dist)
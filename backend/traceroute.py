@@ -1,11 +1,82 @@
+import os
 import sys
-import re
+import time
+import shlex
+import asyncio
 import subprocess
+from contextlib import asynccontextmanager
+from dotenv import load_dotenv
 from logging_config import get_logger
+from metrics import timed, traceroute_wait, traceroute_run
+from raw_tracer import RawSocketTracer, raw_sockets_available
+from traceroute_parser import Hop, detect_format, parse_hop_line, parse_traceroute
 
 logger = get_logger()
+load_dotenv()
+
+# traceroute engine: "tcptraceroute" shells out to sudo tcptraceroute (tracert on windows),
+# "raw" uses the in-process raw socket tracer (linux, needs root or CAP_NET_RAW)
+TRACE_ENGINE = os.environ.get("TRACEROUTE_ENGINE", "tcptraceroute")
+if TRACE_ENGINE == "raw" and not raw_sockets_available():
+    # every raw trace would fail, tcptraceroute (through sudo) still works
+    logger.warning("TRACEROUTE_ENGINE=raw but this process can't open raw sockets, using tcptraceroute instead")
+    TRACE_ENGINE = "tcptraceroute"
+
+# command the tcptraceroute engine runs, before its arguments. benchmarks point this at
+# a fake tracer (benchmarks/fake_tcptraceroute.py) that replays recorded outputs
+TRACE_COMMAND = shlex.split(os.environ.get("TRACEROUTE_COMMAND", "sudo tcptraceroute"))
+
+# most traceroutes allowed to run at once. the rest wait in line for a slot
+MAX_CONCURRENT_TRACES = int(os.environ.get("TRACEROUTE_CONCURRENCY", 4))
+
+# most traceroutes allowed to wait for a slot before new ones are turned away
+MAX_QUEUED_TRACES = int(os.environ.get("TRACEROUTE_QUEUE_SIZE", 32))
+
+# extra seconds on top of the 1 second per hop probe wait before a traceroute is killed
+TRACE_TIMEOUT_SLACK = float(os.environ.get("TRACEROUTE_TIMEOUT_SLACK", 5))
+
+# seconds to wait for a traceroute to exit after asking it to stop before killing it
+TRACE_KILL_GRACE = 1
+
+_trace_slots = asyncio.Semaphore(MAX_CONCURRENT_TRACES)
+
+# queue and timing metrics for traceroute subprocesses
+_trace_stats = {
+    "running": 0,
+    "queued": 0,
+    "max_queued": 0,
+    "completed": 0,
+    "failed": 0,
+    "timed_out": 0,
+    "rejected": 0,
+    "total_wait_s": 0.0,
+    "max_wait_s": 0.0,
+    "total_run_s": 0.0,
+}
+
+class TracerouteBusyError(Exception):
+    """
+    Raised when too many traceroutes are already waiting for a slot
+    """
+
+class TracerouteFailedError(Exception):
+    """
+    Raised when a traceroute times out, exits with an error or can't be run at all
+    """
 
-def get_route(host, hops=50):
+def get_traceroute_stats():
+    """
+    Returns a snapshot of the traceroute queue and timing metrics
+    """
+    finished = _trace_stats["completed"] + _trace_stats["failed"] + _trace_stats["timed_out"]
+    return {
+        **_trace_stats,
+        "avg_wait_s": _trace_stats["total_wait_s"] / finished if finished else 0.0,
+        "avg_run_s": _trace_stats["total_run_s"] / finished if finished else 0.0,
+    }
+
+@timed("traceroute")
+async def get_route(host, hops=50):
     """
     Gets the list of IP addresses visited on a traceroute to a given host
 
@@ -14,23 +85,162 @@ def get_route(host, hops=50):
         hops (int): the maximum number of hops for the traceroute
 
     Returns:
-        list: List of IP addresses logged to stdout after running traceroute
+        dict:
+            ip_addresses: IP addresses of the hops that answered, in hop order
+            time_info: see _summarize_hang_times (the round trip times come from
+                traceroute_parser.parse_traceroute)
+            hops: Hop.to_dict of every hop, including the ones that timed out
+
+    Raises:
+        TracerouteBusyError: if too many traceroutes are waiting for a slot
+        TracerouteFailedError: if the traceroute timed out, failed or found no hops
     """
 
-    # get the traceroute command for the given host
-    trace_cmd = _get_traceroute_cmd(host, hops)
+    if TRACE_ENGINE == "raw":
+        hop_list = await _raw_trace(host, hops)
+    else:
+        # get the traceroute command for the given host
+        trace_cmd = _get_traceroute_cmd(host, hops)
 
-    # get the results of the traceroute
-    trace_result = _execute_traceroute(trace_cmd)
+        # get the results of the traceroute. every probe waits up to 1 second, so give the
+        # whole trace that long plus some slack before killing it
+        trace_result = await _execute_traceroute(trace_cmd, timeout=hops + TRACE_TIMEOUT_SLACK)
 
-    # parse IPs from results of traceroute
-    ip_addresses = _parse_ip_addresses(trace_result)
+        # parse every hop out of the results in one pass
+        hop_list = _parse_hops(trace_result)
 
-    # parse timing info from results of traceroute
-    hang_times = _get_hang_times(trace_result)
+    # a trace that ran but printed no hops isn't a route, don't let it be cached as one
+    if not hop_list:
+        raise TracerouteFailedError("traceroute found no hops")
 
     # return ip addresses and timing info
-    return {"ip_addresses": ip_addresses, "time_info": hang_times}
+    return {
+        "ip_addresses": [hop.ip for hop in hop_list if hop.ip],
+        "time_info": _summarize_hang_times([hop.rtt for hop in hop_list if hop.rtt is not None]),
+        "hops": [hop.to_dict() for hop in hop_list],
+    }
+
+async def stream_route(host, hops=50):
+    """
+    Runs a traceroute and yields each hop as soon as the traceroute prints it, instead
+    of waiting for the whole traceroute to finish
+
+    Args:
+        host (string): the address to run the traceroute on
+        hops (int): the maximum number of hops for the traceroute
+
+    Yields:
+        dict: Hop.to_dict of each hop (hop number, IP address or None if the hop timed
+            out, first round trip time in ms, every probe's round trip time, marker)
+
+    Raises:
+        TracerouteBusyError: if too many traceroutes are waiting for a slot
+        TracerouteFailedError: if the traceroute timed out or failed, after the hops it
+            found before that, or if it found no hops at all
+    """
+    if TRACE_ENGINE == "raw":
+        # the raw tracer probes every hop at once, so they all come back together
+        hop_list = await _raw_trace(host, hops)
+        if not hop_list:
+            raise TracerouteFailedError("traceroute found no hops")
+        for hop in hop_list:
+            yield hop.to_dict()
+        return
+
+    trace_cmd = _get_traceroute_cmd(host, hops)
+
+    async with _trace_slot():
+        started_at = time.monotonic()
+        deadline = started_at + hops + TRACE_TIMEOUT_SLACK
+
+        proc = await asyncio.create_subprocess_exec(
+            *trace_cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+
+        found_hops = False
+        try:
+            fmt = None
+            while True:
+                # read stdout line by line, every hop gets its own line
+                line = await asyncio.wait_for(proc.stdout.readline(), deadline - time.monotonic())
+                if not line:
+                    break
+                line = line.decode('utf-8')
+
+                # the banner tells us which fast path to use for the rest of the lines
+                if fmt is None:
+                    fmt, _ = detect_format(line)
+                    if fmt:
+                        continue
+
+                hop = _parse_hop_line(line, fmt)
+                if hop:
+                    found_hops = True
+                    yield hop
+
+            await proc.wait()
+        except asyncio.TimeoutError:
+            _trace_stats["timed_out"] += 1
+            logger.error(f"Traceroute subprocess timed out after {hops + TRACE_TIMEOUT_SLACK}s")
+            raise TracerouteFailedError(f"traceroute timed out after {hops + TRACE_TIMEOUT_SLACK}s")
+        finally:
+            # also runs if the client disconnects and the generator gets closed
+            await _stop_process(proc)
+            _trace_stats["total_run_s"] += time.monotonic() - started_at
+
+        if proc.returncode != 0:
+            _trace_stats["failed"] += 1
+            logger.error(f"Traceroute subprocess failed with return code {proc.returncode}")
+            raise TracerouteFailedError(f"traceroute exited with status {proc.returncode}")
+        _trace_stats["completed"] += 1
+        if not found_hops:
+            raise TracerouteFailedError("traceroute found no hops")
+
+async def _raw_trace(host, hops):
+    """
+    Runs the raw socket tracer in one of the traceroute slots
+
+    Returns:
+        list: Hop for each hop from RawSocketTracer.trace
+
+    Raises:
+        TracerouteFailedError: if the tracer couldn't run
+    """
+    async with _trace_slot():
+        started_at = time.monotonic()
+        try:
+            hop_list = await RawSocketTracer().trace(host, hops)
+        except OSError as e:
+            # e.g. no permission to open raw sockets, or the host doesn't resolve
+            _trace_stats["failed"] += 1
+            logger.error(f"Raw socket traceroute failed with error {e}")
+            raise TracerouteFailedError(f"raw socket traceroute failed: {e}") from e
+        finally:
+            _trace_stats["total_run_s"] += time.monotonic() - started_at
+
+        _trace_stats["completed"] += 1
+        return [
+            Hop(hop["hop"], hop["ip"], rtts=[hop["rtt"]], marker=hop["marker"])
+            for hop in hop_list
+        ]
+
+def _parse_hop_line(line, fmt=None):
+    """
+    Parses a single line of traceroute output
+
+    Input:
+        line (string): line of traceroute stdout
+        fmt (string): output format from traceroute_parser.detect_format, if known
+
+    Output:
+        dict: Hop.to_dict of the hop (hop number, IP address or None if the hop timed
+            out, first round trip time in ms, every probe's round trip time, open/closed
+            marker), or None if the line isn't a hop
+    """
+    hop = parse_hop_line(line, fmt)
+    return hop.to_dict() if hop else None
 
 def _get_traceroute_cmd(host, hops):
     """
@@ -47,94 +257,156 @@ def _get_traceroute_cmd(host, hops):
     if (sys.platform == "win32"):
         return ["tracert", "-h", f"{hops}", "-w", "1", host]
     else:
-        return ["sudo", "tcptraceroute", "-m", f"{hops}", "-q", "1", "-w", "1", host, "443"]
+        return [*TRACE_COMMAND, "-m", f"{hops}", "-q", "1", "-w", "1", host, "443"]
+
+@asynccontextmanager
+async def _trace_slot():
+    """
+    Waits for one of the MAX_CONCURRENT_TRACES slots and holds it while a traceroute runs
+
+    Raises:
+        TracerouteBusyError: if MAX_QUEUED_TRACES traceroutes are already waiting
+    """
+    if _trace_slots.locked() and _trace_stats["queued"] >= MAX_QUEUED_TRACES:
+        _trace_stats["rejected"] += 1
+        raise TracerouteBusyError("too many traceroutes in progress")
+
+    _trace_stats["queued"] += 1
+    _trace_stats["max_queued"] = max(_trace_stats["max_queued"], _trace_stats["queued"])
+    enqueued_at = time.monotonic()
+    try:
+        await _trace_slots.acquire()
+    finally:
+        _trace_stats["queued"] -= 1
+
+    wait = time.monotonic() - enqueued_at
+    _trace_stats["total_wait_s"] += wait
+    _trace_stats["max_wait_s"] = max(_trace_stats["max_wait_s"], wait)
+    traceroute_wait.observe(wait, TRACE_ENGINE)
 
-def _execute_traceroute(cmd):
+    _trace_stats["running"] += 1
+    started_at = time.monotonic()
+    try:
+        yield
+    finally:
+        _trace_stats["running"] -= 1
+        _trace_slots.release()
+        traceroute_run.observe(time.monotonic() - started_at, TRACE_ENGINE)
+
+async def _stop_process(proc):
     """
-    Executes the traceroute command and returns the result
+    Stops a running traceroute. sudo passes SIGTERM on to tcptraceroute but can't pass
+    on SIGKILL, so ask nicely first and only kill it if it doesn't exit
     """
+    if proc.returncode is not None:
+        return
 
+    proc.terminate()
     try:
-        # try to run the subprocess
-        res = subprocess.run(cmd, capture_output=True, check=True)
+        await asyncio.wait_for(proc.wait(), TRACE_KILL_GRACE)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+
+async def _execute_traceroute(cmd, timeout):
+    """
+    Executes the traceroute command and returns the result. Waits in line if
+    MAX_CONCURRENT_TRACES traceroutes are already running, and kills the traceroute
+    if it takes longer than timeout
+
+    Args:
+        cmd (array): traceroute command
+        timeout (float): seconds to let the traceroute run
+
+    Returns:
+        subprocess.CompletedProcess: the result
+
+    Raises:
+        TracerouteFailedError: if the traceroute timed out or exited with an error
+    """
+    async with _trace_slot():
+        started_at = time.monotonic()
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+        except asyncio.TimeoutError:
+            # the traceroute ran too long, kill it instead of holding the slot forever
+            await _stop_process(proc)
+            _trace_stats["timed_out"] += 1
+            _trace_stats["total_run_s"] += time.monotonic() - started_at
+            logger.error(f"Traceroute subprocess timed out after {timeout}s")
+            raise TracerouteFailedError(f"traceroute timed out after {timeout}s")
+        except asyncio.CancelledError:
+            # the request went away, don't leave the traceroute running
+            await _stop_process(proc)
+            raise
+
+        _trace_stats["total_run_s"] += time.monotonic() - started_at
+        res = subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+
+        if proc.returncode != 0:
+            _trace_stats["failed"] += 1
+            logger.error(f"Traceroute subprocess failed with return code {proc.returncode}: {stderr!r}")
+            raise TracerouteFailedError(f"traceroute exited with status {proc.returncode}")
+
+        _trace_stats["completed"] += 1
         logger.debug(f"[Route._execute_traceroute]: Got {res=} from subprocess")
         return res
-    except subprocess.CalledProcessError as e:
-        # catch subprocess errors and log them instead of breaking
-        logger.error(f"Traceroute subprocess failed with error {e}")
 
-def _parse_ip_addresses(result: subprocess.CompletedProcess):
+def _parse_hops(result: subprocess.CompletedProcess):
     """
-    Parses the result of a traceroute command
+    Parses the result of a traceroute command into hops
 
     Input:
         result (subprocess.CompletedProcess): The raw
             result of a traceroute command
 
     Output:
-        List: List of IP addresses visited during the
-            traceroute
+        List: Hop for every hop of the traceroute, in order
     """
 
     # handle the empty stdout case gracefully
     if (not result.stdout):
-        logger.error(f"No traceroute stdout to parse IP addresses from")
+        logger.error(f"No traceroute stdout to parse hops from")
         return []
 
     # decode stdout bytes string to normal string
     trace_output = result.stdout.decode('utf-8')
 
-    # create regex to match IP addresses inside parenthises
-    # ip_reg = re.compile(r'\([0-9\.]+\)')
-    ip_reg = re.compile(r'(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})')
-
-    # get all IP addresses inside parenthises, then strip parens
-    # ip_addresses = [ip.strip('()') for ip in ip_reg.findall(trace_output)]
-    ip_addresses = [ip for ip in ip_reg.findall(trace_output)]
-
-    # return list of IP addresses
-    return ip_addresses
+    return parse_traceroute(trace_output)
 
-def _get_hang_times(result: subprocess.CompletedProcess):
+def _summarize_hang_times(hang_times):
     """
-    Extract connection times for traceroute call
+    Summarizes the connection times of a traceroute
 
     Input:
-        result (subprocess.CompletedProcess): The raw
-            result of a traceroute command
+        hang_times (list): round trip times in ms, in hop order
 
     Output:
         dict:
             longest_diff: longest time between pings
             total_time: time elapsed between start and completion of command
+        both times are 0 if there were no round trip times at all
     """
 
-    # handle the empty stdout case gracefully
-    if (not result.stdout):
-        logger.error(f"No traceroute stdout to parse IP addresses from")
-        return []
-
-    # decode stdout bytes string to normal string
-    trace_output = result.stdout.decode('utf-8')
-
-    # regex extracts numbers ending with " ms"
-    hang_time_reg = re.compile(r'(\d+\.?\d*)\s*ms')
-
-    # convert each matching string to float
-    hang_times = [float(x) for x in hang_time_reg.findall(trace_output)]
-
-    # find longest hang time (longest time between calls)
-    longest_difference = float("-inf")
+    # find longest hang time (longest time between calls). a single hop has no
+    # time between calls
+    longest_difference = 0.0
     for i in range(len(hang_times) - 1):
         ht_A = hang_times[i]
         ht_B = hang_times[i + 1]
 
         diff = ht_B - ht_A
-        if diff > longest_difference:
+        if i == 0 or diff > longest_difference:
             longest_difference = diff
 
     # traceroute records time elapsed since running the command, so the last
-    # hang time is the total connection time
-    total_connection_time = hang_times[-1]
+    # hang time is the total connection time (nothing matched means nothing ran)
+    total_connection_time = hang_times[-1] if hang_times else 0.0
 
     return {"longest_diff": longest_difference, "total_time": total_connection_time}
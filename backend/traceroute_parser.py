@@ -0,0 +1,182 @@
+import re
+from dataclasses import dataclass, field
+
+# output formats we know how to parse
+TCPTRACEROUTE = "tcptraceroute"
+TRACEROUTE = "traceroute"
+TRACERT = "tracert"
+
+_IPV4 = r'\d{1,3}(?:\.\d{1,3}){3}'
+_IPV6 = r'[0-9a-fA-F]{0,4}(?::[0-9a-fA-F]{0,4}){2,7}(?:%\w+)?'
+_IP = rf'(?:{_IPV4}|{_IPV6})'
+
+# the first line of each format names the destination:
+#   tcptraceroute: Tracing the path to example.com (93.184.216.34) on TCP port 443 (https), 30 hops max
+#   traceroute:    traceroute to example.com (93.184.216.34), 30 hops max, 60 byte packets
+#   tracert:       Tracing route to example.com [93.184.216.34]
+banner_regs = {
+    TCPTRACEROUTE: re.compile(rf'^Tracing the path to \S+ \(({_IP})\)'),
+    TRACEROUTE: re.compile(rf'^traceroute6? to \S+ \(({_IP})\)'),
+    TRACERT: re.compile(rf'^\s*Tracing route to (?:\S+ \[({_IP})\]|({_IP}))'),
+}
+
+# fast paths for the line each format prints most of the time, one probe per hop:
+#   tcptraceroute -q 1:  " 7  host.example.net (10.0.0.1)  1.234 ms" (name only without -n)
+#                        "11  example.com (93.184.216.34) [open]  20.1 ms"
+#   tracert:             "  3    10 ms     9 ms    10 ms  host.example.net [10.0.0.1]"
+fast_line_regs = {
+    TCPTRACEROUTE: re.compile(
+        rf'^\s*(\d+)\s+(?:(\S+) \(({_IP})\)|({_IP}))(?: \[(open|closed)\])?\s+(\d+(?:\.\d+)?) ms\s*$'
+    ),
+    TRACERT: re.compile(
+        rf'^\s*(\d+)\s+<?(\d+) ms\s+<?(\d+) ms\s+<?(\d+) ms\s+(?:(\S+) \[({_IP})\]|({_IP}))\s*$'
+    ),
+}
+
+# general case, one token at a time. covers the other formats, several probes per hop,
+# timed out probes and probes answered by different routers
+hop_line_reg = re.compile(r'^\s*(\d+)\s+(.*)$')
+hop_token_reg = re.compile(
+    rf'(?P<rtt><?\d+(?:\.\d+)?)\s*ms(?=\s|$)'
+    rf'|(?P<timeout>\*)'
+    rf'|\[(?P<marker>open|closed)\]'
+    rf'|[(\[](?P<enclosed_ip>{_IP})[)\]](?=\s|$)'
+    rf'|(?P<ip>{_IP})(?=\s|$)'
+    rf'|(?P<word>\S+)'
+)
+
+@dataclass(slots=True)
+class Hop:
+    """
+    One hop (TTL) of a traceroute
+    """
+
+    # hop number
+    ttl: int
+
+    # address that answered the first responding probe, None if every probe timed out
+    ip: str | None = None
+
+    # reverse DNS name of ip, if the traceroute printed one
+    hostname: str | None = None
+
+    # round trip time of each probe in ms, None for a probe that timed out (printed *)
+    rtts: list = field(default_factory=list)
+
+    # "open"/"closed" if this hop is the destination answering a TCP probe
+    marker: str | None = None
+
+    @property
+    def rtt(self):
+        """
+        Round trip time of the first probe that got an answer, None if they all timed out
+        """
+        return next((rtt for rtt in self.rtts if rtt is not None), None)
+
+    @property
+    def timed_out(self):
+        return self.ip is None
+
+    def to_dict(self):
+        return {
+            "hop": self.ttl,
+            "ip": self.ip,
+            "rtt": self.rtt,
+            "rtts": self.rtts,
+            "marker": self.marker,
+        }
+
+def detect_format(line):
+    """
+    Works out which tool printed a traceroute from its first line
+
+    Input:
+        line (string): first line of traceroute stdout
+
+    Output:
+        (string, string): (format, destination IP address), or (None, None) if the line
+            isn't a banner we know
+    """
+    for fmt, reg in banner_regs.items():
+        match = reg.match(line)
+        if match:
+            return fmt, match.group(1) or match.group(2)
+    return None, None
+
+def parse_hop_line(line, fmt=None):
+    """
+    Parses a single line of traceroute output
+
+    Input:
+        line (string): line of traceroute stdout
+        fmt (string): format from detect_format, to try that format's fast path first
+
+    Output:
+        Hop: the hop, or None if the line isn't a hop (banner, blank line, trailer)
+    """
+    fast_reg = fast_line_regs.get(fmt)
+    if fast_reg:
+        match = fast_reg.match(line)
+        if match:
+            if fmt == TCPTRACEROUTE:
+                ttl, hostname, named_ip, ip, marker, rtt = match.groups()
+                return Hop(int(ttl), named_ip or ip, hostname, [float(rtt)], marker)
+
+            ttl, rtt_1, rtt_2, rtt_3, hostname, named_ip, ip = match.groups()
+            return Hop(int(ttl), named_ip or ip, hostname, [float(rtt_1), float(rtt_2), float(rtt_3)])
+
+    match = hop_line_reg.match(line)
+    if not match:
+        return None
+
+    hop = Hop(int(match.group(1)))
+    pending_name = None
+    for token in hop_token_reg.finditer(match.group(2)):
+        kind = token.lastgroup
+        if kind == "rtt":
+            # tracert prints <1 ms for sub-millisecond times
+            hop.rtts.append(float(token.group(kind).lstrip("<")))
+        elif kind == "timeout":
+            hop.rtts.append(None)
+        elif kind == "marker":
+            hop.marker = token.group(kind)
+        elif kind in ("enclosed_ip", "ip"):
+            # later probes can be answered by other routers, the hop is the first one
+            if hop.ip is None:
+                hop.ip = token.group(kind)
+                if kind == "enclosed_ip" and pending_name != hop.ip:
+                    hop.hostname = pending_name
+            pending_name = None
+        else:
+            pending_name = token.group(kind)
+
+    # lines like "Trace complete." or tracert's banner don't carry any hop information
+    if hop.ip is None and not hop.rtts:
+        return None
+
+    return hop
+
+def parse_traceroute(output):
+    """
+    Parses the whole output of a traceroute in one pass
+
+    Input:
+        output (string): traceroute stdout
+
+    Output:
+        list: Hop for every hop line, in order. the destination in the banner is not a hop
+    """
+    fmt = None
+    hops = []
+    for line in output.splitlines():
+        if fmt is None:
+            detected, _ = detect_format(line)
+            if detected:
+                fmt = detected
+                continue
+
+        hop = parse_hop_line(line, fmt)
+        if hop:
+            hops.append(hop)
+
+    return hops
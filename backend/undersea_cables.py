@@ -1,15 +1,152 @@
+import os
 import json
+import mmap
+import struct
+import numpy as np
 from logging_config import get_logger
-from haversine import haversine
+from geo_math import EARTH_RADIUS_KM, haversine_distances, unit_vectors, unit_vector_to_lat_lon, arc_geometry, arc_distances, nearest_arc_points
+from spatial_index import EndpointGrid, SegmentRTree
+from landing_stations import LandingStations
+from metrics import timed
 
 logger = get_logger()
 cable_json_path = "./cable-geo.json"
 
+# precomputed endpoint artifact, written by build_cable_endpoints.py
+cable_endpoints_path = "./cable-endpoints.bin"
+
+# artifact layout (little endian):
+#   header: magic, number of cables, number of endpoints, size of the cable id table in bytes
+#   int64[n_cables + 1] offsets
+#   float64[n_endpoints] x4: latitude (deg), longitude (deg), latitude (rad), longitude (rad)
+#   utf-8 cable ids separated by newlines
+# everything before the id table is 8 bytes wide, so every array stays aligned when mapped
+_ARTIFACT_MAGIC = b"CABLEPT1"
+_ARTIFACT_HEADER = struct.Struct("<8sQQQ")
+
+# cable matching modes. "endpoints" only looks at the ends of each cable subpath,
+# "geometry" matches against every segment of the cable path, "stations" snaps each hop
+# to its nearest landing station and looks up the cables between the two stations
+MATCH_ENDPOINTS = "endpoints"
+MATCH_GEOMETRY = "geometry"
+MATCH_STATIONS = "stations"
+
 class CableMapper:
-    def __init__(self):
-        self.cable_map = self._get_cable_map(cable_json_path)
+    def __init__(self, mode=MATCH_ENDPOINTS):
+        """
+        Inputs:
+            mode (string): MATCH_ENDPOINTS, MATCH_GEOMETRY or MATCH_STATIONS
+        """
+        if mode not in (MATCH_ENDPOINTS, MATCH_GEOMETRY, MATCH_STATIONS):
+            raise ValueError(f"unknown cable matching mode {mode!r}")
+        self.mode = mode
+
+        # columnar endpoint storage. endpoints of cable i live at
+        # [self._offsets[i], self._offsets[i + 1]) in the flat endpoint arrays.
+        # _lat/_lon are radians copies for the haversine kernel so we don't convert on every query
+        if artifact_is_fresh(cable_endpoints_path, cable_json_path):
+            columns = _read_endpoint_artifact(cable_endpoints_path)
+        else:
+            logger.info(f"[CableMapper]: {cable_endpoints_path} missing or stale, loading {cable_json_path}")
+            columns = self._columns_from_cable_map(self._get_cable_map(cable_json_path))
+
+        self._cable_ids, self._offsets, self._lat_deg, self._lon_deg, self._lat, self._lon = columns
+
+        self._endpoint_index = self._build_endpoint_index()
+
+        # full cable geometry, only loaded in geometry mode
+        if mode == MATCH_GEOMETRY:
+            with open(cable_json_path, 'r') as f:
+                self._load_segments(json.load(f))
+
+        # landing station graph, only built in stations mode
+        if mode == MATCH_STATIONS:
+            self._stations = LandingStations(self._cable_ids, self._offsets, self._lat_deg, self._lon_deg)
+
+    @staticmethod
+    def _columns_from_cable_map(cable_map):
+        """
+        Converts a cable map into the columnar endpoint representation
+
+        Inputs:
+            cable_map (dict): output of _map_cable_endpoints
+
+        Outputs:
+            (list, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray): cable ids,
+                cable offsets, and endpoint latitudes/longitudes in degrees then radians
+        """
+        cable_ids = list(cable_map.keys())
+        offsets = np.zeros(len(cable_ids) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(endpoints) for endpoints in cable_map.values()])
 
-    def _map_cable_endpoints(self, cable_data):
+        points = [(endpoint["lat"], endpoint["lon"]) for endpoints in cable_map.values() for endpoint in endpoints]
+        lat_deg, lon_deg = np.array(points, dtype=np.float64).reshape(-1, 2).T
+
+        return (
+            cable_ids,
+            offsets,
+            np.ascontiguousarray(lat_deg),
+            np.ascontiguousarray(lon_deg),
+            np.radians(lat_deg),
+            np.radians(lon_deg)
+        )
+
+    def _build_endpoint_index(self):
+        """
+        Builds a spatial index over every endpoint of every cable
+
+        Outputs:
+            EndpointGrid: grid mapping endpoint locations to the position of their cable
+                in self._cable_ids
+        """
+        cable_positions = np.repeat(np.arange(len(self._cable_ids)), np.diff(self._offsets))
+        return EndpointGrid(zip(self._lat_deg.tolist(), self._lon_deg.tolist(), cable_positions.tolist()))
+
+    def _candidate_cables(self, lat_A, lon_A, lat_B, lon_B, tol):
+        """
+        Gets the positions of cables that could possibly be within tol of locations A and B
+
+        A cable's score is the average of its distances to A and B, so a cable can only
+        score <= tol if it has an endpoint within 2 * tol of A and an endpoint within
+        2 * tol of B. Every other cable can be skipped without changing the result.
+
+        outputs:
+            np.ndarray: sorted candidate positions in self._cable_ids
+        """
+        near_A = self._endpoint_index.query(lat_A, lon_A, 2 * tol)
+        if not near_A:
+            return np.empty(0, dtype=np.int64)
+
+        near_B = self._endpoint_index.query(lat_B, lon_B, 2 * tol)
+        return np.array(sorted(near_A & near_B), dtype=np.int64)
+
+    def _gather_endpoints(self, cables):
+        """
+        Gets the flat endpoint indices for a subset of cables
+
+        inputs:
+            cables (np.ndarray): sorted cable positions
+
+        outputs:
+            (np.ndarray, np.ndarray): indices into the flat endpoint arrays, and the offset
+                where each cable's endpoints start inside of those indices (for reduceat)
+        """
+        starts = self._offsets[cables]
+        counts = self._offsets[cables + 1] - starts
+        local_starts = np.cumsum(counts) - counts
+
+        # every cable's run of endpoints is contiguous, so shift a single arange per run
+        idx = np.arange(counts.sum()) + np.repeat(starts - local_starts, counts)
+        return idx, local_starts
+
+    def _endpoint(self, i):
+        """
+        Gets an endpoint in the {"lat", "lon"} format the rest of the app uses
+        """
+        return {"lat": float(self._lat_deg[i]), "lon": float(self._lon_deg[i])}
+
+    @staticmethod
+    def _map_cable_endpoints(cable_data):
         """
         Maps cable id (ascii name) to all endpoints in cable path
 
@@ -67,6 +204,7 @@ class CableMapper:
 
         return cable_map
 
+    @timed("cable_match")
     def find_nearest_cable(self, lat_A, lon_A, lat_B, lon_B, tol):
         """
         uses the haversine formula to determine the closest undersea cable to two ping locations
@@ -84,64 +222,379 @@ class CableMapper:
                 average distance between the two endpoints and a cable,
                 the id of the closest cable, the nearest endpoint in
                 that cable to the first IP location, and the nearest
-                endpoint in that cable to the second IP location
-        """
-        pos_A = (lat_A, lon_A)
-        pos_B = (lat_B, lon_B)
-
-        # initialize distance tracking variables
-        min_avg_dist = float("inf") # minimum average distance (between the two pings) to the nearest cable
-        nearest_cable_id = None # id of average nearest cable
-        nearest_endpoint_A = None # endpoint of nearest cable nearest to location A
-        nearest_endpoint_B = None # endpoint of nearest cable nearest to location B
-
-        # iterate through all cables
-        for id, endpoints in self.cable_map.items():
-            # initialize distance tracking variables for this cable
-            min_distance_A = float("inf") # smallest distance between location A and the current cable
-            min_endpoint_A = None # endpoint on cable nearest to location A
-            min_distance_B = float("inf") # smallest distance between location B and the current cable
-            min_endpoint_B = None # endpoint on cable nearest to location B
-
-            # check each endpoint in cable for proximity to locations A and B
-            for endpoint in endpoints:
-                endpoint_pos = (endpoint["lat"], endpoint["lon"])
-
-                # compute distances in km from each location to this endpoint
-                distance_A = abs(haversine(pos_A, endpoint_pos))
-                distance_B = abs(haversine(pos_B, endpoint_pos))
-
-                # update nearest endpoint for A if distance is smaller than current min distance to A
-                if distance_A < min_distance_A:
-                    min_distance_A = distance_A
-                    min_endpoint_A = endpoint
-
-                # update nearest endpoint for B if distance is smaller than current min distance to B
-                if distance_B < min_distance_B:
-                    min_distance_B = distance_B
-                    min_endpoint_B = endpoint
-
-            # compute average between min distances to this cable
-            avg_dist = (min_distance_A + min_distance_B) / 2
-
-            # if the endpoints are the same, the datacenters are not connected by the cable
-            # if endpoints are different and average distance is smaller, this cable is closer
-            # to locations A and B
-            if min_endpoint_B != min_endpoint_A and avg_dist < min_avg_dist:
-                min_avg_dist = avg_dist
-                nearest_cable_id = id
-                nearest_endpoint_A = min_endpoint_A
-                nearest_endpoint_B = min_endpoint_B
+                endpoint in that cable to the second IP location. in geometry mode
+                the distances are to the nearest segment of each cable, and the
+                "endpoints" are the points on the cable nearest to each location
+        """
+        if self.mode == MATCH_GEOMETRY:
+            return self._pick_nearest_geometry(
+                self._nearest_segments(lat_A, lon_A, 2 * tol),
+                self._nearest_segments(lat_B, lon_B, 2 * tol),
+                tol
+            )
+
+        if self.mode == MATCH_STATIONS:
+            # a location more than 2 * tol from every station can't average <= tol
+            snapped_A = self._stations.snap(lat_A, lon_A)
+            if snapped_A[1] > 2 * tol:
+                return None
+            return self._stations.find_cable(snapped_A, self._stations.snap(lat_B, lon_B), tol)
+
+        # only check cables that have endpoints near both locations. the rest of the cables
+        # can't be within tol, so checking them can't change the result
+        cables = self._candidate_cables(lat_A, lon_A, lat_B, lon_B, tol)
+        if not len(cables):
+            return None
+
+        idx, starts = self._gather_endpoints(cables)
+        lat_A, lon_A, lat_B, lon_B = np.radians((lat_A, lon_A, lat_B, lon_B))
+
+        # compute distances in km from each location to every candidate endpoint in one pass
+        distances_A = haversine_distances(lat_A, lon_A, self._lat[idx], self._lon[idx])
+        distances_B = haversine_distances(lat_B, lon_B, self._lat[idx], self._lon[idx])
+
+        return self._pick_nearest(
+            cables,
+            self._cable_minimums(distances_A, idx, starts),
+            self._cable_minimums(distances_B, idx, starts),
+            tol
+        )
+
+    @timed("cable_match_route")
+    def find_nearest_cables_for_route(self, points, tol):
+        """
+        find_nearest_cable for every adjacent pair of locations along a route
+
+        The distance from each hop to the endpoints is computed once as a row of a
+        hop-to-endpoint matrix, then both pairs that share the hop reuse that row.
+
+        inputs:
+            points (list): (latitude, longitude) of each hop, in route order
+            tol (float): largest acceptable distance from the closest cable
+
+        outputs:
+            list: one find_nearest_cable result (dict or None) per adjacent pair of points,
+                so the list has len(points) - 1 entries
+        """
+        if len(points) < 2:
+            return []
+
+        if self.mode == MATCH_GEOMETRY:
+            # every hop is searched once and shared by both of its pairs
+            nearest = [self._nearest_segments(lat, lon, 2 * tol) for lat, lon in points]
+            return [
+                self._pick_nearest_geometry(nearest[i], nearest[i + 1], tol)
+                for i in range(len(points) - 1)
+            ]
+
+        if self.mode == MATCH_STATIONS:
+            snapped = [self._stations.snap(lat, lon) for lat, lon in points]
+            return [
+                self._stations.find_cable(snapped[i], snapped[i + 1], tol)
+                for i in range(len(points) - 1)
+            ]
+
+        # cables near each hop. a pair's candidates are the cables near both of its hops
+        near = [self._endpoint_index.query(lat, lon, 2 * tol) for lat, lon in points]
+        pair_candidates = [near[i] & near[i + 1] for i in range(len(points) - 1)]
+
+        # only look at cables that are a candidate for at least one pair. a cable that isn't
+        # a candidate for a given pair scores > tol there, so it can never be picked over a
+        # real candidate and can be left in that pair's comparison
+        cables = np.array(sorted(set().union(*pair_candidates)), dtype=np.int64)
+        if not len(cables):
+            return [None] * (len(points) - 1)
+
+        idx, starts = self._gather_endpoints(cables)
+
+        # hop-to-endpoint distance matrix: one row per hop, one column per candidate endpoint
+        hop_pos = np.radians(np.array(points, dtype=np.float64))
+        distances = haversine_distances(
+            hop_pos[:, 0:1],
+            hop_pos[:, 1:2],
+            self._lat[idx][np.newaxis, :],
+            self._lon[idx][np.newaxis, :]
+        )
+
+        # per-cable minimums for each hop that's part of a pair with candidates
+        minimums = {}
+        for i, candidates in enumerate(pair_candidates):
+            if candidates:
+                for hop in (i, i + 1):
+                    if hop not in minimums:
+                        minimums[hop] = self._cable_minimums(distances[hop], idx, starts)
+
+        return [
+            self._pick_nearest(cables, minimums[i], minimums[i + 1], tol) if candidates else None
+            for i, candidates in enumerate(pair_candidates)
+        ]
+
+    def _cable_minimums(self, distances, idx, starts):
+        """
+        Reduces per-endpoint distances to per-cable minimums
+
+        inputs:
+            distances (np.ndarray): distance from a location to each endpoint in idx
+            idx (np.ndarray): flat endpoint indices of the cables being considered
+            starts (np.ndarray): where each cable's endpoints start in idx
+
+        outputs:
+            (np.ndarray, np.ndarray): smallest distance between the location and each cable,
+                and the flat index of the endpoint on each cable nearest to the location
+        """
+        min_distances = np.minimum.reduceat(distances, starts)
+        nearest = idx[self._first_argmin(distances, min_distances, starts)]
+        return min_distances, nearest
+
+    def _pick_nearest(self, cables, minimums_A, minimums_B, tol):
+        """
+        Picks the cable with the smallest average distance to locations A and B
+
+        inputs:
+            cables (np.ndarray): cable positions being considered
+            minimums_A (tuple): _cable_minimums result for location A
+            minimums_B (tuple): _cable_minimums result for location B
+            tol (float): largest acceptable distance from the closest cable
+
+        outputs:
+            same as find_nearest_cable
+        """
+        min_distances_A, nearest_A = minimums_A
+        min_distances_B, nearest_B = minimums_B
+
+        # compute average between min distances to each cable
+        avg_dist = (min_distances_A + min_distances_B) / 2
+
+        # if the endpoints are the same, the datacenters are not connected by the cable
+        same_endpoint = (
+            (self._lat_deg[nearest_A] == self._lat_deg[nearest_B])
+            & (self._lon_deg[nearest_A] == self._lon_deg[nearest_B])
+        )
+        avg_dist[same_endpoint] = np.inf
+
+        # argmin keeps the first cable on ties, same as the original cable_map scan
+        best = int(np.argmin(avg_dist))
 
         # if the nearest cable is within the tolerance (in km), return info. otherwise, return None
         return {
-            "id": nearest_cable_id,
-            "endpoint_A": nearest_endpoint_A,
-            "endpoint_B": nearest_endpoint_B
-        } if min_avg_dist <= tol else None
+            "id": self._cable_ids[cables[best]],
+            "endpoint_A": self._endpoint(nearest_A[best]),
+            "endpoint_B": self._endpoint(nearest_B[best])
+        } if avg_dist[best] <= tol else None
+
+    @staticmethod
+    def _first_argmin(distances, min_distances, starts):
+        """
+        Finds the index of the first minimum inside of each cable's run of distances
+
+        inputs:
+            distances (np.ndarray): flat distances for every endpoint
+            min_distances (np.ndarray): per-cable minimums from np.minimum.reduceat
+            starts (np.ndarray): where each cable's run starts in distances
+
+        outputs:
+            np.ndarray: index into distances of each cable's first minimum
+        """
+        counts = np.diff(np.append(starts, len(distances)))
+        cable_of = np.repeat(np.arange(len(starts)), counts)
+
+        # every cable has at least one endpoint equal to its minimum. keep the first per cable
+        hits = np.flatnonzero(distances == min_distances[cable_of])
+        first = np.flatnonzero(np.diff(cable_of[hits], prepend=-1))
+        return hits[first]
+
+    def _load_segments(self, cable_data):
+        """
+        Loads every segment of every cable path and builds an R-tree over them
+
+        Each segment is stored as its arc_geometry: the unit vectors of its two ends plus
+        the normals arc_distances needs, all in one array so a query gathers them at once. Features that share a cable
+        id all count towards that cable.
+
+        Inputs:
+            cable_data (dict): unpacked json of cable data via www.submarinecablemap.com API
+        """
+        positions = {cid: i for i, cid in enumerate(self._cable_ids)}
+
+        starts, ends, cables = [], [], []
+        for cable_info in cable_data["features"]:
+            position = positions.get(cable_info["properties"]["id"])
+            if position is None:
+                continue
+
+            for sp in cable_info["geometry"]["coordinates"]:
+                # each point in geometry array is [lon, lat]
+                points = np.radians(np.array(sp, dtype=np.float64)[:, :2])
+                vectors = unit_vectors(points[:, 1], points[:, 0])
+                starts.append(vectors[:-1])
+                ends.append(vectors[1:])
+                cables.append(np.full(len(vectors) - 1, position, dtype=np.int64))
+
+        seg_a = np.concatenate(starts)
+        seg_b = np.concatenate(ends)
+        self._seg_cable = np.concatenate(cables)
+        self._segments = arc_geometry(seg_a, seg_b)
+
+        # the arc between two points bows out past the straight line between them by up to
+        # 1 - cos(angle / 2), so pad each segment's box by that much
+        angles = np.arccos(np.clip(np.einsum("ij,ij->i", seg_a, seg_b), -1.0, 1.0))
+        bulge = (1 - np.cos(angles / 2))[:, np.newaxis]
+        self._segment_index = SegmentRTree(
+            np.minimum(seg_a, seg_b) - bulge,
+            np.maximum(seg_a, seg_b) + bulge
+        )
+
+    def _nearest_segments(self, lat, lon, radius):
+        """
+        Finds the cables with a segment within radius km of a location
+
+        inputs:
+            lat (float): latitude of the location
+            lon (float): longitude of the location
+            radius (float): search radius in km
+
+        outputs:
+            (np.ndarray, np.ndarray, np.ndarray): sorted positions of the cables in
+                range, the distance from the location to each of them, and the nearest
+                point on each of them as a unit vector
+        """
+        p = unit_vectors(np.radians(lat), np.radians(lon))
+
+        # a great-circle distance d is a straight line of 2 sin(d / 2R) through the sphere.
+        # pad it slightly so floating point error never drops a segment on the boundary
+        chord = 2 * np.sin(min(radius / (2 * EARTH_RADIUS_KM), np.pi / 2)) * 1.0001 + 1e-12
+        segments = self._segment_index.query_ball(p, chord)
+
+        arcs = self._segments[segments]
+        distances, beside = arc_distances(p, arcs)
+
+        # keep each cable's nearest segment in range (the first one on ties)
+        in_range = np.flatnonzero(distances <= radius)
+        cables = self._seg_cable[segments[in_range]]
+        order = in_range[np.lexsort((distances[in_range], cables))]
+        cables = self._seg_cable[segments[order]]
+        first = order[np.concatenate(([True], cables[1:] != cables[:-1]))] if len(order) else order
+
+        nearest = nearest_arc_points(p, arcs[first], beside[first])
+        return self._seg_cable[segments[first]], distances[first], nearest
+
+    def _pick_nearest_geometry(self, nearest_A, nearest_B, tol):
+        """
+        Picks the cable with the smallest average distance to locations A and B in
+        geometry mode
+
+        inputs:
+            nearest_A (tuple): _nearest_segments result for location A (radius 2 * tol)
+            nearest_B (tuple): _nearest_segments result for location B (radius 2 * tol)
+            tol (float): largest acceptable distance from the closest cable
+
+        outputs:
+            same as find_nearest_cable. the endpoints are the points on the cable nearest
+                to each location
+        """
+        cables_A, distances_A, points_A = nearest_A
+        cables_B, distances_B, points_B = nearest_B
+
+        # a cable can only average <= tol if it's within 2 * tol of both locations
+        cables, in_A, in_B = np.intersect1d(cables_A, cables_B, assume_unique=True, return_indices=True)
+        if not len(cables):
+            return None
+
+        avg_dist = (distances_A[in_A] + distances_B[in_B]) / 2
+
+        # if both locations reach the cable at (about) the same spot, the datacenters are not
+        # connected by the cable
+        points_A, points_B = points_A[in_A], points_B[in_B]
+        span = np.arctan2(
+            np.linalg.norm(np.cross(points_A, points_B), axis=1),
+            np.einsum("ij,ij->i", points_A, points_B)
+        ) * EARTH_RADIUS_KM
+        avg_dist[span < tol] = np.inf
+
+        # argmin keeps the first cable on ties, same as endpoint mode
+        best = int(np.argmin(avg_dist))
+        if avg_dist[best] > tol:
+            return None
+
+        lat_A, lon_A = unit_vector_to_lat_lon(points_A[best])
+        lat_B, lon_B = unit_vector_to_lat_lon(points_B[best])
+        return {
+            "id": self._cable_ids[cables[best]],
+            "endpoint_A": {"lat": lat_A, "lon": lon_A},
+            "endpoint_B": {"lat": lat_B, "lon": lon_B}
+        }
 
-    def _get_cable_map(self, path):
+    @staticmethod
+    def _get_cable_map(path):
         with open(path, 'r') as f:
             data = json.load(f)
 
-        return self._map_cable_endpoints(data)
\ No newline at end of file
+        return CableMapper._map_cable_endpoints(data)
+
+def write_endpoint_artifact(source_path=cable_json_path, artifact_path=cable_endpoints_path):
+    """
+    Writes the precomputed endpoint artifact that CableMapper maps at startup
+
+    Inputs:
+        source_path (string): path of the cable GeoJSON
+        artifact_path (string): path to write the artifact to
+
+    Outputs:
+        (int, int): number of cables and number of endpoints written
+    """
+    cable_ids, offsets, lat_deg, lon_deg, lat, lon = CableMapper._columns_from_cable_map(
+        CableMapper._get_cable_map(source_path)
+    )
+    id_table = "\n".join(cable_ids).encode("utf-8")
+
+    # write to a temp file and swap it in so running workers never map a half-written file
+    tmp_path = f"{artifact_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_ARTIFACT_HEADER.pack(_ARTIFACT_MAGIC, len(cable_ids), len(lat_deg), len(id_table)))
+        for array in (offsets, lat_deg, lon_deg, lat, lon):
+            f.write(np.ascontiguousarray(array, dtype="<f8" if array.dtype.kind == "f" else "<i8").tobytes())
+        f.write(id_table)
+    os.replace(tmp_path, artifact_path)
+
+    return len(cable_ids), len(lat_deg)
+
+def artifact_is_fresh(artifact_path, source_path):
+    """
+    Checks that a built artifact (e.g. the cable endpoints or simplified geometry) exists
+    and is at least as new as the file it was built from
+    """
+    try:
+        return os.path.getmtime(artifact_path) >= os.path.getmtime(source_path)
+    except OSError:
+        return False
+
+def _read_endpoint_artifact(path):
+    """
+    Memory-maps the endpoint artifact. The arrays are read-only views into the mapping,
+    so every worker process that loads the same file shares its pages
+
+    Inputs:
+        path (string): path of the artifact
+
+    Outputs:
+        same as CableMapper._columns_from_cable_map
+    """
+    with open(path, "rb") as f:
+        # the mapping stays open after the file is closed, as long as the arrays reference it
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, n_cables, n_endpoints, id_table_size = _ARTIFACT_HEADER.unpack_from(buf, 0)
+    if magic != _ARTIFACT_MAGIC:
+        raise ValueError(f"{path} is not a cable endpoint artifact")
+
+    pos = _ARTIFACT_HEADER.size
+    offsets = np.frombuffer(buf, dtype="<i8", count=n_cables + 1, offset=pos)
+    pos += offsets.nbytes
+
+    columns = []
+    for _ in range(4):
+        columns.append(np.frombuffer(buf, dtype="<f8", count=n_endpoints, offset=pos))
+        pos += n_endpoints * 8
+
+    cable_ids = buf[pos:pos + id_table_size].decode("utf-8").split("\n")
+    return (cable_ids, offsets, *columns)
\ No newline at end of file
@@ -64,19 +64,48 @@ export interface CableFeatureCollection extends FeatureCollection<MultiLineStrin
   features: CableFeature[];
 }
 
+const API_URL = 'http://127.0.0.1:8000';
+
+// zoom level of the geometry for the layer showing every cable (the globe view), and for
+// the highlighted cables on a route. the backend simplifies the geometry for each zoom
+const OVERVIEW_ZOOM = 5;
+const HIGHLIGHT_ZOOM = 8;
+
+const emptyCollection = () => ({
+  type: 'FeatureCollection' as const,
+  features: []
+});
+
 export class CableManager {
   private visibleCableIds: Set<string> = new Set();
   private map: Map;
   private highlightSourceId = 'highlight-data';
   private highlightLayerId = 'highlights';
 
+  // geometry version from the backend. urls with it never change, so the browser can
+  // keep them cached for good
+  private version: Promise<string>;
+
+  // detailed geometry of every cable highlighted so far, by cable id
+  private cableFeatures: Record<string, Promise<CableFeature[]>> = {};
+
   constructor(map: Map) {
     this.map = map;
 
+    this.version = fetch(`${API_URL}/api/cables/manifest`)
+      .then(r => r.json())
+      .then(manifest => manifest.version)
+      .catch(() => '');
 
     map.addSource('cable-data', {
       type: 'geojson',
-      data: '../cable-geo.json'
+      data: emptyCollection()
+    });
+
+    // only the simplified overview geometry is loaded up front
+    this.version.then(version => {
+      const source = this.map.getSource('cable-data') as mapboxgl.GeoJSONSource;
+      source?.setData(`${API_URL}/api/cables?zoom=${OVERVIEW_ZOOM}&v=${version}`);
     });
 
     map.addLayer({
@@ -91,7 +120,7 @@ export class CableManager {
 
     map.addSource(this.highlightSourceId, {
       type: 'geojson',
-      data: '../cable-geo.json'
+      data: emptyCollection()
     });
 
     this.map.addLayer({
@@ -105,8 +134,6 @@ export class CableManager {
       }
     });
 
-    this.updateFilter();
-
   }
 
   // highlightSubcables(cableId: string, endpoints: SubcableEndpoint[]) {
@@ -183,17 +210,17 @@ export class CableManager {
 
   addCable = (cableId: string) => {
     this.visibleCableIds.add(cableId);
-    this.updateFilter();
+    this.updateHighlights();
   }
 
   removeCable = (cableId: string) => {
     this.visibleCableIds.delete(cableId);
-    this.updateFilter();
+    this.updateHighlights();
   }
 
   clearFilter = () => {
     this.visibleCableIds.clear();
-    this.updateFilter();
+    this.updateHighlights();
   }
 
   showAll = () => {
@@ -201,15 +228,36 @@ export class CableManager {
     this.map.setFilter('cables', null);
   }
 
-  private updateFilter = () => {
-    if (this.visibleCableIds.size === 0) {
-      this.map.setFilter(this.highlightLayerId, ['==', ['get', 'id'], '']);
-    } else {
-      this.map.setFilter(this.highlightLayerId, [
-        'in',
-        ['get', 'id'],
-        ['literal', Array.from(this.visibleCableIds)]
-      ]);
+  // fetches a cable's detailed geometry the first time it's highlighted
+  private loadCable = (cableId: string): Promise<CableFeature[]> => {
+    if (!(cableId in this.cableFeatures)) {
+      this.cableFeatures[cableId] = this.version
+        .then(version => fetch(`${API_URL}/api/cables/${encodeURIComponent(cableId)}?zoom=${HIGHLIGHT_ZOOM}&v=${version}`))
+        .then(r => r.ok ? r.json() : emptyCollection())
+        .then((collection: CableFeatureCollection) => collection.features)
+        .catch(() => {
+          // let the next highlight try again
+          delete this.cableFeatures[cableId];
+          return [];
+        });
     }
+    return this.cableFeatures[cableId];
+  }
+
+  // shows the detailed geometry of the visible cables, and only those, in the highlight layer
+  private updateHighlights = () => {
+    const cableIds = Array.from(this.visibleCableIds);
+    Promise.all(cableIds.map(this.loadCable)).then(features => {
+      // the visible cables may have changed while we were fetching
+      if (cableIds.some(cableId => !this.visibleCableIds.has(cableId)) || cableIds.length !== this.visibleCableIds.size) {
+        return;
+      }
+
+      const source = this.map.getSource(this.highlightSourceId) as mapboxgl.GeoJSONSource;
+      source?.setData({
+        type: 'FeatureCollection',
+        features: features.flat()
+      });
+    });
   }
 }
\ No newline at end of file